@@ -47,6 +47,9 @@ from leap.soledad.common.crypto import (
     ENC_IV_KEY,
     MAC_KEY,
     MAC_METHOD_KEY,
+    ENC_VERSION_KEY,
+    ENC_VERSION_1,
+    ENC_VERSION_2,
 )
 
 logger = logging.getLogger(__name__)
@@ -382,7 +385,8 @@ def decrypt_doc(crypto, doc):
     return decrypt_doc_dict(doc.content, doc.doc_id, doc.rev, key, secret)
 
 
-def decrypt_doc_dict(doc_dict, doc_id, doc_rev, key, secret):
+def decrypt_doc_dict(doc_dict, doc_id, doc_rev, key, secret,
+                     ciphertext=None):
     """
     Decrypt C{doc}'s content.
 
@@ -404,6 +408,11 @@ def decrypt_doc_dict(doc_dict, doc_id, doc_rev, key, secret):
     EncryptionSchemes.SYMKEY and C{enc_method} is
     EncryptionMethods.AES_256_CTR.
 
+    This is version 1 of the encrypted document format, where C{enc_blob} is
+    hex encoded. In version 2, doc_dict has ENC_VERSION_KEY set to
+    ENC_VERSION_2 and no ENC_JSON_KEY, and the raw ciphertext has to be given
+    in the C{ciphertext} argument.
+
     :param doc_dict: The content of the document to be decrypted.
     :type doc_dict: dict
 
@@ -419,18 +428,27 @@ def decrypt_doc_dict(doc_dict, doc_id, doc_rev, key, secret):
     :param secret:
     :type secret:
 
+    :param ciphertext: The raw ciphertext, for documents in version 2 of the
+                       encrypted document format.
+    :type ciphertext: str
+
     :return: The JSON serialization of the decrypted content.
     :rtype: str
     """
-    soledad_assert(ENC_JSON_KEY in doc_dict)
     soledad_assert(ENC_SCHEME_KEY in doc_dict)
     soledad_assert(ENC_METHOD_KEY in doc_dict)
     soledad_assert(MAC_KEY in doc_dict)
     soledad_assert(MAC_METHOD_KEY in doc_dict)
 
+    version = doc_dict.get(ENC_VERSION_KEY, ENC_VERSION_1)
+    if version == ENC_VERSION_2:
+        soledad_assert(ciphertext is not None)
+    else:
+        soledad_assert(ENC_JSON_KEY in doc_dict)
+        ciphertext = binascii.a2b_hex(  # content is stored as hex.
+            doc_dict[ENC_JSON_KEY])
+
     # verify MAC
-    ciphertext = binascii.a2b_hex(  # content is stored as hex.
-        doc_dict[ENC_JSON_KEY])
     mac = mac_doc(
         doc_id, doc_rev,
         ciphertext,
@@ -602,10 +602,14 @@ class SQLCipherDatabase(sqlite_backend.SQLitePartialExpandDatabase):
             encr.TABLE_NAME, encr.FIELD_NAMES))
         sql_decr = ("CREATE TABLE IF NOT EXISTS %s (%s)" % (
             decr.TABLE_NAME, decr.FIELD_NAMES))
+        sql_checkpoint = ("CREATE TABLE IF NOT EXISTS %s (%s)" % (
+            SoledadSyncTarget.CHECKPOINT_TABLE_NAME,
+            SoledadSyncTarget.CHECKPOINT_FIELD_NAMES))
 
         with self._sync_db_write_lock:
             self._sync_db.execute(sql_encr)
             self._sync_db.execute(sql_decr)
+            self._sync_db.execute(sql_checkpoint)
 
     #
     # Symmetric encryption of syncing docs
@@ -28,9 +28,12 @@ import logging
 import re
 import urllib
 import threading
+import zlib
 
 from collections import defaultdict
-from time import sleep
+from itertools import izip
+from Queue import Queue
+from time import sleep, time
 from uuid import uuid4
 
 import simplejson as json
@@ -43,6 +46,22 @@ from zope.proxy import ProxyBase
 from zope.proxy import sameProxiedObjects, setProxiedObject
 
 from leap.soledad.common.document import SoledadDocument
+from leap.soledad.common.errors import SyncSessionExpiredError
+from leap.soledad.common.wire import (
+    JSON_FORMAT,
+    BINARY_FORMAT,
+    FORMATS_HEADER,
+    REQUEST_ENCODINGS_HEADER,
+    BrokenFrameError,
+    choose_format,
+    choose_request_encoding,
+    decode_doc_frame,
+    decode_frames,
+    encode_doc_frame,
+    encode_frame,
+    make_content_type,
+    parse_content_type,
+)
 from leap.soledad.client.auth import TokenBasedAuth
 from leap.soledad.client.crypto import is_symmetrically_encrypted
 from leap.soledad.client.crypto import encrypt_doc, decrypt_doc
@@ -73,177 +92,283 @@ def _gunzip(data):
     return data
 
 
-class PendingReceivedDocsSyncError(Exception):
-    pass
+def _compress(entries, encoding, compresslevel=6):
+    """
+    Compress the entries of a request body, one after the other.
 
+    :param entries: The entries of the request body.
+    :type entries: list of str
+    :param encoding: The content coding, either 'gzip' or 'deflate'.
+    :type encoding: str
+    :param compresslevel: The zlib compression level.
+    :type compresslevel: int
 
-class DocumentSyncerThread(threading.Thread):
-    """
-    A thread that knowns how to either send or receive a document during the
-    sync process.
+    :return: The compressed chunks of the request body.
+    :rtype: list of str
     """
+    wbits = zlib.MAX_WBITS
+    if encoding == 'gzip':
+        wbits += 16
+    compressor = zlib.compressobj(
+        compresslevel, zlib.DEFLATED, wbits, zlib.DEF_MEM_LEVEL, 0)
+    chunks = [compressor.compress(entry) for entry in entries]
+    chunks.append(compressor.flush())
+    return filter(None, chunks)
 
-    def __init__(self, doc_syncer, release_method, failed_method,
-                 idx, total, last_request_lock=None, last_callback_lock=None):
-        """
-        Initialize a new syncer thread.
 
-        :param doc_syncer: A document syncer.
-        :type doc_syncer: HTTPDocumentSyncer
-        :param release_method: A method to be called when finished running.
-        :type release_method: callable(DocumentSyncerThread)
-        :param failed_method: A method to be called when we failed.
-        :type failed_method: callable(DocumentSyncerThread)
-        :param idx: The index count of the current operation.
-        :type idx: int
-        :param total: The total number of operations.
-        :type total: int
-        :param last_request_lock: A lock to wait for before actually performing
-                                  the request.
-        :type last_request_lock: threading.Lock
-        :param last_callback_lock: A lock to wait for before actually running
-                                  the success callback.
-        :type last_callback_lock: threading.Lock
-        """
-        threading.Thread.__init__(self)
-        self._doc_syncer = doc_syncer
-        self._release_method = release_method
-        self._failed_method = failed_method
-        self._idx = idx
-        self._total = total
-        self._last_request_lock = last_request_lock
-        self._last_callback_lock = last_callback_lock
-        self._response = None
-        self._exception = None
-        self._result = None
-        self._success = False
-        # a lock so we can signal when we're finished
-        self._request_lock = threading.Lock()
-        self._request_lock.acquire()
-        self._callback_lock = threading.Lock()
-        self._callback_lock.acquire()
-        # make thread interruptable
-        self._stopped = None
-        self._stop_lock = threading.Lock()
+class PendingReceivedDocsSyncError(Exception):
+    pass
 
-    def run(self):
-        """
-        Run the HTTP request and store results.
 
-        This method will block and wait for an eventual previous operation to
-        finish before actually performing the request. It also traps any
-        exception and register any failure with the request.
-        """
-        with self._stop_lock:
-            if self._stopped is None:
-                self._stopped = False
-            else:
-                return
+class SyncWindowController(object):
+    """
+    Choose the number of sync requests that may be in flight at the same
+    time, based on observed request latency, throughput and server
+    unavailability.
+
+    The window grows additively (one request per window of successful
+    requests) while latency stays close to the lowest observed latency and
+    throughput does not drop, and shrinks multiplicatively otherwise, at most
+    once per window of requests. A 503 (unavailable) response from the server
+    halves the window.
+    """
 
-        # eventually wait for the previous thread to finish
-        if self._last_request_lock is not None:
-            self._last_request_lock.acquire()
+    INITIAL_WINDOW = 4
+    MIN_WINDOW = 1
+    MAX_WINDOW = 32
 
-        # bail out in case we've been interrupted
-        if self.stopped is True:
-            return
+    """
+    Latency is considered to be growing due to congestion when the smoothed
+    latency exceeds the lowest observed latency by this factor.
+    """
+    LATENCY_TOLERANCE = 2.0
 
-        try:
-            self._response = self._doc_syncer.do_request()
-            self._request_lock.release()
+    """
+    Throughput is considered to be dropping when the throughput of a window
+    of requests is less than this fraction of the previous one.
+    """
+    THROUGHPUT_TOLERANCE = 0.9
 
-            # run success callback
-            if self._doc_syncer.success_callback is not None:
+    """
+    Factor by which the window shrinks when congestion is detected.
+    """
+    DECREASE_FACTOR = 0.75
+
+    def __init__(self, initial_window=None, min_window=None,
+                 max_window=None):
+        """
+        Initialize the window controller.
+
+        :param initial_window: The initial window size.
+        :type initial_window: int
+        :param min_window: The minimum window size.
+        :type min_window: int
+        :param max_window: The maximum window size.
+        :type max_window: int
+        """
+        self._min_window = min_window or self.MIN_WINDOW
+        self._max_window = max_window or self.MAX_WINDOW
+        self._window = float(initial_window or self.INITIAL_WINDOW)
+        self._window = max(self._min_window, min(self._max_window,
+                                                 self._window))
+        self._lock = threading.Lock()
+        # latency
+        self._min_latency = None
+        self._smoothed_latency = None
+        # throughput
+        self._epoch_start = None
+        self._epoch_requests = 0
+        self._epoch_bytes = 0
+        self._last_throughput = None
+        # number of requests to wait for before decreasing the window again
+        self._cooldown = 0
+        # counters
+        self._requests = 0
+        self._bytes = 0
+        self._unavailable = 0
 
-                # eventually wait for callback lock release
-                if self._last_callback_lock is not None:
-                    self._last_callback_lock.acquire()
+    @property
+    def window(self):
+        """
+        The current window size.
 
-                # bail out in case we've been interrupted
-                if self._stopped is True:
-                    return
+        :rtype: int
+        """
+        return int(self._window)
 
-                self._result = self._doc_syncer.success_callback(
-                    self._idx, self._total, self._response)
-                self._success = True
-                doc_syncer = self._doc_syncer
-                self._release_method(self, doc_syncer)
-                self._doc_syncer = None
-                # let next thread executed its callback
-                self._callback_lock.release()
-
-        # trap any exception and signal failure
-        except Exception as e:
-            self._exception = e
-            self._success = False
-            # run failure callback
-            if self._doc_syncer.failure_callback is not None:
-
-                # eventually wait for callback lock release
-                if self._last_callback_lock is not None:
-                    self._last_callback_lock.acquire()
-
-                # bail out in case we've been interrupted
-                if self.stopped is True:
-                    return
+    def _decrease(self, factor):
+        self._window = max(self._min_window, self._window * factor)
+        self._cooldown = self.window
+        # start a new throughput epoch with the new window
+        self._epoch_start = None
 
-                self._doc_syncer.failure_callback(
-                    self._idx, self._total, self._exception)
+    def on_success(self, latency, size=0):
+        """
+        Update the window after a successful request.
 
-                self._failed_method(self)
-                # we do not release the callback lock here because we
-                # failed and so we don't want other threads to succeed.
+        :param latency: The time (in seconds) the request took.
+        :type latency: float
+        :param size: The amount of bytes transferred by the request.
+        :type size: int
+        """
+        with self._lock:
+            now = time()
+            self._requests += 1
+            self._bytes += size
+            # update latency estimates
+            if self._min_latency is None or latency < self._min_latency:
+                self._min_latency = latency
+            if self._smoothed_latency is None:
+                self._smoothed_latency = latency
+            else:
+                self._smoothed_latency = \
+                    0.875 * self._smoothed_latency + 0.125 * latency
+            if self._cooldown > 0:
+                # wait for the effects of the last decrease
+                self._cooldown -= 1
+                return
+            if self._smoothed_latency > \
+                    self.LATENCY_TOLERANCE * self._min_latency:
+                if self._window <= self._min_window:
+                    # latency is high even with the minimum window, so the
+                    # link itself got slower.
+                    self._min_latency = self._smoothed_latency
+                else:
+                    # latency is growing, so we are probably queueing
+                    # requests somewhere on the way.
+                    self._decrease(self.DECREASE_FACTOR)
+                return
+            # update throughput estimate
+            if self._epoch_start is None:
+                self._epoch_start = now - latency
+                self._epoch_requests = 0
+                self._epoch_bytes = 0
+            self._epoch_requests += 1
+            self._epoch_bytes += size
+            if self._epoch_requests >= self.window:
+                elapsed = max(now - self._epoch_start, 1e-6)
+                throughput = self._epoch_bytes / elapsed
+                last_throughput = self._last_throughput
+                self._last_throughput = throughput
+                self._epoch_start = None
+                if last_throughput is not None and \
+                        throughput < self.THROUGHPUT_TOLERANCE \
+                        * last_throughput:
+                    self._decrease(self.DECREASE_FACTOR)
+                    return
+            # additive increase: one more request per window of successes
+            self._window = min(
+                self._max_window, self._window + 1.0 / self._window)
 
-    @property
-    def doc_syncer(self):
-        return self._doc_syncer
+    def on_unavailable(self):
+        """
+        Update the window after the server answered it is unavailable.
+        """
+        with self._lock:
+            self._unavailable += 1
+            self._decrease(0.5)
 
     @property
-    def response(self):
-        return self._response
+    def stats(self):
+        """
+        Statistics about the requests observed by this controller.
 
-    @property
-    def exception(self):
-        return self._exception
+        :return: A dictionary with the current window size, latency and
+                 throughput estimates and request counters.
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'window': self.window,
+                'min_latency': self._min_latency,
+                'smoothed_latency': self._smoothed_latency,
+                'throughput': self._last_throughput,
+                'requests': self._requests,
+                'bytes': self._bytes,
+                'unavailable': self._unavailable,
+            }
 
-    @property
-    def callback_lock(self):
-        return self._callback_lock
 
-    @property
-    def request_lock(self):
-        return self._request_lock
+class DocumentSyncerJob(object):
+    """
+    A request to be performed by a document syncer during the sync process,
+    either for sending or receiving documents.
+    """
 
-    @property
-    def success(self):
-        return self._success
+    def __init__(self, seq, idx, total, method, args, kwargs,
+                 success_callback=None, failure_callback=None):
+        """
+        Initialize a new syncer job.
 
-    def stop(self):
-        with self._stop_lock:
-            self._stopped = True
+        :param seq: The sequence number of the job in the pool.
+        :type seq: int
+        :param idx: The index count of the current operation.
+        :type idx: int
+        :param total: The total number of operations.
+        :type total: int
+        :param method: Either 'get' or 'put'.
+        :type method: str
+        :param args: Arguments for the request method.
+        :type args: tuple
+        :param kwargs: Keyworded arguments for the request method.
+        :type kwargs: dict
+        :param success_callback: A callable(idx, total, response) to be run
+                                 in order after the request succeeds.
+        :type success_callback: callable
+        :param failure_callback: A callable(idx, total, exception) to be run
+                                 if the request or the success callback
+                                 fail.
+        :type failure_callback: callable
+        """
+        self.seq = seq
+        self.idx = idx
+        self.total = total
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.success_callback = success_callback
+        self.failure_callback = failure_callback
+        self.response = None
+        self.exception = None
+        self.result = None
+        self.success = False
+        self.attempts = 0
+        self._done = threading.Event()
 
-    @property
-    def stopped(self):
-        with self._stop_lock:
-            return self._stopped
+    def finish(self):
+        """
+        Signal that the job has been processed, either successfully or not.
+        """
+        self._done.set()
 
-    @property
-    def result(self):
-        return self._result
+    def join(self):
+        """
+        Wait for the job to be processed.
+        """
+        self._done.wait()
 
 
 class DocumentSyncerPool(object):
     """
-    A pool of reusable document syncers.
+    A pipeline of reusable document syncers.
+
+    A fixed set of worker threads, each one with its own document syncer
+    (and so its own persistent connection), perform the submitted requests.
+    Responses are put in a reorder buffer so success callbacks are always run
+    in the order the jobs were submitted, and the number of jobs that are
+    either in-flight or waiting for their callbacks to run is bounded by the
+    window size, which is chosen by a SyncWindowController.
     """
 
-    POOL_SIZE = 10
+    MAX_ATTEMPTS = 5
     """
-    The maximum amount of syncer threads running at the same time.
+    The maximum amount of times a request is tried when the server answers
+    it is unavailable.
     """
 
     def __init__(self, raw_url, raw_creds, query_string, headers,
-                 ensure_callback, stop_method):
+                 ensure_callback, stop_method, window_controller=None,
+                 wire_format=JSON_FORMAT, request_encoding=None):
         """
         Initialize the document syncer pool.
 
@@ -258,7 +383,18 @@ class DocumentSyncerPool(object):
         :param ensure_callback: A callback to ensure we have the correct
                                 target_replica_uid, if it was just created.
         :type ensure_callback: callable
-
+        :param stop_method: A method to be called to stop the sync process
+                            when a job fails.
+        :type stop_method: callable
+        :param window_controller: The controller that chooses the maximum
+                                  amount of requests in flight at the same
+                                  time.
+        :type window_controller: SyncWindowController
+        :param wire_format: The wire format of syncing bodies.
+        :type wire_format: str
+        :param request_encoding: The content coding of syncing request
+                                 bodies, or None if they are not encoded.
+        :type request_encoding: str
         """
         # save syncer params
         self._raw_url = raw_url
@@ -267,134 +403,210 @@ class DocumentSyncerPool(object):
         self._headers = headers
         self._ensure_callback = ensure_callback
         self._stop_method = stop_method
+        self._wire_format = wire_format
+        self._request_encoding = request_encoding
+        # ids of sync sessions already known by the server
+        self._sync_sessions = set()
         # pool attributes
         self._failures = False
-        self._semaphore_pool = threading.BoundedSemaphore(
-            DocumentSyncerPool.POOL_SIZE)
-        self._pool_access_lock = threading.Lock()
+        if window_controller is None:
+            window_controller = SyncWindowController()
+        self._window_controller = window_controller
+        self._pending = 0
+        self._window_cond = threading.Condition()
+        self._jobs = Queue()
         self._doc_syncers = []
-        self._threads = []
+        self._workers = []
+        # reorder buffer
+        self._seq = 0
+        self._next_seq = 0
+        self._completed = {}
+        self._delivering = False
+        self._reorder_lock = threading.Lock()
 
-    def new_syncer_thread(self, idx, total, last_request_lock=None,
-                          last_callback_lock=None):
+    def submit(self, idx, total, method, args=(), kwargs=None,
+               success_callback=None, failure_callback=None):
         """
-        Yield a new document syncer thread.
+        Submit a new request to the pipeline.
+
+        This method blocks while the window of pending jobs is full.
 
         :param idx: The index count of the current operation.
         :type idx: int
         :param total: The total number of operations.
         :type total: int
-        :param last_request_lock: A lock to wait for before actually performing
-                                  the request.
-        :type last_request_lock: threading.Lock
-        :param last_callback_lock: A lock to wait for before actually running
-                                   the success callback.
-        :type last_callback_lock: threading.Lock
-        """
-        t = None
-        # wait for available threads
-        self._semaphore_pool.acquire()
-        with self._pool_access_lock:
+        :param method: Either 'get' or 'put'.
+        :type method: str
+        :param args: Arguments for the request method.
+        :type args: tuple
+        :param kwargs: Keyworded arguments for the request method.
+        :type kwargs: dict
+        :param success_callback: A callable(idx, total, response) to be run
+                                 in order after the request succeeds.
+        :type success_callback: callable
+        :param failure_callback: A callable(idx, total, exception) to be run
+                                 if the request or the success callback
+                                 fail.
+        :type failure_callback: callable
+
+        :return: The submitted job, or None if any previous job failed.
+        :rtype: DocumentSyncerJob
+        """
+        # wait for room in the window
+        with self._window_cond:
+            while self._failures is False and self._pending >= self.window:
+                self._window_cond.wait()
             if self._failures is True:
                 return None
-            # get a syncer
-            doc_syncer = self._get_syncer()
-            # we rely on DocumentSyncerThread.run() to release the lock using
-            # self.release_syncer so we can launch a new thread.
-            t = DocumentSyncerThread(
-                doc_syncer, self.release_syncer, self.cancel_threads,
-                idx, total,
-                last_request_lock=last_request_lock,
-                last_callback_lock=last_callback_lock)
-            self._threads.append(t)
-            return t
-
-    def _failed(self):
-        with self._pool_access_lock:
-            self._failures = True
-
-    @property
-    def failures(self):
-        return self._failures
-
-    def _get_syncer(self):
+            self._pending += 1
+            job = DocumentSyncerJob(
+                self._seq, idx, total, method, args, kwargs or {},
+                success_callback=success_callback,
+                failure_callback=failure_callback)
+            self._seq += 1
+            # start a new worker if all of them might be busy
+            if len(self._workers) < self._pending:
+                self._start_worker()
+        self._jobs.put(job)
+        return job
+
+    def _start_worker(self):
+        """
+        Start a new worker thread with its own document syncer.
+        """
+        syncer = HTTPDocumentSyncer(
+            self._raw_url, self._raw_creds, self._query_string,
+            self._headers, self._ensure_callback,
+            sync_sessions=self._sync_sessions, wire_format=self._wire_format,
+            request_encoding=self._request_encoding)
+        self._doc_syncers.append(syncer)
+        worker = threading.Thread(target=self._work, args=(syncer,))
+        worker.daemon = True
+        self._workers.append(worker)
+        worker.start()
+
+    def _work(self, syncer):
+        """
+        Perform the requests of jobs in the queue until a None job is found.
+
+        :param syncer: The document syncer used to perform requests.
+        :type syncer: HTTPDocumentSyncer
         """
-        Get a document syncer from the pool.
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            if self._failures is False:
+                job.attempts += 1
+                start = time()
+                try:
+                    syncer.set_request_method(
+                        job.method, *job.args, **job.kwargs)
+                    job.response = syncer.do_request()
+                    self._window_controller.on_success(
+                        time() - start, len(job.response[0]))
+                except errors.Unavailable as e:
+                    self._window_controller.on_unavailable()
+                    if job.attempts < self.MAX_ATTEMPTS:
+                        # back off and try again later
+                        sleep(0.5 * job.attempts)
+                        self._jobs.put(job)
+                        continue
+                    job.exception = e
+                except Exception as e:
+                    job.exception = e
+            self._deliver(job)
 
-        This method will create a new syncer whenever there is no syncer
-        available in the pool.
+    def _deliver(self, job):
+        """
+        Put a processed job in the reorder buffer and run the callbacks of
+        all jobs that are ready, in submission order.
 
-        :return: A syncer.
-        :rtype: HTTPDocumentSyncer
+        :param job: The processed job.
+        :type job: DocumentSyncerJob
         """
-        syncer = None
-        # get an available syncer or create a new one
-        try:
-            syncer = self._doc_syncers.pop()
-        except IndexError:
-            syncer = HTTPDocumentSyncer(
-                self._raw_url, self._raw_creds, self._query_string,
-                self._headers, self._ensure_callback)
-        return syncer
+        with self._reorder_lock:
+            self._completed[job.seq] = job
+            if self._delivering is True:
+                # another worker is already running callbacks and will take
+                # care of this job.
+                return
+            self._delivering = True
+        while True:
+            with self._reorder_lock:
+                job = self._completed.pop(self._next_seq, None)
+                if job is None:
+                    self._delivering = False
+                    return
+                self._next_seq += 1
+            self._finish(job)
 
-    def release_syncer(self, syncer_thread, doc_syncer):
+    def _finish(self, job):
         """
-        Return a syncer to the pool after use and check for any failures.
+        Run the callbacks of a job and release its room in the window.
 
-        :param syncer: The syncer to be returned to the pool.
-        :type syncer: HTTPDocumentSyncer
+        :param job: The processed job.
+        :type job: DocumentSyncerJob
         """
-        with self._pool_access_lock:
-            self._doc_syncers.append(doc_syncer)
-            if syncer_thread.success is True:
-                self._threads.remove(syncer_thread)
-            self._semaphore_pool.release()
+        try:
+            # jobs that come after a failure are just cancelled
+            if self._failures is False:
+                if job.exception is None and job.success_callback:
+                    try:
+                        job.result = job.success_callback(
+                            job.idx, job.total, job.response)
+                    except Exception as e:
+                        job.exception = e
+                if job.exception is None:
+                    job.success = True
+                else:
+                    if job.failure_callback is not None:
+                        job.failure_callback(
+                            job.idx, job.total, job.exception)
+                    self._failed()
+        finally:
+            with self._window_cond:
+                self._pending -= 1
+                self._window_cond.notify_all()
+            job.finish()
 
-    def cancel_threads(self, calling_thread):
+    def _failed(self):
         """
-        Stop all threads in the pool.
+        Stop the sync process and cancel all pending jobs.
         """
-        # stop sync
-        self._stop_method()
-        stopped = []
-        # stop all threads
-        logger.warning("Soledad sync: cancelling sync threads...")
-        with self._pool_access_lock:
+        logger.warning("Soledad sync: cancelling sync jobs...")
+        with self._window_cond:
             self._failures = True
-            while self._threads:
-                t = self._threads.pop(0)
-                t.stop()
-                self._doc_syncers.append(t.doc_syncer)
-                stopped.append(t)
-        # release locks and join
-        while stopped:
-            t = stopped.pop(0)
-            t.request_lock.acquire(False)   # just in case
-            t.request_lock.release()
-            t.callback_lock.acquire(False)  # just in case
-            t.callback_lock.release()
-        # release any blocking semaphores
-        for i in xrange(DocumentSyncerPool.POOL_SIZE):
-            try:
-                self._semaphore_pool.release()
-            except ValueError:
-                break
-        logger.warning("Soledad sync: cancelled sync threads.")
+            self._window_cond.notify_all()
+        self._stop_method()
+
+    @property
+    def failures(self):
+        return self._failures
+
+    @property
+    def window(self):
+        return self._window_controller.window
 
     def cleanup(self):
         """
-        Close and remove any syncers from the pool.
+        Stop all workers and close their document syncers.
         """
-        with self._pool_access_lock:
-            while self._doc_syncers:
-                syncer = self._doc_syncers.pop()
-                syncer.close()
-                del syncer
+        for _ in self._workers:
+            self._jobs.put(None)
+        while self._workers:
+            self._workers.pop().join()
+        while self._doc_syncers:
+            syncer = self._doc_syncers.pop()
+            syncer.close()
+            del syncer
 
 
 class HTTPDocumentSyncer(HTTPClientBase, TokenBasedAuth):
 
-    def __init__(self, raw_url, creds, query_string, headers, ensure_callback):
+    def __init__(self, raw_url, creds, query_string, headers, ensure_callback,
+                 sync_sessions=None, wire_format=JSON_FORMAT,
+                 request_encoding=None):
         """
         Initialize the client.
 
@@ -409,25 +621,34 @@ class HTTPDocumentSyncer(HTTPClientBase, TokenBasedAuth):
         :param ensure_callback: A callback to ensure we have the correct
                                 target_replica_uid, if it was just created.
         :type ensure_callback: callable
+        :param sync_sessions: A set of ids of sync sessions already known by
+                              the server, possibly shared among syncers.
+        :type sync_sessions: set
+        :param wire_format: The wire format of syncing bodies.
+        :type wire_format: str
+        :param request_encoding: The content coding of syncing request
+                                 bodies, or None if they are not encoded.
+        :type request_encoding: str
         """
         HTTPClientBase.__init__(self, raw_url, creds=creds)
         # info needed to perform the request
         self._query_string = query_string
         self._headers = headers
         self._ensure_callback = ensure_callback
+        if sync_sessions is None:
+            sync_sessions = set()
+        self._sync_sessions = sync_sessions
+        self._sync_id = None
+        self._wire_format = wire_format
+        self._request_encoding = request_encoding
         # the actual request method
         self._request_method = None
-        self._success_callback = None
-        self._failure_callback = None
 
     def _reset(self):
         """
         Reset this document syncer so we can reuse it.
         """
         self._request_method = None
-        self._success_callback = None
-        self._failure_callback = None
-        self._request_method = None
 
     def set_request_method(self, method, *args, **kwargs):
         """
@@ -442,30 +663,16 @@ class HTTPDocumentSyncer(HTTPClientBase, TokenBasedAuth):
         """
         self._reset()
         # resolve request method
-        if method is 'get':
-            self._request_method = self._get_doc
-        elif method is 'put':
-            self._request_method = self._put_doc
+        if method == 'get':
+            self._request_method = self._get_docs
+        elif method == 'put':
+            self._request_method = self._put_docs
         else:
             raise Exception
         # store request method args
         self._args = args
         self._kwargs = kwargs
 
-    def set_success_callback(self, callback):
-        self._success_callback = callback
-
-    def set_failure_callback(self, callback):
-        self._failure_callback = callback
-
-    @property
-    def success_callback(self):
-        return self._success_callback
-
-    @property
-    def failure_callback(self):
-        return self._failure_callback
-
     def do_request(self):
         """
         Actually perform the request.
@@ -476,7 +683,17 @@ class HTTPDocumentSyncer(HTTPClientBase, TokenBasedAuth):
         self._ensure_connection()
         args = self._args
         kwargs = self._kwargs
-        return self._request_method(*args, **kwargs)
+        try:
+            response = self._request_method(*args, **kwargs)
+        except SyncSessionExpiredError:
+            # the server does not know about this sync session anymore, so we
+            # send the full prologue again.
+            self._sync_sessions.discard(self._sync_id)
+            response = self._request_method(*args, **kwargs)
+        # further requests may continue this sync session
+        if self._sync_id is not None:
+            self._sync_sessions.add(self._sync_id)
+        return response
 
     def _request(self, method, url_parts, params=None, body=None,
                  content_type=None):
@@ -578,6 +795,10 @@ class HTTPDocumentSyncer(HTTPClientBase, TokenBasedAuth):
         """
         Prepare an entry to be sent through a syncing POST request.
 
+        In the binary format, the entry is encoded as a frame and the comma is
+        ignored. The ciphertext of entries that carry a document content is
+        sent as the raw payload of the frame.
+
         :param comma: A string to be prepended to the current entry.
         :type comma: str
         :param entries: A list of entries accumulated to be sent on the
@@ -589,11 +810,82 @@ class HTTPDocumentSyncer(HTTPClientBase, TokenBasedAuth):
         :return: The size of the prepared entry.
         :rtype: int
         """
-        entry = comma + '\r\n' + json.dumps(dic)
+        if self._wire_format == BINARY_FORMAT:
+            if 'content' in dic:
+                entry = encode_doc_frame(dic)
+            else:
+                entry = encode_frame(dic)
+        else:
+            entry = comma + '\r\n' + json.dumps(dic)
         entries.append(entry)
         return len(entry)
 
-    def _init_post_request(self, action, content_length):
+    def _start_stream(self, entries):
+        """
+        Prepare the start of the body of a syncing POST request.
+
+        :param entries: A list of entries accumulated to be sent on the
+                        request.
+        :type entries: list
+
+        :return: The size of the prepared entry.
+        :rtype: int
+        """
+        if self._wire_format == BINARY_FORMAT:
+            return 0
+        entries.append('[')
+        return 1
+
+    def _end_stream(self, entries):
+        """
+        Prepare the end of the body of a syncing POST request.
+
+        :param entries: A list of entries accumulated to be sent on the
+                        request.
+        :type entries: list
+
+        :return: The size of the prepared entry.
+        :rtype: int
+        """
+        if self._wire_format == BINARY_FORMAT:
+            return 0
+        entries.append('\r\n]')
+        return len(entries[-1])
+
+    def _prepare_prologue(self, entries, sync_id, last_known_generation,
+                          last_known_trans_id):
+        """
+        Prepare the first entry of a syncing POST request.
+
+        If the server already knows about the sync session, only its id is
+        sent. Otherwise, the full information about the remote replica is
+        sent so the server can validate it and start the session.
+
+        :param entries: A list of entries accumulated to be sent on the
+                        request.
+        :type entries: list
+        :param sync_id: The id for the current sync session.
+        :type sync_id: str
+        :param last_known_generation: Target's last known generation.
+        :type last_known_generation: int
+        :param last_known_trans_id: Target's last known transaction id.
+        :type last_known_trans_id: str
+
+        :return: The size of the prepared entry.
+        :rtype: int
+        """
+        self._sync_id = sync_id
+        if sync_id is not None and sync_id in self._sync_sessions:
+            return self._prepare('', entries, sync_id=sync_id)
+        return self._prepare(
+            '', entries,
+            last_known_generation=last_known_generation,
+            last_known_trans_id=last_known_trans_id,
+            sync_id=sync_id,
+            ensure=self._ensure_callback is not None)
+
+    def _init_post_request(self, action, content_length,
+                           content_encoding=None):
         """
         Initiate a syncing POST request.
 
@@ -605,20 +897,27 @@ class HTTPDocumentSyncer(HTTPClientBase, TokenBasedAuth):
         :type headers: dict
         :param content_length: The content-length of the request.
         :type content_length: int
+        :param content_encoding: The content coding of the request body, or
+                                 None if it is not encoded.
+        :type content_encoding: str
         """
         self._conn.putrequest('POST', self._query_string)
         self._conn.putheader(
-            'content-type', 'application/x-soledad-sync-%s' % action)
+            'content-type',
+            make_content_type(
+                'application/x-soledad-sync-%s' % action, self._wire_format))
         for header_name, header_value in self._headers:
             self._conn.putheader(header_name, header_value)
         self._conn.putheader('accept-encoding', 'gzip')
+        if content_encoding is not None:
+            self._conn.putheader('content-encoding', content_encoding)
         self._conn.putheader('content-length', str(content_length))
         self._conn.endheaders()
 
-    def _get_doc(self, received, sync_id, last_known_generation,
-                 last_known_trans_id):
+    def _get_docs(self, received, sync_id, last_known_generation,
+                  last_known_trans_id, limit=1):
         """
-        Get a sync document from server by means of a POST request.
+        Get a batch of sync documents from server by means of a POST request.
 
         :param received: The number of documents already received in the
                          current sync session.
@@ -629,35 +928,33 @@ class HTTPDocumentSyncer(HTTPClientBase, TokenBasedAuth):
         :type last_known_generation: int
         :param last_known_trans_id: Target's last known transaction id.
         :type last_known_trans_id: str
+        :param limit: The maximum number of documents to get.
+        :type limit: int
 
         :return: The body and headers of the response.
         :rtype: tuple
         """
-        entries = ['[']
-        size = 1
+        entries = []
+        size = self._start_stream(entries)
         # add remote replica metadata to the request
+        size += self._prepare_prologue(
+            entries, sync_id, last_known_generation, last_known_trans_id)
+        # inform server of how many documents have already been received and
+        # how many we want in this request
         size += self._prepare(
-            '', entries,
-            last_known_generation=last_known_generation,
-            last_known_trans_id=last_known_trans_id,
-            sync_id=sync_id,
-            ensure=self._ensure_callback is not None)
-        # inform server of how many documents have already been received
-        size += self._prepare(
-            ',', entries, received=received)
-        entries.append('\r\n]')
-        size += len(entries[-1])
+            ',', entries, received=received, limit=limit)
+        size += self._end_stream(entries)
         # send headers
         self._init_post_request('get', size)
-        # get document
+        # get documents
         for entry in entries:
             self._conn.send(entry)
         return self._response()
 
-    def _put_doc(self, sync_id, last_known_generation, last_known_trans_id,
-                 id, rev, content, gen, trans_id, number_of_docs, doc_idx):
+    def _put_docs(self, sync_id, last_known_generation, last_known_trans_id,
+                  docs):
         """
-        Put a sync document on server by means of a POST request.
+        Put a batch of sync documents on server by means of one POST request.
 
         :param sync_id: The id for the current sync session.
         :type sync_id: str
@@ -665,46 +962,35 @@ class HTTPDocumentSyncer(HTTPClientBase, TokenBasedAuth):
         :type last_known_generation: int
         :param last_known_trans_id: Target's last known transaction id.
         :type last_known_trans_id: str
-        :param id: The document id.
-        :type id: str
-        :param rev: The document revision.
-        :type rev: str
-        :param content: The serialized document content.
-        :type content: str
-        :param gen: The generation of the modification of the document.
-        :type gen: int
-        :param trans_id: The transaction id of the modification of the
-                         document.
-        :type trans_id: str
-        :param number_of_docs: The total amount of documents sent on this sync
-                               session.
-        :type number_of_docs: int
-        :param doc_idx: The index of the current document being sent.
-        :type doc_idx: int
+        :param docs: A list of dictionaries, each one containing the id, rev,
+                     content, gen, trans_id, number_of_docs and doc_idx of a
+                     document to be sent.
+        :type docs: list of dict
 
         :return: The body and headers of the response.
         :rtype: tuple
         """
-        # prepare to send the document
-        entries = ['[']
-        size = 1
+        # prepare to send the documents
+        entries = []
+        size = self._start_stream(entries)
         # add remote replica metadata to the request
-        size += self._prepare(
-            '', entries,
-            last_known_generation=last_known_generation,
-            last_known_trans_id=last_known_trans_id,
-            sync_id=sync_id,
-            ensure=self._ensure_callback is not None)
-        # add the document to the request
-        size += self._prepare(
-            ',', entries,
-            id=id, rev=rev, content=content, gen=gen, trans_id=trans_id,
-            number_of_docs=number_of_docs, doc_idx=doc_idx)
-        entries.append('\r\n]')
-        size += len(entries[-1])
+        size += self._prepare_prologue(
+            entries, sync_id, last_known_generation, last_known_trans_id)
+        # add the documents to the request
+        for doc_entry in docs:
+            size += self._prepare(',', entries, **doc_entry)
+        size += self._end_stream(entries)
+        # compress the JSON stream, as the raw ciphertext in binary frames
+        # would not get any smaller
+        content_encoding = None
+        if self._request_encoding is not None \
+                and self._wire_format == JSON_FORMAT:
+            content_encoding = self._request_encoding
+            entries = _compress(entries, content_encoding)
+            size = sum(map(len, entries))
         # send headers
-        self._init_post_request('put', size)
-        # send document
+        self._init_post_request('put', size, content_encoding)
+        # send documents
         for entry in entries:
             self._conn.send(entry)
         return self._response()
@@ -757,6 +1043,37 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
     """
     DECRYPT_TASK_PERIOD = 0.5
 
+    """
+    Maximum number of documents sent to the server in one POST request.
+    """
+    MAX_PUT_BATCH_DOCS = 100
+
+    """
+    Approximate maximum size (in bytes) of the documents sent to the server in
+    one POST request. A document bigger than this is sent alone.
+    """
+    MAX_PUT_BATCH_SIZE = 1024 * 1024
+
+    """
+    Maximum number of documents requested from the server in one POST request.
+    """
+    MAX_GET_BATCH_DOCS = 100
+
+    """
+    Table of the sync db where checkpoints of interrupted syncs are stored, so
+    they can be resumed. There is at most one checkpoint for each pair of
+    target url and source replica uid.
+    """
+    CHECKPOINT_TABLE_NAME = "sync_checkpoints"
+    CHECKPOINT_FIELD_NAMES = (
+        "target_url, source_replica_uid, sync_id, last_known_generation, "
+        "last_known_trans_id, phase, sent, sent_generation, received, "
+        "new_generation, new_transaction_id, number_of_changes, "
+        "PRIMARY KEY (target_url, source_replica_uid)")
+
+    CHECKPOINT_SEND = 'send'
+    CHECKPOINT_RECEIVE = 'receive'
+
     #
     # Modified HTTPSyncTarget methods.
     #
@@ -796,6 +1113,12 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
         self._sync_exchange_lock = threading.Lock()
         self.source_replica_uid = source_replica_uid
         self._defer_decryption = False
+        # the window of concurrent requests is kept among syncs
+        self._window_controller = SyncWindowController()
+        # the wire format and the content coding of request bodies are
+        # negotiated when getting the sync info
+        self._wire_format = JSON_FORMAT
+        self._request_encoding = None
 
         # deferred decryption attributes
         self._sync_db = None
@@ -863,64 +1186,102 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
 
     def _parse_received_doc_response(self, response):
         """
-        Parse the response from the server containing the received document.
+        Parse the response from the server containing the received documents.
 
         :param response: The body and headers of the response.
         :type response: tuple(str, dict)
+
+        :return: The new generation and transaction id of the target replica,
+                 the total number of changes to be received in the current
+                 sync session, and a list of (doc_id, rev, content, gen,
+                 trans_id) tuples for the documents in this response.
+        :rtype: tuple
         """
-        data, _ = response
+        data, headers = response
+        _, wire_format = parse_content_type(headers.get('content-type'))
+        if wire_format == BINARY_FORMAT:
+            return self._parse_received_doc_frames(data)
         # decode incoming stream
         parts = data.splitlines()
         if not parts or parts[0] != '[' or parts[-1] != ']':
             raise errors.BrokenSyncStream
         data = parts[1:-1]
         # decode metadata
-        line, comma = utils.check_and_strip_comma(data[0])
-        metadata = None
         try:
+            line, comma = utils.check_and_strip_comma(data[0])
             metadata = json.loads(line)
             new_generation = metadata['new_generation']
             new_transaction_id = metadata['new_transaction_id']
             number_of_changes = metadata['number_of_changes']
-        except (json.JSONDecodeError, KeyError):
+        except (IndexError, json.JSONDecodeError, KeyError):
             raise errors.BrokenSyncStream
         # make sure we have replica_uid from fresh new dbs
         if self._ensure_callback and 'replica_uid' in metadata:
             self._ensure_callback(metadata['replica_uid'])
         # parse incoming document info
-        doc_id = None
-        rev = None
-        content = None
-        gen = None
-        trans_id = None
-        if number_of_changes > 0:
+        entries = []
+        for line in data[1:]:
+            if not comma:  # no preceding comma
+                raise errors.BrokenSyncStream
+            line, comma = utils.check_and_strip_comma(line)
             try:
-                entry = json.loads(data[1])
-                doc_id = entry['id']
-                rev = entry['rev']
-                content = entry['content']
-                gen = entry['gen']
-                trans_id = entry['trans_id']
-            except (IndexError, KeyError):
+                entry = json.loads(line)
+                entries.append((
+                    entry['id'], entry['rev'], entry['content'],
+                    entry['gen'], entry['trans_id']))
+            except (json.JSONDecodeError, KeyError):
                 raise errors.BrokenSyncStream
+        if comma:  # extra comma
+            raise errors.BrokenSyncStream
+        return new_generation, new_transaction_id, number_of_changes, \
+            entries
+
+    def _parse_received_doc_frames(self, data):
+        """
+        Parse the binary response from the server containing the received
+        documents.
+
+        :param data: The body of the response.
+        :type data: str
+
+        :return: The same as _parse_received_doc_response().
+        :rtype: tuple
+        """
+        try:
+            frames = decode_frames(data)
+            metadata, _ = frames.next()
+            new_generation = metadata['new_generation']
+            new_transaction_id = metadata['new_transaction_id']
+            number_of_changes = metadata['number_of_changes']
+            # make sure we have replica_uid from fresh new dbs
+            if self._ensure_callback and 'replica_uid' in metadata:
+                self._ensure_callback(metadata['replica_uid'])
+            # parse incoming document info
+            entries = []
+            for metadata, payload in frames:
+                entry = decode_doc_frame(metadata, payload)
+                entries.append((
+                    entry['id'], entry['rev'], entry['content'],
+                    entry['gen'], entry['trans_id']))
+        except (StopIteration, BrokenFrameError, ValueError, KeyError):
+            raise errors.BrokenSyncStream
         return new_generation, new_transaction_id, number_of_changes, \
-            doc_id, rev, content, gen, trans_id
+            entries
 
     def _insert_received_doc(self, idx, total, response):
         """
-        Insert a received document into the local replica.
+        Insert the received documents into the local replica.
 
-        :param idx: The index count of the current operation.
+        :param idx: The index count of the first document in the response.
         :type idx: int
         :param total: The total number of operations.
         :type total: int
         :param response: The body and headers of the response.
         :type response: tuple(str, dict)
         """
-        new_generation, new_transaction_id, number_of_changes, doc_id, \
-            rev, content, gen, trans_id = \
+        new_generation, new_transaction_id, number_of_changes, entries = \
             self._parse_received_doc_response(response)
-        if doc_id is not None:
+        for doc_id, rev, content, gen, trans_id in entries:
             # decrypt incoming document and insert into local database
             # -------------------------------------------------------------
             # symmetric decryption of document's contents
@@ -933,7 +1294,7 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
             if is_symmetrically_encrypted(doc):
                 if self._queue_for_decrypt:
                     self._save_encrypted_received_doc(
-                        doc, gen, trans_id, idx, total)
+                        doc, gen, trans_id, idx, number_of_changes)
                 else:
                     # defer_decryption is False or no-sync-db fallback
                     doc.set_json(decrypt_doc(self._crypto, doc))
@@ -942,20 +1303,22 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
                 # not symmetrically encrypted doc, insert it directly
                 # or save it in the decrypted stage.
                 if self._queue_for_decrypt:
-                    self._save_received_doc(doc, gen, trans_id, idx, total)
+                    self._save_received_doc(
+                        doc, gen, trans_id, idx, number_of_changes)
                 else:
                     self._return_doc_cb(doc, gen, trans_id)
             # -------------------------------------------------------------
             # end of symmetric decryption
             # -------------------------------------------------------------
-        msg = "%d/%d" % (idx + 1, total)
-        signal(SOLEDAD_SYNC_RECEIVE_STATUS, msg)
-        logger.debug("Soledad sync receive status: %s" % msg)
+            idx += 1
+            msg = "%d/%d" % (idx, number_of_changes)
+            signal(SOLEDAD_SYNC_RECEIVE_STATUS, msg)
+            logger.debug("Soledad sync receive status: %s" % msg)
         return number_of_changes, new_generation, new_transaction_id
 
     def _get_remote_docs(self, url, last_known_generation, last_known_trans_id,
                          headers, return_doc_cb, ensure_callback, sync_id,
-                         syncer_pool, defer_decryption=False):
+                         syncer_pool, defer_decryption=False, received=0):
         """
         Fetch sync documents from the remote database and insert them in the
         local database.
@@ -983,6 +1346,9 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
                                  the intermediate database. If False,
                                  decryption will be done inline.
         :type defer_decryption: bool
+        :param received: How many documents have already been received in a
+                         previous attempt of the current sync session.
+        :type received: int
 
         :raise BrokenSyncStream: If `data` is malformed.
 
@@ -1005,9 +1371,37 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
         idx = 0
         number_of_changes = 1
 
+        # resume an interrupted download if the server still has the same
+        # changes to return for this sync session
+        if received > 0:
+            idx = self._resume_remote_docs(
+                syncer_pool, sync_id, received, last_known_generation,
+                last_known_trans_id)
+            number_of_changes = idx + 1
+            # documents received on the previous attempt are stale
+            if idx == 0 and defer_decryption is True:
+                self._sync_decr_pool.empty()
+
         first_request = True
-        last_callback_lock = None
-        threads = []
+        jobs = []
+
+        def _success_callback(idx, total, response):
+            result = self._insert_received_doc(idx, total, response)
+            number_of_changes, new_generation, new_transaction_id = result
+            self._update_checkpoint(
+                received=min(idx + self.MAX_GET_BATCH_DOCS, number_of_changes),
+                new_generation=new_generation,
+                new_transaction_id=new_transaction_id,
+                number_of_changes=number_of_changes)
+            return result
+
+        def _failure_callback(idx, total, exception):
+            _failure_msg = "Soledad sync: error while getting documents " \
+                "starting at %d/%d: %s" \
+                % (idx + 1, total, exception)
+            logger.warning("%s" % _failure_msg)
+            logger.warning("Soledad sync: failing gracefully, will "
+                           "recover on next sync.")
 
         # get incoming documents
         while idx < number_of_changes:
@@ -1015,71 +1409,214 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
             if self.stopped is True:
                 break
 
-            # launch a thread to fetch one document from target
-            t = syncer_pool.new_syncer_thread(
-                idx, number_of_changes,
-                last_callback_lock=last_callback_lock)
-
-            # bail out if any thread failed
-            if t is None:
+            # submit a request to fetch a batch of documents from target
+            job = syncer_pool.submit(
+                idx, number_of_changes, 'get',
+                args=(idx, sync_id, last_known_generation,
+                      last_known_trans_id),
+                kwargs={'limit': self.MAX_GET_BATCH_DOCS},
+                success_callback=_success_callback,
+                failure_callback=_failure_callback)
+
+            # bail out if any request failed
+            if job is None:
                 self.stop()
                 break
 
-            t.doc_syncer.set_request_method(
-                'get', idx, sync_id, last_known_generation,
-                last_known_trans_id)
-            t.doc_syncer.set_success_callback(self._insert_received_doc)
-
-            def _failure_callback(idx, total, exception):
-                _failure_msg = "Soledad sync: error while getting document " \
-                    "%d/%d: %s" \
-                    % (idx + 1, total, exception)
-                logger.warning("%s" % _failure_msg)
-                logger.warning("Soledad sync: failing gracefully, will "
-                               "recover on next sync.")
-
-            t.doc_syncer.set_failure_callback(_failure_callback)
-            threads.append(t)
-            t.start()
-            last_callback_lock = t.callback_lock
-            idx += 1
+            jobs.append(job)
+            idx += self.MAX_GET_BATCH_DOCS
 
             # if this is the first request, wait to update the number of
             # changes
             if first_request is True:
-                t.join()
-                if t.success:
-                    number_of_changes, _, _ = t.result
+                job.join()
+                if job.success:
+                    number_of_changes, _, _ = job.result
                 first_request = False
 
-        # make sure all threads finished and we have up-to-date info
-        last_successful_thread = None
-        while threads:
+        # make sure all requests finished and we have up-to-date info
+        last_successful_job = None
+        while jobs:
             # check if there are failures
-            t = threads.pop(0)
-            t.join()
-            if t.success:
-                last_successful_thread = t
-
-        # get information about last successful thread
-        if last_successful_thread is not None:
-            body, _ = last_successful_thread.response
-            parsed_body = json.loads(body)
-            # get current target gen and trans id in case no documents were
-            # transferred
-            if len(parsed_body) == 1:
-                metadata = parsed_body[0]
-                new_generation = metadata['new_generation']
-                new_transaction_id = metadata['new_transaction_id']
+            job = jobs.pop(0)
+            job.join()
+            if job.success:
+                last_successful_job = job
+
+        # get information about last successful request
+        if last_successful_job is not None:
+            new_generation, new_transaction_id, _, entries = \
+                self._parse_received_doc_response(
+                    last_successful_job.response)
             # get current target gen and trans id from last transferred
-            # document
-            else:
-                doc_data = parsed_body[1]
-                new_generation = doc_data['gen']
-                new_transaction_id = doc_data['trans_id']
+            # document, if any
+            if entries:
+                _, _, _, new_generation, new_transaction_id = entries[-1]
 
         return new_generation, new_transaction_id
 
+    def _resume_remote_docs(self, syncer_pool, sync_id, received,
+                            last_known_generation, last_known_trans_id):
+        """
+        Check if the download of documents of an interrupted sync session can
+        be resumed.
+
+        The server is asked only for information about the sync session, which
+        has to be the same as the one stored in the checkpoint. Otherwise, the
+        server has calculated the changes to return again, and we cannot trust
+        the number of documents already received.
+
+        :param syncer_pool: The pool used to perform requests.
+        :type syncer_pool: DocumentSyncerPool
+        :param sync_id: The id for the current sync session.
+        :type sync_id: str
+        :param received: How many documents have already been received in a
+                         previous attempt of the current sync session.
+        :type received: int
+        :param last_known_generation: Target's last known generation.
+        :type last_known_generation: int
+        :param last_known_trans_id: Target's last known transaction id.
+        :type last_known_trans_id: str
+
+        :return: The index of the next document to be received.
+        :rtype: int
+        """
+        checkpoint = self._get_checkpoint()
+        job = syncer_pool.submit(
+            received, received, 'get',
+            args=(received, sync_id, last_known_generation,
+                  last_known_trans_id),
+            kwargs={'limit': 0})
+        if job is None:
+            return 0
+        job.join()
+        if not job.success or checkpoint is None:
+            return 0
+        new_generation, new_transaction_id, number_of_changes, _ = \
+            self._parse_received_doc_response(job.response)
+        if (new_generation, new_transaction_id, number_of_changes) != \
+                (checkpoint['new_generation'],
+                 checkpoint['new_transaction_id'],
+                 checkpoint['number_of_changes']):
+            logger.debug("Soledad sync: cannot resume receiving documents.")
+            return 0
+        logger.debug(
+            "Soledad sync: resuming receiving documents at %d/%d."
+            % (received, number_of_changes))
+        return received
+
+    def _get_checkpoint(self):
+        """
+        Return the checkpoint of an interrupted sync of the current source
+        replica with this target, if any.
+
+        :return: A dictionary with the checkpoint fields, or None.
+        :rtype: dict
+        """
+        if self._sync_db is None:
+            return None
+        sql = ("SELECT sync_id, last_known_generation, last_known_trans_id, "
+               "phase, sent, sent_generation, received, new_generation, "
+               "new_transaction_id, number_of_changes FROM %s "
+               "WHERE target_url=? AND source_replica_uid=?"
+               % (self.CHECKPOINT_TABLE_NAME,))
+        res = self._sync_db.select(
+            sql, (self._raw_url, self.source_replica_uid))
+        try:
+            row = res.next()
+        except StopIteration:
+            return None
+        return dict(izip(
+            ('sync_id', 'last_known_generation', 'last_known_trans_id',
+             'phase', 'sent', 'sent_generation', 'received',
+             'new_generation', 'new_transaction_id', 'number_of_changes'),
+            row))
+
+    def _put_checkpoint(self, sync_id, last_known_generation,
+                        last_known_trans_id):
+        """
+        Store a new checkpoint for a sync of the current source replica with
+        this target, replacing any previous one.
+
+        :param sync_id: The id for the current sync session.
+        :type sync_id: str
+        :param last_known_generation: Target's last known generation.
+        :type last_known_generation: int
+        :param last_known_trans_id: Target's last known transaction id.
+        :type last_known_trans_id: str
+        """
+        if self._sync_db is None:
+            return
+        sql = ("INSERT OR REPLACE INTO %s VALUES "
+               "(?, ?, ?, ?, ?, ?, 0, 0, 0, NULL, NULL, NULL)"
+               % (self.CHECKPOINT_TABLE_NAME,))
+        with self._sync_db_write_lock:
+            self._sync_db.execute(
+                sql, (self._raw_url, self.source_replica_uid, sync_id,
+                      last_known_generation, last_known_trans_id,
+                      self.CHECKPOINT_SEND))
+
+    def _update_checkpoint(self, **fields):
+        """
+        Update fields of the checkpoint of the current sync.
+
+        This is also called from the threads of the document syncer pool, so
+        writes to the sync db are serialized by its write lock.
+
+        :param fields: The names and values of the fields to update.
+        :type fields: dict
+        """
+        if self._sync_db is None:
+            return
+        names = sorted(fields)
+        sql = ("UPDATE %s SET %s WHERE target_url=? AND source_replica_uid=?"
+               % (self.CHECKPOINT_TABLE_NAME,
+                  ', '.join('%s=?' % name for name in names)))
+        with self._sync_db_write_lock:
+            self._sync_db.execute(
+                sql, tuple(fields[name] for name in names)
+                + (self._raw_url, self.source_replica_uid))
+
+    def _delete_checkpoint(self):
+        """
+        Delete the checkpoint of the current sync.
+        """
+        if self._sync_db is None:
+            return
+        sql = ("DELETE FROM %s WHERE target_url=? AND source_replica_uid=?"
+               % (self.CHECKPOINT_TABLE_NAME,))
+        with self._sync_db_write_lock:
+            self._sync_db.execute(
+                sql, (self._raw_url, self.source_replica_uid))
+
+    def get_sync_info(self, source_replica_uid):
+        """
+        Return information about known state of the target replica.
+
+        This also chooses the wire format of syncing bodies and the content
+        coding of uploads among the ones announced by the server. Servers
+        that do not announce any are sent uncompressed bodies in the JSON
+        format.
+
+        :param source_replica_uid: The uid of the source replica.
+        :type source_replica_uid: str
+
+        :return: The target replica uid, generation and transaction id, and
+                 the source replica generation and transaction id known by
+                 the target.
+        :rtype: tuple
+        """
+        self._ensure_connection()
+        res, headers = self._request_json(
+            'GET', ['sync-from', source_replica_uid])
+        self._wire_format = choose_format(headers.get(FORMATS_HEADER))
+        self._request_encoding = choose_request_encoding(
+            headers.get(REQUEST_ENCODINGS_HEADER))
+        return (res['target_replica_uid'], res['target_replica_generation'],
+                res['target_replica_transaction_id'],
+                res['source_replica_generation'],
+                res['source_transaction_id'])
+
     def sync_exchange(self, docs_by_generations,
                       source_replica_uid, last_known_generation,
                       last_known_trans_id, return_doc_cb,
@@ -1139,15 +1676,42 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
 
         self.start()
 
-        if sync_id is None:
-            sync_id = str(uuid4())
         self.source_replica_uid = source_replica_uid
         # let the decrypter pool access the passed callback to insert docs
         setProxiedObject(self._insert_doc_cb[source_replica_uid],
                          return_doc_cb)
 
+        # resume an interrupted sync whose documents have all been sent, or
+        # start a new one.
+        received = 0
+        checkpoint = None
+        if sync_id is None:
+            checkpoint = self._get_checkpoint()
+        if checkpoint is not None \
+                and checkpoint['phase'] == self.CHECKPOINT_RECEIVE:
+            sync_id = checkpoint['sync_id']
+            last_known_generation = checkpoint['last_known_generation']
+            last_known_trans_id = checkpoint['last_known_trans_id']
+            received = checkpoint['received']
+            # do not send again documents that were already acknowledged
+            docs_by_generations = [
+                (doc, gen, trans_id)
+                for doc, gen, trans_id in docs_by_generations
+                if gen > checkpoint['sent_generation']]
+            logger.debug("Soledad sync: resuming sync %s." % sync_id)
+            if docs_by_generations:
+                # an interrupted sending of new documents with the same
+                # sync_id cannot be resumed.
+                self._update_checkpoint(phase=self.CHECKPOINT_SEND)
+        else:
+            if sync_id is None:
+                sync_id = str(uuid4())
+            self._put_checkpoint(
+                sync_id, last_known_generation, last_known_trans_id)
+
         # empty the database before starting a new sync
-        if defer_decryption is True and not self.clear_to_sync():
+        if defer_decryption is True and received == 0 \
+                and not self.clear_to_sync():
             self._sync_decr_pool.empty()
 
         self._ensure_connection()
@@ -1167,15 +1731,61 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
         defer_encryption = self._sync_db is not None
         syncer_pool = DocumentSyncerPool(
             self._raw_url, self._raw_creds, url, headers, ensure_callback,
-            self.stop)
-        threads = []
-        last_callback_lock = None
+            self.stop, window_controller=self._window_controller,
+            wire_format=self._wire_format,
+            request_encoding=self._request_encoding)
+        jobs = []
         sent = 0
         total = len(docs_by_generations)
 
         synced = []
         number_of_docs = len(docs_by_generations)
 
+        # documents are accumulated in batches and each batch is sent in one
+        # POST request
+        batch = []
+        batch_size = 0
+        # source generation of each document sent, by index
+        sent_generations = {}
+
+        def _success_callback(idx, total, response):
+            _success_msg = "Soledad sync send status: %d/%d" \
+                           % (idx, total)
+            signal(SOLEDAD_SYNC_SEND_STATUS, _success_msg)
+            logger.debug(_success_msg)
+            # callbacks run in order, so all documents up to this one have
+            # been acknowledged by the server.
+            self._update_checkpoint(
+                sent=idx, sent_generation=sent_generations[idx])
+
+        def _failure_callback(idx, total, exception):
+            _failure_msg = "Soledad sync: error while sending document " \
+                           "%d/%d: %s" % (idx, total, exception)
+            logger.warning("%s" % _failure_msg)
+            logger.warning("Soledad sync: failing gracefully, will "
+                           "recover on next sync.")
+
+        def _send_batch(batch):
+            """
+            Submit a request that sends a batch of documents to the server.
+
+            :param batch: A list of (doc, doc_entry) tuples.
+            :type batch: list
+
+            :return: The job that will send the batch or None if any of
+                     the previous jobs failed.
+            :rtype: DocumentSyncerJob
+            """
+            job = syncer_pool.submit(
+                batch[-1][1]['doc_idx'], total, 'put',
+                args=(sync_id, cur_target_gen, cur_target_trans_id,
+                      [doc_entry for _, doc_entry in batch]),
+                success_callback=_success_callback,
+                failure_callback=_failure_callback)
+            if job is not None:
+                jobs.append((job, [doc for doc, _ in batch]))
+            return job
+
         for doc, gen, trans_id in docs_by_generations:
             # allow for interrupting the sync process
             if self.stopped is True:
@@ -1211,56 +1821,41 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
             # -------------------------------------------------------------
             # end of symmetric encryption
             # -------------------------------------------------------------
-            t = syncer_pool.new_syncer_thread(
-                sent + 1, total, last_request_lock=None,
-                last_callback_lock=last_callback_lock)
-
-            # bail out if any thread failed
-            if t is None:
-                self.stop()
-                break
+            doc_size = len(doc_json or '')
+            # send the current batch if this doc does not fit in it
+            if batch and (
+                    len(batch) >= self.MAX_PUT_BATCH_DOCS or
+                    batch_size + doc_size > self.MAX_PUT_BATCH_SIZE):
+                job = _send_batch(batch)
+                batch = []
+                batch_size = 0
+                # bail out if any request failed
+                if job is None:
+                    self.stop()
+                    break
 
-            # set the request method
-            t.doc_syncer.set_request_method(
-                'put', sync_id, cur_target_gen, cur_target_trans_id,
-                id=doc.doc_id, rev=doc.rev, content=doc_json, gen=gen,
-                trans_id=trans_id, number_of_docs=number_of_docs,
-                doc_idx=sent + 1)
-            # set the success calback
-
-            def _success_callback(idx, total, response):
-                _success_msg = "Soledad sync send status: %d/%d" \
-                               % (idx, total)
-                signal(SOLEDAD_SYNC_SEND_STATUS, _success_msg)
-                logger.debug(_success_msg)
-
-            t.doc_syncer.set_success_callback(_success_callback)
-
-            # set the failure callback
-            def _failure_callback(idx, total, exception):
-                _failure_msg = "Soledad sync: error while sending document " \
-                               "%d/%d: %s" % (idx, total, exception)
-                logger.warning("%s" % _failure_msg)
-                logger.warning("Soledad sync: failing gracefully, will "
-                               "recover on next sync.")
-
-            t.doc_syncer.set_failure_callback(_failure_callback)
-
-            # save thread and append
-            t.start()
-            threads.append((t, doc))
-            last_callback_lock = t.callback_lock
             sent += 1
+            sent_generations[sent] = gen
+            batch.append((doc, {
+                'id': doc.doc_id, 'rev': doc.rev, 'content': doc_json,
+                'gen': gen, 'trans_id': trans_id,
+                'number_of_docs': number_of_docs, 'doc_idx': sent}))
+            batch_size += doc_size
+
+        # send the remaining documents
+        if batch and self.stopped is False:
+            if _send_batch(batch) is None:
+                self.stop()
 
-        # make sure all threads finished and we have up-to-date info
-        last_successful_thread = None
-        while threads:
+        # make sure all requests finished and we have up-to-date info
+        last_successful_job = None
+        while jobs:
             # check if there are failures
-            t, doc = threads.pop(0)
-            t.join()
-            if t.success:
-                synced.append((doc.doc_id, doc.rev))
-                last_successful_thread = t
+            job, docs = jobs.pop(0)
+            job.join()
+            if job.success:
+                synced.extend([(doc.doc_id, doc.rev) for doc in docs])
+                last_successful_job = job
 
         # delete documents from the sync database
         if defer_encryption:
@@ -1269,18 +1864,19 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
         # get target gen and trans_id after docs
         gen_after_send = None
         trans_id_after_send = None
-        if last_successful_thread is not None:
-            response_dict = json.loads(last_successful_thread.response[0])[0]
+        if last_successful_job is not None:
+            response_dict = json.loads(last_successful_job.response[0])[0]
             gen_after_send = response_dict['new_generation']
             trans_id_after_send = response_dict['new_transaction_id']
 
         # get docs from target
         if self.stopped is False:
+            self._update_checkpoint(phase=self.CHECKPOINT_RECEIVE)
             cur_target_gen, cur_target_trans_id = self._get_remote_docs(
                 url,
                 last_known_generation, last_known_trans_id, headers,
                 return_doc_cb, ensure_callback, sync_id, syncer_pool,
-                defer_decryption=defer_decryption)
+                defer_decryption=defer_decryption, received=received)
 
         syncer_pool.cleanup()
 
@@ -1299,6 +1895,10 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
             cur_target_gen = gen_after_send
             cur_target_trans_id = trans_id_after_send
 
+        # the sync was not interrupted, so there is nothing to resume
+        if self.stopped is False:
+            self._delete_checkpoint()
+
         self.stop()
         return cur_target_gen, cur_target_trans_id
 
@@ -1331,6 +1931,17 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
         with self._stop_lock:
             return self._stopped is True
 
+    @property
+    def sync_stats(self):
+        """
+        Return statistics about the requests performed while syncing.
+
+        :return: A dictionary with the current window of concurrent requests,
+                 latency and throughput estimates and request counters.
+        :rtype: dict
+        """
+        return self._window_controller.stats
+
     def get_encrypted_doc_from_db(self, doc_id, doc_rev):
         """
         Retrieve encrypted document from the database of encrypted docs for
@@ -24,13 +24,14 @@ import uuid
 import logging
 import binascii
 import socket
-import time
 import sys
 import threading
+import time
 
 
 from StringIO import StringIO
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from itertools import izip
 from urlparse import urljoin
 from contextlib import contextmanager
 
@@ -61,13 +62,45 @@ from u1db.remote.server_state import ServerState
 
 
 from leap.soledad.common import USER_DB_PREFIX, ddocs, errors
+from leap.soledad.common.crypto import (
+    split_encrypted_content,
+    join_encrypted_content,
+)
 from leap.soledad.common.document import SoledadDocument
+from leap.soledad.common.metrics import METRICS, COUNT_BUCKETS
 
 
 logger = logging.getLogger(__name__)
 
 
 COUCH_TIMEOUT = 120  # timeout for transfers between Soledad server and Couch
+MAX_OPEN_DATABASES = 1000  # max number of database handles kept open
+OPEN_DATABASE_TTL = 300  # in seconds
+
+
+class MeteredSession(Session):
+    """
+    A couch session that records the number and latency of its requests.
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        start = time.time()
+        try:
+            return Session.request(self, method, url, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            METRICS.increment('couch.requests.%s' % method)
+            METRICS.observe('couch.request', elapsed)
+            METRICS.add_to_request('couch.calls', 1, COUNT_BUCKETS)
+            METRICS.add_to_request('couch.time', elapsed)
+
+
+SESSION = MeteredSession(timeout=COUCH_TIMEOUT)
+"""
+The session shared by all connections of the process to couch servers. It
+keeps a pool of keep-alive connections, so requests do not have to open new
+connections.
+"""
 
 
 class InvalidURLError(Exception):
@@ -104,7 +137,8 @@ class CouchDocument(SoledadDocument):
         SoledadDocument.__init__(self, doc_id, rev, json, has_conflicts)
         self._couch_rev = None
         self._conflicts = None
-        self._transactions = None
+        self._transactions = []
+        self._trans_id = None
 
     def _ensure_fetch_conflicts(self, get_conflicts_fun):
         """
@@ -182,6 +216,14 @@ class CouchDocument(SoledadDocument):
 
     transactions = property(_get_transactions, _set_transactions)
 
+    def _get_trans_id(self):
+        return self._trans_id
+
+    def _set_trans_id(self, trans_id):
+        self._trans_id = trans_id
+
+    trans_id = property(_get_trans_id, _set_trans_id)
+
 
 # monkey-patch the u1db http app to use CouchDocument
 http_app.Document = CouchDocument
@@ -338,17 +380,15 @@ class MultipartWriter(object):
 @contextmanager
 def couch_server(url):
     """
-    Provide a connection to a couch server and cleanup after use.
+    Provide a connection to a couch server.
 
-    For database creation and deletion we use an ephemeral connection to the
-    couch server. That connection has to be properly closed, so we provide it
-    as a context manager.
+    For database creation and deletion we use a couch server object, which
+    shares the pooled connections of the process.
 
     :param url: The URL of the Couch server.
     :type url: str
     """
-    session = Session(timeout=COUCH_TIMEOUT)
-    server = Server(url=url, session=session)
+    server = Server(url=url, session=SESSION)
     yield server
 
 
@@ -357,50 +397,35 @@ class CouchDatabase(CommonBackend):
     A U1DB implementation that uses CouchDB as its persistence layer.
     """
 
-    # We spawn threads to parallelize the CouchDatabase.get_docs() method
-    MAX_GET_DOCS_THREADS = 20
+    # The maximum number of documents fetched in one bulk request by
+    # CouchDatabase.get_docs() and CouchDatabase.get_all_docs().
+    BULK_GET_BATCH_SIZE = 100
+
+    # Whether documents stored in version 1 of the encrypted document format
+    # should be rewritten in version 2 format when they are read. This turns
+    # reads into writes, so by default documents are only migrated when they
+    # are written, or offline with migrate_encrypted_docs().
+    MIGRATE_ENCRYPTED_DOCS_ON_READ = False
+
+    # The number of documents fetched with each request when encrypted
+    # documents are migrated.
+    MIGRATE_PAGE_SIZE = 1000
+
+    # The prefix of the ids of the documents that log transactions, the
+    # prefix of the ids of the documents they are merged into, and the
+    # number of documents fetched with each request when the history is
+    # compacted.
+    LOG_DOC_ID_PREFIX = 'u1db_log_'
+    LOG_CHUNK_DOC_ID_PREFIX = 'u1db_log_chunk_'
+    HISTORY_PAGE_SIZE = 1000
+
+    # Whether _put_doc_if_newer() should first try to put documents using an
+    # update handler, which compares revisions inside couch.
+    PUT_IF_NEWER_WITH_UPDATE_HANDLER = True
 
     update_handler_lock = defaultdict(threading.Lock)
     sync_info_lock = defaultdict(threading.Lock)
 
-    class _GetDocThread(threading.Thread):
-        """
-        A thread that gets a document from a database.
-
-        TODO: switch this for a twisted deferred to thread. This depends on
-        replacing python-couchdb for paisley in this module.
-        """
-
-        def __init__(self, db, doc_id, check_for_conflicts,
-                     release_fun):
-            """
-            :param db: The database from where to get the document.
-            :type db: CouchDatabase
-            :param doc_id: The doc_id of the document to be retrieved.
-            :type doc_id: str
-            :param check_for_conflicts: Whether the get_doc() method should
-                                        check for existing conflicts.
-            :type check_for_conflicts: bool
-            :param release_fun: A function that releases a semaphore, to be
-                                called after the document is fetched.
-            :type release_fun: function
-            """
-            threading.Thread.__init__(self)
-            self._db = db
-            self._doc_id = doc_id
-            self._check_for_conflicts = check_for_conflicts
-            self._release_fun = release_fun
-            self._doc = None
-
-        def run(self):
-            """
-            Fetch the document, store it as a property, and call the release
-            function.
-            """
-            self._doc = self._db._get_doc(
-                self._doc_id, self._check_for_conflicts)
-            self._release_fun()
-
     @classmethod
     def open_database(cls, url, create, replica_uid=None, ensure_ddocs=False):
         """
@@ -434,7 +459,8 @@ class CouchDatabase(CommonBackend):
         return cls(
             url, dbname, replica_uid=replica_uid, ensure_ddocs=ensure_ddocs)
 
-    def __init__(self, url, dbname, replica_uid=None, ensure_ddocs=True):
+    def __init__(self, url, dbname, replica_uid=None, ensure_ddocs=True,
+                 session=None):
         """
         Create a new Couch data container.
 
@@ -446,12 +472,17 @@ class CouchDatabase(CommonBackend):
         :type replica_uid: str
         :param ensure_ddocs: Ensure that the design docs exist on server.
         :type ensure_ddocs: bool
+        :param session: The session used to connect to couch. Defaults to the
+                        session shared by the process.
+        :type session: couchdb.http.Session
         """
         # save params
         self._url = url
-        self._session = Session(timeout=COUCH_TIMEOUT)
+        self._session = session if session is not None else SESSION
         self._factory = CouchDocument
         self._real_replica_uid = None
+        self._put_if_newer_handler_missing = False
+        self._log_docs_supported = None
         # configure couch
         self._dbname = dbname
         self._database = Database(
@@ -465,9 +496,6 @@ class CouchDatabase(CommonBackend):
             self._set_replica_uid(replica_uid)
         if ensure_ddocs:
             self.ensure_ddocs_on_db()
-        # initialize a thread pool for parallelizing get_docs()
-        self._sem_pool = threading.BoundedSemaphore(
-            value=self.MAX_GET_DOCS_THREADS)
 
     def ensure_ddocs_on_db(self):
         """
@@ -574,9 +602,6 @@ class CouchDatabase(CommonBackend):
 
         :raise MissingDesignDocError: Raised when tried to access a missing
                                       design document.
-        :raise MissingDesignDocListFunctionError: Raised when trying to access
-                                                  a missing list function on a
-                                                  design document.
         :raise MissingDesignDocNamedViewError: Raised when trying to access a
                                                missing named view on a design
                                                document.
@@ -586,29 +611,21 @@ class CouchDatabase(CommonBackend):
                                              design document for an yet
                                              unknown reason.
         """
-        # query a couch list function
-        ddoc_path = ['_design', 'transactions', '_list', 'generation', 'log']
-        res = self._database.resource(*ddoc_path)
-        try:
-            response = res.get_json()
-            return response[2]['generation']
-        except ResourceNotFound as e:
-            raise_missing_design_doc_error(e, ddoc_path)
-        except ServerError as e:
-            raise_server_error(e, ddoc_path)
+        return self._get_generation_info()[0]
 
     def _get_generation_info(self):
         """
         Return the current generation.
 
+        The transaction log view is queried for its last row only. The total
+        number of rows, which is the current generation, is read from the
+        view index, so this does not depend on the size of the log.
+
         :return: A tuple containing the current generation and transaction id.
         :rtype: (int, str)
 
         :raise MissingDesignDocError: Raised when tried to access a missing
                                       design document.
-        :raise MissingDesignDocListFunctionError: Raised when trying to access
-                                                  a missing list function on a
-                                                  design document.
         :raise MissingDesignDocNamedViewError: Raised when trying to access a
                                                missing named view on a design
                                                document.
@@ -618,16 +635,92 @@ class CouchDatabase(CommonBackend):
                                              design document for an yet
                                              unknown reason.
         """
-        # query a couch list function
-        ddoc_path = ['_design', 'transactions', '_list', 'generation', 'log']
+        cur_gen, rows = self._query_transaction_log(
+            descending='true', limit=1)
+        if not rows:
+            return 0, ''
+        return cur_gen, self._log_entry(rows[0])[1]
+
+    def _log_entry(self, row):
+        """
+        Return the document id and transaction id of a row of the transaction
+        log view.
+
+        Rows of transactions held by documents have the transaction id as
+        value, and rows of transactions logged in documents of their own have
+        the transaction id and the id of their document.
+
+        :param row: The row of the view.
+        :type row: dict
+
+        :return: The document id and the transaction id.
+        :rtype: (str, str)
+        """
+        if isinstance(row['value'], list):
+            trans_id, doc_id = row['value']
+            return doc_id, trans_id
+        return row['id'], row['value']
+
+    def _query_transaction_log(self, **params):
+        """
+        Query the transaction log view.
+
+        Rows of the view are ordered by transaction, so the row of generation
+        `gen` is the one skipping `gen - 1` rows from the start, or skipping
+        `cur_gen - gen` rows from the end in a descending query.
+
+        :param params: The query parameters.
+        :type params: dict
+
+        :return: The total number of rows of the view, which is the current
+                 generation, and the rows returned by the query.
+        :rtype: (int, list)
+
+        :raise MissingDesignDocError: Raised when tried to access a missing
+                                      design document.
+        :raise MissingDesignDocNamedViewError: Raised when trying to access a
+                                               missing named view on a design
+                                               document.
+        :raise MissingDesignDocDeletedError: Raised when trying to access a
+                                             deleted design document.
+        :raise MissingDesignDocUnknownError: Raised when failed to access a
+                                             design document for an yet
+                                             unknown reason.
+        """
+        response = self._get_transaction_log_response(**params)
+        return response['total_rows'], response['rows']
+
+    def _get_transaction_log_response(self, **params):
+        """
+        Query the transaction log view and return the whole response, which
+        also has the number of rows before the first one returned.
+
+        :param params: The query parameters.
+        :type params: dict
+
+        :return: The response of the view.
+        :rtype: dict
+
+        :raise MissingDesignDocError: Raised when tried to access a missing
+                                      design document.
+        :raise MissingDesignDocNamedViewError: Raised when trying to access a
+                                               missing named view on a design
+                                               document.
+        :raise MissingDesignDocDeletedError: Raised when trying to access a
+                                             deleted design document.
+        :raise MissingDesignDocUnknownError: Raised when failed to access a
+                                             design document for an yet
+                                             unknown reason.
+        """
+        ddoc_path = ['_design', 'transactions', '_view', 'log']
         res = self._database.resource(*ddoc_path)
         try:
-            response = res.get_json()
-            return (response[2]['generation'], response[2]['transaction_id'])
+            response = res.get_json(**params)
         except ResourceNotFound as e:
             raise_missing_design_doc_error(e, ddoc_path)
         except ServerError as e:
             raise_server_error(e, ddoc_path)
+        return response[2]
 
     def _get_trans_id_for_gen(self, generation):
         """
@@ -642,9 +735,6 @@ class CouchDatabase(CommonBackend):
         :raise InvalidGeneration: Raised when the generation does not exist.
         :raise MissingDesignDocError: Raised when tried to access a missing
                                       design document.
-        :raise MissingDesignDocListFunctionError: Raised when trying to access
-                                                  a missing list function on a
-                                                  design document.
         :raise MissingDesignDocNamedViewError: Raised when trying to access a
                                                missing named view on a design
                                                document.
@@ -656,20 +746,22 @@ class CouchDatabase(CommonBackend):
         """
         if generation == 0:
             return ''
-        # query a couch list function
-        ddoc_path = [
-            '_design', 'transactions', '_list', 'trans_id_for_gen', 'log'
-        ]
-        res = self._database.resource(*ddoc_path)
-        try:
-            response = res.get_json(gen=generation)
-            if response[2] == {}:
-                raise InvalidGeneration
-            return response[2]['transaction_id']
-        except ResourceNotFound as e:
-            raise_missing_design_doc_error(e, ddoc_path)
-        except ServerError as e:
-            raise_server_error(e, ddoc_path)
+        cur_gen, trans_id = self._get_generation_info()
+        # look the generation up from the nearest end of the log
+        while generation < cur_gen:
+            if generation <= cur_gen // 2:
+                _, rows = self._query_transaction_log(
+                    skip=generation - 1, limit=1)
+                return self._log_entry(rows[0])[1]
+            total, rows = self._query_transaction_log(
+                descending='true', skip=cur_gen - generation, limit=1)
+            if total == cur_gen:
+                return self._log_entry(rows[0])[1]
+            # the log has grown in the meantime
+            cur_gen = total
+        if generation == cur_gen:
+            return trans_id
+        raise InvalidGeneration
 
     def _get_transaction_log(self):
         """
@@ -692,16 +784,8 @@ class CouchDatabase(CommonBackend):
                                              design document for an yet
                                              unknown reason.
         """
-        # query a couch view
-        ddoc_path = ['_design', 'transactions', '_view', 'log']
-        res = self._database.resource(*ddoc_path)
-        try:
-            response = res.get_json()
-            return map(
-                lambda row: (row['id'], row['value']),
-                response[2]['rows'])
-        except ResourceNotFound as e:
-            raise_missing_design_doc_error(e, ddoc_path)
+        _, rows = self._query_transaction_log()
+        return map(self._log_entry, rows)
 
     def _get_doc(self, doc_id, check_for_conflicts=False):
         """
@@ -726,18 +810,44 @@ class CouchDatabase(CommonBackend):
                     attachments=True)[2]
         except ResourceNotFound:
             return None
+        return self._doc_from_couch_doc(doc_id, result, check_for_conflicts)
+
+    def _doc_from_couch_doc(self, doc_id, result, check_for_conflicts):
+        """
+        Build a document from a couch document fetched with its attachments.
+
+        :param doc_id: The unique document identifier
+        :type doc_id: str
+        :param result: The couch document.
+        :type result: dict
+        :param check_for_conflicts: If set to False, then the conflict check
+                                    will be skipped.
+        :type check_for_conflicts: bool
+
+        :return: The document, or None if the couch document does not hold a
+                 U1DB document.
+        :rtype: CouchDocument
+        """
         # restrict to u1db documents
         if 'u1db_rev' not in result:
             return None
         doc = self._factory(doc_id, result['u1db_rev'])
         # set contents or make tombstone
+        migrate = False
         if '_attachments' not in result \
                 or 'u1db_content' not in result['_attachments']:
             doc.make_tombstone()
         else:
-            doc.content = json.loads(
-                binascii.a2b_base64(
-                    result['_attachments']['u1db_content']['data']))
+            content = binascii.a2b_base64(
+                result['_attachments']['u1db_content']['data'])
+            if 'u1db_enc' in result:
+                # encrypted content stored in version 2 format
+                doc.content = join_encrypted_content(
+                    result['u1db_enc'], content)
+            else:
+                doc.content = json.loads(content)
+                migrate = self.MIGRATE_ENCRYPTED_DOCS_ON_READ \
+                    and split_encrypted_content(doc.content)[0] is not None
         # determine if there are conflicts
         if check_for_conflicts \
                 and '_attachments' in result \
@@ -751,9 +861,66 @@ class CouchDatabase(CommonBackend):
         # store couch revision
         doc.couch_rev = result['_rev']
         # store transactions
-        doc.transactions = result['u1db_transactions']
+        doc.transactions = result.get('u1db_transactions', [])
+        doc.trans_id = result.get('u1db_trans_id')
+        # conflicts have to be known so they are kept when migrating
+        if migrate and (check_for_conflicts
+                        or 'u1db_conflicts' not in result['_attachments']):
+            self._migrate_doc(doc)
         return doc
 
+    def _migrate_doc(self, doc):
+        """
+        Rewrite a document stored in version 1 of the encrypted document
+        format in version 2 format.
+
+        The U1DB revision and transactions of the document are kept and no
+        transaction is logged, so this does not change the database
+        generation. If the document is
+        concurrently updated, it is left to be migrated when written.
+
+        :param doc: The document, as read from the database.
+        :type doc: CouchDocument
+
+        :return: Whether the document was migrated.
+        :rtype: bool
+        """
+        try:
+            doc.couch_rev = self._put_couch_doc(doc, doc.couch_rev)
+            return True
+        except RevisionConflict:
+            logger.debug("Could not migrate document %s." % doc.doc_id)
+            return False
+
+    def migrate_encrypted_docs(self, page_size=MIGRATE_PAGE_SIZE):
+        """
+        Rewrite all documents stored in version 1 of the encrypted document
+        format in version 2 format.
+
+        This is meant to be run offline, as documents are otherwise only
+        migrated when they are written. Documents concurrently updated are
+        skipped, as they are then stored in version 2 format.
+
+        :param page_size: The number of documents fetched with each request.
+        :type page_size: int
+
+        :return: The number of documents migrated.
+        :rtype: int
+        """
+        migrated = 0
+        for couch_doc in self._iter_couch_docs(page_size):
+            if 'u1db_rev' not in couch_doc or 'u1db_enc' in couch_doc \
+                    or 'u1db_content' not in couch_doc.get(
+                        '_attachments', {}):
+                continue
+            doc = self._get_doc(couch_doc.id, check_for_conflicts=True)
+            if doc is None or doc.is_tombstone() \
+                    or split_encrypted_content(doc.content)[0] is None:
+                continue
+            if self._migrate_doc(doc):
+                migrated += 1
+        return migrated
+
     def get_doc(self, doc_id, include_deleted=False):
         """
         Get the JSON string for the given document.
@@ -791,11 +958,13 @@ class CouchDatabase(CommonBackend):
         """
 
         generation = self._get_generation()
-        results = []
-        for row in self._database.view('_all_docs'):
-            doc = self.get_doc(row.id, include_deleted=include_deleted)
-            if doc is not None:
-                results.append(doc)
+        # documents that log transactions are not fetched
+        doc_ids = [
+            row.id for row in self._database.view('_all_docs')
+            if not row.id.startswith(self.LOG_DOC_ID_PREFIX)]
+        results = list(self.get_docs(
+            doc_ids, check_for_conflicts=True,
+            include_deleted=include_deleted))
         return (generation, results)
 
     def _put_doc(self, old_doc, doc):
@@ -827,48 +996,273 @@ class CouchDatabase(CommonBackend):
                                              design document for an yet
                                              unknown reason.
         """
-        attachments = {}  # we save content and conflicts as attachments
-        parts = []  # and we put it using couch's multipart PUT
-        # save content as attachment
-        if doc.is_tombstone() is False:
-            content = doc.get_json()
-            attachments['u1db_content'] = {
-                'follows': True,
-                'content_type': 'application/octet-stream',
-                'length': len(content),
-            }
-            parts.append(content)
-        # save conflicts as attachment
-        if doc.has_conflicts is True:
-            conflicts = json.dumps(
-                map(lambda cdoc: (cdoc.rev, cdoc.content),
-                    doc.get_conflicts()))
-            attachments['u1db_conflicts'] = {
-                'follows': True,
-                'content_type': 'application/octet-stream',
-                'length': len(conflicts),
-            }
-            parts.append(conflicts)
-        # store old transactions, if any
-        transactions = old_doc.transactions[:] if old_doc is not None else []
-        # create a new transaction id and timestamp it so the transaction log
-        # is consistent when querying the database.
-        transactions.append(
+        # nothing is written if couch revisions mismatch
+        if self._put_docs_in_bulk([(old_doc, doc)])[0] is None:
+            raise RevisionConflict()
+
+    def _prepare_transaction(self, old_doc, doc):
+        """
+        Create a new transaction for a document being written.
+
+        Each transaction is logged in a document of its own, which is never
+        updated. The transaction log view orders these documents by their
+        sequence number in the database, so transactions are ordered as they
+        were committed, and a transaction committed later never takes the
+        place of one already in the log.
+
+        Transactions kept in documents by older versions are kept along with
+        the document, so their generations do not change. If the design
+        documents of the database have not been updated, the new transaction
+        is also kept in the document, ordered by a timestamp.
+
+        :param old_doc: The old document version, or None if the document
+                        does not exist.
+        :type old_doc: CouchDocument
+        :param doc: The document to be written.
+        :type doc: CouchDocument
+
+        :return: The transaction id, and the document that logs the
+                 transaction, or None if the transaction is kept in the
+                 document.
+        :rtype: (str, dict)
+        """
+        trans_id = self._allocate_transaction_id()
+        doc.transactions = \
+            list(old_doc.transactions) if old_doc is not None else []
+        if not self._writes_log_docs():
             # here we store milliseconds to keep consistent with javascript
             # Date.prototype.getTime() which was used before inside a couchdb
             # update handler.
-            (int(time.time() * 1000),
-             self._allocate_transaction_id()))
-        # build the couch document
-        couch_doc = {
-            '_id': doc.doc_id,
-            'u1db_rev': doc.rev,
-            'u1db_transactions': transactions,
-            '_attachments': attachments,
+            doc.transactions.append((int(time.time() * 1000), trans_id))
+            doc.trans_id = None
+            return trans_id, None
+        doc.trans_id = trans_id
+        return trans_id, self._make_log_doc(doc.doc_id, trans_id)
+
+    def _make_log_doc(self, doc_id, trans_id):
+        """
+        Build the document that logs a transaction.
+
+        :param doc_id: The id of the document the transaction belongs to.
+        :type doc_id: str
+        :param trans_id: The transaction id.
+        :type trans_id: str
+
+        :return: The log document.
+        :rtype: dict
+        """
+        return {
+            '_id': self.LOG_DOC_ID_PREFIX + trans_id,
+            'u1db_log': [trans_id, doc_id],
         }
-        # if we are updating a doc we have to add the couch doc revision
-        if old_doc is not None:
-            couch_doc['_rev'] = old_doc.couch_rev
+
+    def _save_log_docs(self, log_docs):
+        """
+        Create log documents, keeping the ones that already exist.
+
+        :param log_docs: The log documents.
+        :type log_docs: list
+
+        :return: The number of log documents created.
+        :rtype: int
+        """
+        if not log_docs:
+            return 0
+        results = self._database.update(log_docs)
+        return len([success for success, _, _ in results if success])
+
+    def _writes_log_docs(self):
+        """
+        Tell whether transactions are logged in documents of their own,
+        which depends on the transaction log view indexing them.
+
+        Databases whose design documents have not been updated keep all
+        transactions of a document in the document.
+
+        :return: Whether transactions are logged in documents of their own.
+        :rtype: bool
+        """
+        if self._log_docs_supported is None:
+            try:
+                ddoc = self._database['_design/transactions']
+                self._log_docs_supported = \
+                    'u1db_log' in ddoc['views']['log']['map']
+            except (ResourceNotFound, KeyError):
+                self._log_docs_supported = False
+        return self._log_docs_supported
+
+    def compact_transaction_history(self, page_size=HISTORY_PAGE_SIZE):
+        """
+        Merge the documents that log transactions into chunk documents, and
+        log the transactions of documents that were written without their log
+        documents.
+
+        Log documents are merged one page of the transaction log at a time,
+        up to the last transaction logged when compaction starts. The chunk
+        document holds the transactions with the keys they had in the log,
+        and is created with the same request that deletes the merged log
+        documents, so they are committed together and generations and
+        transaction ids are the same after compaction. Only one compaction
+        may run on a database at a time, or transactions could be merged
+        twice.
+
+        The update handler used by _put_doc_if_newer() writes a document
+        before the document that logs its transaction. If writing the log
+        document fails, the latest transaction of the document is logged
+        here, after all transactions already in the log. The ids of the
+        transactions in the log are kept in memory while documents are
+        checked.
+
+        :param page_size: The number of log rows or documents fetched with
+                          each request.
+        :type page_size: int
+
+        :return: The number of log documents merged and the number of log
+                 documents written, or (0, 0) if the design documents of the
+                 database do not support log documents.
+        :rtype: (int, int)
+        """
+        if not self._writes_log_docs():
+            return 0, 0
+        merged = 0
+        logged = set()
+        for rows in self._iter_transaction_log(page_size):
+            logged.update(self._log_entry(row)[1] for row in rows)
+            log_rows = [
+                row for row in rows
+                if row['id'].startswith(self.LOG_DOC_ID_PREFIX)
+                and not row['id'].startswith(self.LOG_CHUNK_DOC_ID_PREFIX)]
+            if len(log_rows) > 1:
+                merged += self._merge_log_docs(log_rows)
+        log_docs = []
+        for couch_doc in self._iter_couch_docs(page_size):
+            trans_id = couch_doc.get('u1db_trans_id')
+            if trans_id is not None and trans_id not in logged:
+                log_docs.append(self._make_log_doc(couch_doc.id, trans_id))
+        return merged, self._save_log_docs(log_docs)
+
+    def _iter_transaction_log(self, page_size):
+        """
+        Iterate over the rows of the transactions logged in documents of
+        their own or in chunk documents, one page at a time, up to the last
+        one logged when the iteration starts.
+
+        :param page_size: The number of rows fetched with each request.
+        :type page_size: int
+
+        :return: An iterator over lists of rows of the transaction log view.
+        :rtype: generator
+        """
+        _, rows = self._query_transaction_log(descending='true', limit=1)
+        if not rows or not isinstance(rows[0]['key'], list):
+            return
+        # keys of these transactions are unique lists, which sort after the
+        # timestamps of transactions kept in documents
+        params = {
+            'startkey': json.dumps([]),
+            'endkey': json.dumps(rows[0]['key']),
+            'limit': page_size + 1,
+        }
+        while True:
+            _, rows = self._query_transaction_log(**params)
+            yield rows[:page_size]
+            if len(rows) <= page_size:
+                return
+            params['startkey'] = json.dumps(rows[page_size]['key'])
+
+    def _merge_log_docs(self, rows):
+        """
+        Merge log documents into a new chunk document.
+
+        :param rows: The rows of the log documents in the transaction log
+                     view.
+        :type rows: list
+
+        :return: The number of log documents merged.
+        :rtype: int
+        """
+        _, _, data = self._database.resource('_all_docs').post_json(
+            body={'keys': [row['id'] for row in rows]})
+        chunk = []
+        deleted = []
+        for row, doc_row in izip(rows, data['rows']):
+            value = doc_row.get('value')
+            if value is None or value.get('deleted'):
+                continue
+            chunk.append([row['key']] + row['value'])
+            deleted.append({
+                '_id': row['id'],
+                '_rev': value['rev'],
+                '_deleted': True,
+            })
+        if len(chunk) < 2:
+            return 0
+        chunk_doc = {
+            '_id': self.LOG_CHUNK_DOC_ID_PREFIX + uuid.uuid4().hex,
+            'u1db_log_chunk': chunk,
+        }
+        results = self._database.update([chunk_doc] + deleted)
+        return len([success for success, _, _ in results[1:] if success])
+
+    def _iter_couch_docs(self, page_size, startkey=None, endkey=None):
+        """
+        Iterate over the couch documents of the database, one page at a time.
+
+        :param page_size: The number of documents fetched with each request.
+        :type page_size: int
+        :param startkey: The id to start from, if any.
+        :type startkey: str
+        :param endkey: The id to stop at, if any.
+        :type endkey: str
+
+        :return: An iterator over the couch documents, without the content of
+                 their attachments.
+        :rtype: generator
+        """
+        options = {'include_docs': True, 'limit': page_size + 1}
+        if endkey is not None:
+            options['endkey'] = endkey
+        while True:
+            if startkey is not None:
+                options['startkey'] = startkey
+            rows = list(self._database.view('_all_docs', **options))
+            for row in rows[:page_size]:
+                if row.doc is not None:
+                    yield row.doc
+            if len(rows) <= page_size:
+                return
+            startkey = rows[-1].id
+
+    def _put_couch_doc(self, doc, couch_rev):
+        """
+        Store a document in a couch document.
+
+        Symmetrically encrypted contents are stored in version 2 of the
+        encrypted document format: the encryption metadata is kept in the
+        couch document and the raw ciphertext is stored as its content
+        attachment. Other contents are stored as JSON attachments.
+
+        :param doc: The document to be put.
+        :type doc: CouchDocument
+        :param couch_rev: The current couch revision of the document, or None
+                          if it does not exist.
+        :type couch_rev: str
+
+        :return: The new couch revision of the document.
+        :rtype: str
+
+        :raise RevisionConflict: Raised when trying to update a document but
+                                 couch revisions mismatch.
+        """
+        couch_doc, attachments = self._make_couch_doc(doc, couch_rev)
+        # content and conflicts follow the document in a multipart PUT
+        couch_doc['_attachments'] = dict(
+            (name, {
+                'follows': True,
+                'content_type': 'application/octet-stream',
+                'length': len(data),
+            }) for name, data in attachments)
+        parts = [data for _, data in attachments]
         # prepare the multipart PUT
         buf = StringIO()
         envelope = MultipartWriter(buf)
@@ -879,10 +1273,105 @@ class CouchDatabase(CommonBackend):
         # try to save and fail if there's a revision conflict
         try:
             resource = self._new_resource()
-            resource.put_json(
+            _, _, result = resource.put_json(
                 doc.doc_id, body=buf.getvalue(), headers=envelope.headers)
         except ResourceConflict:
             raise RevisionConflict()
+        return result['rev']
+
+    def _make_couch_doc(self, doc, couch_rev):
+        """
+        Build the couch document that stores a document.
+
+        The document keeps the transactions it holds, if any, and the id of
+        its latest transaction if that is logged in a document of its own.
+
+        :param doc: The document to be put.
+        :type doc: CouchDocument
+        :param couch_rev: The current couch revision of the document, or None
+                          if it does not exist.
+        :type couch_rev: str
+
+        :return: The couch document, without attachments, and a list of
+                 (name, data) tuples for the attachments it should be stored
+                 with.
+        :rtype: (dict, list)
+        """
+        attachments = []  # we save content and conflicts as attachments
+        enc_metadata = None
+        # save content as attachment
+        if doc.is_tombstone() is False:
+            enc_metadata, content = split_encrypted_content(doc.content)
+            if enc_metadata is None:
+                content = doc.get_json()
+            attachments.append(('u1db_content', content))
+        # save conflicts as attachment
+        if doc.has_conflicts is True:
+            conflicts = json.dumps(
+                map(lambda cdoc: (cdoc.rev, cdoc.content),
+                    doc.get_conflicts()))
+            attachments.append(('u1db_conflicts', conflicts))
+        # build the couch document
+        couch_doc = {
+            '_id': doc.doc_id,
+            'u1db_rev': doc.rev,
+        }
+        if doc.transactions:
+            couch_doc['u1db_transactions'] = doc.transactions
+        if doc.trans_id is not None:
+            couch_doc['u1db_trans_id'] = doc.trans_id
+        if enc_metadata is not None:
+            couch_doc['u1db_enc'] = enc_metadata
+        # if we are updating a doc we have to add the couch doc revision
+        if couch_rev is not None:
+            couch_doc['_rev'] = couch_rev
+        return couch_doc, attachments
+
+    def _put_docs_in_bulk(self, docs):
+        """
+        Put many documents in the Couch backend database with one bulk
+        request.
+
+        Documents are sent with their attachments inline, along with the
+        documents that log their new transactions, so a document and its
+        transaction are committed together. Each document is written or not
+        independently of the others. A document that could not be written
+        leaves its transaction in the log, which then refers to a change that
+        did not happen: it is returned by whats_changed() like any other
+        change of the document, and does not move other transactions.
+
+        :param docs: A list of (old_doc, doc) tuples, where old_doc is the
+                     current version of the document, fetched with its
+                     conflicts, or None if it does not exist.
+        :type docs: list
+
+        :return: A list with the id of the new transaction of each document,
+                 or None for documents that could not be written because
+                 couch revisions mismatch.
+        :rtype: list
+        """
+        if not docs:
+            return []
+        couch_docs = []
+        log_docs = []
+        trans_ids = []
+        for old_doc, doc in docs:
+            trans_id, log_doc = self._prepare_transaction(old_doc, doc)
+            trans_ids.append(trans_id)
+            if log_doc is not None:
+                log_docs.append(log_doc)
+            couch_rev = old_doc.couch_rev if old_doc is not None else None
+            couch_doc, attachments = self._make_couch_doc(doc, couch_rev)
+            couch_doc['_attachments'] = dict(
+                (name, {
+                    'content_type': 'application/octet-stream',
+                    'data': binascii.b2a_base64(data).strip(),
+                }) for name, data in attachments)
+            couch_docs.append(couch_doc)
+        results = self._database.update(couch_docs + log_docs)
+        return [
+            trans_id if success else None
+            for trans_id, (success, _, _) in izip(trans_ids, results)]
 
     def put_doc(self, doc):
         """
@@ -940,9 +1429,6 @@ class CouchDatabase(CommonBackend):
 
         :raise MissingDesignDocError: Raised when tried to access a missing
                                       design document.
-        :raise MissingDesignDocListFunctionError: Raised when trying to access
-                                                  a missing list function on a
-                                                  design document.
         :raise MissingDesignDocNamedViewError: Raised when trying to access a
                                                missing named view on a design
                                                document.
@@ -952,38 +1438,26 @@ class CouchDatabase(CommonBackend):
                                              design document for an yet
                                              unknown reason.
         """
-        # query a couch list function
-        ddoc_path = [
-            '_design', 'transactions', '_list', 'whats_changed', 'log'
-        ]
-        res = self._database.resource(*ddoc_path)
-        try:
-            response = res.get_json(old_gen=old_generation)
-            results = map(
-                lambda row:
-                    (row['generation'], row['doc_id'], row['transaction_id']),
-                response[2]['transactions'])
-            results.reverse()
-            cur_gen = old_generation
-            seen = set()
-            changes = []
-            newest_trans_id = ''
-            for generation, doc_id, trans_id in results:
-                if doc_id not in seen:
-                    changes.append((doc_id, generation, trans_id))
-                    seen.add(doc_id)
-            if changes:
-                cur_gen = changes[0][1]  # max generation
-                newest_trans_id = changes[0][2]
-                changes.reverse()
-            else:
-                cur_gen, newest_trans_id = self._get_generation_info()
-
-            return cur_gen, newest_trans_id, changes
-        except ResourceNotFound as e:
-            raise_missing_design_doc_error(e, ddoc_path)
-        except ServerError as e:
-            raise_server_error(e, ddoc_path)
+        cur_gen, newest_trans_id = self._get_generation_info()
+        if cur_gen <= old_generation:
+            return cur_gen, newest_trans_id, []
+        # only the rows after old_generation are fetched, newest first
+        total, rows = self._query_transaction_log(
+            descending='true', limit=cur_gen - old_generation)
+        while total > cur_gen:
+            # the log has grown in the meantime
+            cur_gen = total
+            total, rows = self._query_transaction_log(
+                descending='true', limit=cur_gen - old_generation)
+        seen = set()
+        changes = []
+        for generation, row in zip(xrange(total, old_generation, -1), rows):
+            doc_id, trans_id = self._log_entry(row)
+            if doc_id not in seen:
+                changes.append((doc_id, generation, trans_id))
+                seen.add(doc_id)
+        changes.reverse()
+        return total, self._log_entry(rows[0])[1], changes
 
     def delete_doc(self, doc):
         """
@@ -1108,7 +1582,7 @@ class CouchDatabase(CommonBackend):
     def _set_replica_gen_and_trans_id(self, other_replica_uid,
                                       other_generation, other_transaction_id,
                                       number_of_docs=None, doc_idx=None,
-                                      sync_id=None):
+                                      sync_id=None, first_doc_idx=None):
         """
         Set the last-known generation and transaction id for the other
         database replica.
@@ -1131,14 +1605,21 @@ class CouchDatabase(CommonBackend):
         :type doc_idx: int
         :param sync_id: The id of the current sync session.
         :type sync_id: str
+        :param first_doc_idx: The index of the first document of a run of
+                              consecutive documents ending with the current
+                              one, if the generation is recorded once for
+                              many documents.
+        :type first_doc_idx: int
         """
         self._do_set_replica_gen_and_trans_id(
             other_replica_uid, other_generation, other_transaction_id,
-            number_of_docs=number_of_docs, doc_idx=doc_idx, sync_id=sync_id)
+            number_of_docs=number_of_docs, doc_idx=doc_idx, sync_id=sync_id,
+            first_doc_idx=first_doc_idx)
 
     def _do_set_replica_gen_and_trans_id(
             self, other_replica_uid, other_generation, other_transaction_id,
-            number_of_docs=None, doc_idx=None, sync_id=None):
+            number_of_docs=None, doc_idx=None, sync_id=None,
+            first_doc_idx=None):
         """
         Set the last-known generation and transaction id for the other
         database replica.
@@ -1161,6 +1642,11 @@ class CouchDatabase(CommonBackend):
         :type doc_idx: int
         :param sync_id: The id of the current sync session.
         :type sync_id: str
+        :param first_doc_idx: The index of the first document of a run of
+                              consecutive documents ending with the current
+                              one, if the generation is recorded once for
+                              many documents.
+        :type first_doc_idx: int
 
         :raise MissingDesignDocError: Raised when tried to access a missing
                                       design document.
@@ -1192,6 +1678,8 @@ class CouchDatabase(CommonBackend):
                     body['doc_idx'] = doc_idx
                 if sync_id is not None:
                     body['sync_id'] = sync_id
+                if first_doc_idx is not None:
+                    body['first_doc_idx'] = first_doc_idx
                 res.put_json(
                     body=body,
                     headers={'content-type': 'application/json'})
@@ -1262,19 +1750,6 @@ class CouchDatabase(CommonBackend):
                 doc.rev = doc_vcr.as_str()
             self._delete_conflicts(doc, c_revs_to_prune)
 
-    def _force_doc_sync_conflict(self, doc):
-        """
-        Add a conflict and force a document put.
-
-        :param doc: The document to be put.
-        :type doc: CouchDocument
-        """
-        my_doc = self._get_doc(doc.doc_id, check_for_conflicts=True)
-        self._prune_conflicts(doc, vectorclock.VectorClockRev(doc.rev))
-        self._add_conflict(doc, my_doc.rev, my_doc.get_json())
-        doc.has_conflicts = True
-        self._put_doc(my_doc, doc)
-
     def resolve_doc(self, doc, conflicted_doc_revs):
         """
         Mark a document as no longer conflicted.
@@ -1384,64 +1859,365 @@ class CouchDatabase(CommonBackend):
                  'converged', at_gen is the insertion/current generation.
         :rtype: (str, int)
         """
-        cur_doc = self._get_doc(doc.doc_id, check_for_conflicts=True)
-        # at this point, `doc` has arrived from the other syncing party, and
-        # we will decide what to do with it.
-        # First, we prepare the arriving doc to update couch database.
-        old_doc = doc
-        doc = self._factory(doc.doc_id, doc.rev, doc.get_json())
+        return self._put_docs_if_newer(
+            [(doc, replica_gen, replica_trans_id, doc_idx)], save_conflict,
+            replica_uid, number_of_docs=number_of_docs, sync_id=sync_id)[0]
+
+    def _put_doc_if_newer_with_update_handler(self, doc):
+        """
+        Try to put an incoming document with a single request to an update
+        handler, which compares revisions inside couch.
+
+        The update handler only decides when that does not depend on the
+        contents or conflicts of the stored document, so it never reports a
+        conflict.
+
+        The update handler cannot write the document that logs the
+        transaction of the incoming document, so that is written afterwards,
+        and only if the incoming document was inserted. If writing it fails,
+        the error is raised, and the transaction is logged when the history is
+        compacted.
+
+        The update handler also returns the sequence number the database had
+        when it read the stored document, so the generation at that time and
+        the generation of the new transaction can be read from the log with
+        one request.
+
+        :param doc: The incoming document.
+        :type doc: CouchDocument
+
+        :return: The state of the incoming document, as returned by
+                 _put_doc_if_newer(), whether it has conflicts, the id of the
+                 new transaction, or None if the document was not inserted,
+                 and the database sequence number when the stored document
+                 was read. None is returned if the caller has to compare the
+                 documents by itself.
+        :rtype: (str, bool, str, int)
+        """
+        if not self.PUT_IF_NEWER_WITH_UPDATE_HANDLER \
+                or self._put_if_newer_handler_missing \
+                or not self._writes_log_docs():
+            return None
+        trans_id = self._allocate_transaction_id()
+        body = {
+            'u1db_rev': doc.rev,
+            'content': None,
+            'trans_id': trans_id,
+        }
+        if doc.is_tombstone() is False:
+            enc_metadata, content = split_encrypted_content(doc.content)
+            if enc_metadata is None:
+                content = doc.get_json()
+            else:
+                body['u1db_enc'] = enc_metadata
+            body['content'] = binascii.b2a_base64(content).strip()
+        ddoc_path = ['_design', 'docs', '_update', 'put_if_newer', doc.doc_id]
+        res = self._database.resource(*ddoc_path)
+        try:
+            _, _, result = res.put_json(
+                body=body, headers={'content-type': 'application/json'})
+        except ResourceNotFound:
+            # the design documents of this database are outdated
+            self._put_if_newer_handler_missing = True
+            return None
+        except ResourceConflict:
+            # the document was updated concurrently
+            return None
+        if result['state'] is None:
+            return None
+        if result['state'] == 'inserted':
+            self._save_log_docs([self._make_log_doc(doc.doc_id, trans_id)])
+        else:
+            trans_id = None
+        return (result['state'], result['has_conflicts'], trans_id,
+                result['update_seq'])
+
+    def _count_put_doc_if_newer_path(self, path):
+        """
+        Count one document put by _put_doc_if_newer() using some path, in
+        the 'couch.put_doc_if_newer.<path>' counter.
+
+        :param path: Either 'update_handler' or 'fallback'.
+        :type path: str
+        """
+        METRICS.increment('couch.put_doc_if_newer.%s' % path)
+
+    def _put_docs_if_newer(self, entries, save_conflict, replica_uid,
+                           number_of_docs=None, sync_id=None):
+        """
+        Insert/update many documents into the database with given revisions.
+
+        This is the batch variant of _put_doc_if_newer(): the current versions
+        of the documents are fetched with bulk requests, and each incoming
+        document is compared to its current version just like in
+        _put_doc_if_newer(). All documents that have to be written are then
+        sent with one _bulk_docs request, and the replica generation is
+        recorded once for each run of consecutive documents of the batch.
+
+        Each document written is returned with the generation of its own
+        transaction, so changes made by other writers during the batch are
+        not taken as seen by the source replica. Other documents are returned
+        with the generation the database had before they were compared.
+
+        Documents that could not be written because they were concurrently
+        updated are compared again to their current versions and put one at a
+        time. The document of a batch of only one document is first tried
+        with a single request to the update handler, which tells the sequence
+        number of the database when it decided, so the generation before the
+        batch does not have to be read.
+
+        :param entries: A list of (doc, replica_gen, replica_trans_id,
+                        doc_idx) tuples for the incoming documents, where
+                        replica_gen and replica_trans_id are the generation
+                        and transaction id of the source replica corresponding
+                        to each document, and doc_idx is its index in the sync
+                        session.
+        :type entries: list
+        :param save_conflict: If a document is a conflict, do you want to
+                              save it as a conflict, or just ignore it.
+        :type save_conflict: bool
+        :param replica_uid: A unique replica identifier.
+        :type replica_uid: str
+        :param number_of_docs: The total amount of documents sent on this sync
+                               session.
+        :type number_of_docs: int
+        :param sync_id: The id of the current sync session.
+        :type sync_id: str
+
+        :return: A list with one (state, at_gen) tuple for each entry, as
+                 returned by _put_doc_if_newer().
+        :rtype: list
+        """
+        entries = list(entries)
+        if not entries:
+            return []
+        _, first_gen, first_trans_id, _ = min(entries, key=lambda e: e[1])
+        self._validate_source(replica_uid, first_gen, first_trans_id)
+        states = [None] * len(entries)
+        # ids of the transactions of the documents written
+        trans_ids = {}
+        start_gen = start_key = None
+        if len(entries) == 1:
+            # at this point, `doc` has arrived from the other syncing party,
+            # and we will decide what to do with it.
+            doc = entries[0][0]
+            result = self._put_doc_if_newer_with_update_handler(doc)
+            if result is not None:
+                states[0], doc.has_conflicts, trans_id, update_seq = result
+                if trans_id is not None:
+                    trans_ids[0] = trans_id
+                # the log is read from the first transaction committed after
+                # the update handler read the stored document
+                start_key = [update_seq + 1]
+                self._count_put_doc_if_newer_path('update_handler')
+            else:
+                self._count_put_doc_if_newer_path('fallback')
+        pending = [i for i, state in enumerate(states) if state is None]
+        if pending:
+            start_gen, rows = self._query_transaction_log(
+                descending='true', limit=1)
+            start_key = rows[0]['key'] if rows else None
+        # fetch current versions of all documents
+        cur_docs = []
+        for docs in self._get_docs_in_bulk(
+                [entries[i][0].doc_id for i in pending], True):
+            cur_docs.extend(docs)
+        # compare revisions and collect the documents to be written
+        to_put = []
+        for i, cur_doc in izip(pending, cur_docs):
+            old_doc = entries[i][0]
+            doc = self._factory(
+                old_doc.doc_id, old_doc.rev, old_doc.get_json())
+            states[i], put = self._prepare_doc_if_newer(
+                doc, cur_doc, save_conflict)
+            if put:
+                to_put.append((i, cur_doc, doc))
+            else:
+                self._update_incoming_doc(old_doc, doc)
+        written = self._put_docs_in_bulk(
+            [(cur_doc, doc) for _, cur_doc, doc in to_put])
+        for (i, _, doc), trans_id in izip(to_put, written):
+            old_doc = entries[i][0]
+            if trans_id is not None:
+                trans_ids[i] = trans_id
+            while trans_id is None:
+                # the document was concurrently updated, so it is compared
+                # again to its current version and put on its own
+                cur_doc = self._get_doc(
+                    old_doc.doc_id, check_for_conflicts=True)
+                doc = self._factory(
+                    old_doc.doc_id, old_doc.rev, old_doc.get_json())
+                states[i], put = self._prepare_doc_if_newer(
+                    doc, cur_doc, save_conflict)
+                if not put:
+                    break
+                trans_id = self._put_docs_in_bulk([(cur_doc, doc)])[0]
+                if trans_id is not None:
+                    trans_ids[i] = trans_id
+            self._update_incoming_doc(old_doc, doc)
+        if replica_uid is not None:
+            self._set_replica_gens_and_trans_ids(
+                replica_uid, entries, number_of_docs, sync_id)
+        gens = {}
+        if trans_ids or start_gen is None:
+            offset, gens = self._get_generations_of(
+                trans_ids.values(), start_key)
+            if start_gen is None:
+                start_gen = offset
+        return [
+            (state, gens.get(trans_ids.get(i), start_gen))
+            for i, state in enumerate(states)]
+
+    def _get_generations_of(self, trans_ids, start_key):
+        """
+        Return the generations of transactions committed after some key of
+        the transaction log.
+
+        The transaction log is read with one request, from that key on.
+
+        :param trans_ids: The ids of the transactions.
+        :type trans_ids: list
+        :param start_key: The key, or None to read the whole log.
+        :type start_key: int or list
+
+        :return: The number of rows of the log before the key, and a
+                 dictionary mapping the ids of the transactions found in the
+                 log to their generations.
+        :rtype: (int, dict)
+        """
+        params = {}
+        if start_key is not None:
+            params['startkey'] = json.dumps(start_key)
+        if not trans_ids:
+            params['limit'] = 0
+        response = self._get_transaction_log_response(**params)
+        wanted = set(trans_ids)
+        gens = {}
+        for gen, row in enumerate(response['rows'], response['offset'] + 1):
+            trans_id = self._log_entry(row)[1]
+            if trans_id in wanted:
+                gens[trans_id] = gen
+        return response['offset'], gens
+
+    def _set_replica_gens_and_trans_ids(self, replica_uid, entries,
+                                        number_of_docs, sync_id):
+        """
+        Record the replica generation once for each run of consecutive
+        documents in a batch of incoming documents.
+
+        :param replica_uid: A unique replica identifier.
+        :type replica_uid: str
+        :param entries: A list of (doc, replica_gen, replica_trans_id,
+                        doc_idx) tuples for the incoming documents.
+        :type entries: list
+        :param number_of_docs: The total amount of documents sent on this sync
+                               session.
+        :type number_of_docs: int
+        :param sync_id: The id of the current sync session.
+        :type sync_id: str
+        """
+        entries = [e for e in entries if e[1] is not None]
+        if not entries:
+            return
+        if sync_id is None:
+            # there is no pending log, so only the last generation matters
+            _, gen, trans_id, doc_idx = max(entries, key=lambda e: e[1])
+            self._set_replica_gen_and_trans_id(
+                replica_uid, gen, trans_id, number_of_docs=number_of_docs,
+                doc_idx=doc_idx)
+            return
+        runs = []
+        for entry in sorted(entries, key=lambda e: e[3]):
+            last = runs[-1][-1] if runs else None
+            if last is not None and last[3] is not None \
+                    and entry[3] == last[3] + 1:
+                runs[-1].append(entry)
+            else:
+                runs.append([entry])
+        for run in runs:
+            _, gen, trans_id, doc_idx = run[-1]
+            self._set_replica_gen_and_trans_id(
+                replica_uid, gen, trans_id, number_of_docs=number_of_docs,
+                doc_idx=doc_idx, sync_id=sync_id, first_doc_idx=run[0][3])
+
+    def _prepare_doc_if_newer(self, doc, cur_doc, save_conflict):
+        """
+        Decide what to do with a document that has arrived from another
+        replica, given the current version of that document.
+
+        The incoming document is given the conflicts it should be stored
+        with, and possibly a new revision, but nothing is written to the
+        database.
+
+        :param doc: A copy of the incoming document.
+        :type doc: CouchDocument
+        :param cur_doc: The current version of the document, fetched with its
+                        conflicts, or None if it does not exist.
+        :type cur_doc: CouchDocument
+        :param save_conflict: If this document is a conflict, do you want to
+                              save it as a conflict, or just ignore it.
+        :type save_conflict: bool
+
+        :return: The state of the incoming document, as returned by
+                 _put_doc_if_newer(), and whether the document should be
+                 written over its current version.
+        :rtype: (str, bool)
+        """
+        # the conflicts of the current version will eventually be manipulated
         if cur_doc is not None:
             doc.couch_rev = cur_doc.couch_rev
-        # fetch conflicts because we will eventually manipulate them
-        doc._ensure_fetch_conflicts(self._get_conflicts)
+            doc.set_conflicts(list(cur_doc.get_conflicts() or []))
+        else:
+            doc.set_conflicts([])
         # from now on, it works just like u1db sqlite backend
         doc_vcr = vectorclock.VectorClockRev(doc.rev)
         if cur_doc is None:
             cur_vcr = vectorclock.VectorClockRev(None)
         else:
             cur_vcr = vectorclock.VectorClockRev(cur_doc.rev)
-        self._validate_source(replica_uid, replica_gen, replica_trans_id)
         if doc_vcr.is_newer(cur_vcr):
             rev = doc.rev
             self._prune_conflicts(doc, doc_vcr)
             if doc.rev != rev:
                 # conflicts have been autoresolved
-                state = 'superseded'
-            else:
-                state = 'inserted'
-            self._put_doc(cur_doc, doc)
+                return 'superseded', True
+            return 'inserted', True
         elif doc.rev == cur_doc.rev:
             # magical convergence
-            state = 'converged'
+            return 'converged', False
         elif cur_vcr.is_newer(doc_vcr):
             # Don't add this to seen_ids, because we have something newer,
             # so we should send it back, and we should not generate a
             # conflict
-            state = 'superseded'
+            return 'superseded', False
         elif cur_doc.same_content_as(doc):
             # the documents have been edited to the same thing at both ends
             doc_vcr.maximize(cur_vcr)
             doc_vcr.increment(self._replica_uid)
             doc.rev = doc_vcr.as_str()
-            self._put_doc(cur_doc, doc)
-            state = 'superseded'
-        else:
-            state = 'conflicted'
-            if save_conflict:
-                self._force_doc_sync_conflict(doc)
-        if replica_uid is not None and replica_gen is not None:
-            self._set_replica_gen_and_trans_id(
-                replica_uid, replica_gen, replica_trans_id,
-                number_of_docs=number_of_docs, doc_idx=doc_idx,
-                sync_id=sync_id)
-        # update info
+            return 'superseded', True
+        if save_conflict:
+            # keep the current version as a conflict of the incoming one
+            self._prune_conflicts(doc, doc_vcr)
+            self._add_conflict(doc, cur_doc.rev, cur_doc.get_json())
+            doc.has_conflicts = True
+        return 'conflicted', save_conflict
+
+    def _update_incoming_doc(self, old_doc, doc):
+        """
+        Update an incoming document with the outcome of putting it.
+
+        :param old_doc: The incoming document.
+        :type old_doc: CouchDocument
+        :param doc: The copy of the incoming document that was put.
+        :type doc: CouchDocument
+        """
         old_doc.rev = doc.rev
         if doc.is_tombstone():
             old_doc.is_tombstone()
         else:
             old_doc.content = doc.content
         old_doc.has_conflicts = doc.has_conflicts
-        return state, self._get_generation()
 
     def get_docs(self, doc_ids, check_for_conflicts=True,
                  include_deleted=False):
@@ -1458,34 +2234,46 @@ class CouchDatabase(CommonBackend):
                                 returned with empty content. Otherwise deleted
                                 documents will not be included in the results.
         :return: iterable giving the Document object for each document id
-                 in matching doc_ids order.
+                 in matching doc_ids order. Documents are fetched in batches
+                 of BULK_GET_BATCH_SIZE, each one with a single request.
         :rtype: iterable
         """
-        # Workaround for:
-        #
-        #   http://bugs.python.org/issue7980
-        #   https://leap.se/code/issues/5449
-        #
-        # python-couchdb uses time.strptime, which is not thread safe. In
-        # order to avoid the problem described on the issues above, we preload
-        # strptime here by evaluating the conversion of an arbitrary date.
-        # This will not be needed when/if we switch from python-couchdb to
-        # paisley.
-        time.strptime('Mar 8 1917', '%b %d %Y')
-        # spawn threads to retrieve docs
-        threads = []
-        for doc_id in doc_ids:
-            self._sem_pool.acquire()
-            t = self._GetDocThread(self, doc_id, check_for_conflicts,
-                                   self._sem_pool.release)
-            t.start()
-            threads.append(t)
-        # join threads and yield docs
-        for t in threads:
-            t.join()
-            if t._doc.is_tombstone() and not include_deleted:
-                continue
-            yield t._doc
+        for docs in self._get_docs_in_bulk(doc_ids, check_for_conflicts):
+            for doc in docs:
+                if doc is None:
+                    continue
+                if doc.is_tombstone() and not include_deleted:
+                    continue
+                yield doc
+
+    def _get_docs_in_bulk(self, doc_ids, check_for_conflicts):
+        """
+        Fetch documents in batches, each one with a single bulk request.
+
+        :param doc_ids: A list of document identifiers.
+        :type doc_ids: list
+        :param check_for_conflicts: If set to False, then the conflict check
+                                    will be skipped.
+        :type check_for_conflicts: bool
+
+        :return: An iterator over lists with one document for each document
+                 id of a batch, or None if the document does not exist.
+        :rtype: generator
+        """
+        doc_ids = list(doc_ids)
+        resource = self._database.resource('_all_docs')
+        for i in xrange(0, len(doc_ids), self.BULK_GET_BATCH_SIZE):
+            batch = doc_ids[i:i + self.BULK_GET_BATCH_SIZE]
+            _, _, data = resource.post_json(
+                body={'keys': batch}, include_docs=True, attachments=True)
+            docs = []
+            for row in data['rows']:
+                if row.get('doc') is None:  # missing or deleted in couch
+                    docs.append(None)
+                else:
+                    docs.append(self._doc_from_couch_doc(
+                        row['id'], row['doc'], check_for_conflicts))
+            yield docs
 
     def _new_resource(self, *path):
         """
@@ -1496,7 +2284,7 @@ class CouchDatabase(CommonBackend):
         """
         # Workaround for: https://leap.se/code/issues/5448
         url = couch_urljoin(self._database.resource.url, *path)
-        resource = Resource(url, Session(timeout=COUCH_TIMEOUT))
+        resource = Resource(url, self._session)
         resource.credentials = self._database.resource.credentials
         resource.headers = self._database.resource.headers.copy()
         return resource
@@ -1524,12 +2312,91 @@ class CouchSyncTarget(CommonSyncTarget):
             source_replica_transaction_id)
 
 
+class CouchDatabaseCache(object):
+    """
+    A bounded cache of open database handles.
+
+    Handles are shared by concurrent requests, and are discarded when they
+    have not been used for some time or when the least recently used handle
+    has to make room for a new one.
+    """
+
+    def __init__(self, max_size=MAX_OPEN_DATABASES, ttl=OPEN_DATABASE_TTL):
+        """
+        Initialize the database cache.
+
+        :param max_size: The maximum number of handles to keep.
+        :type max_size: int
+        :param ttl: The time (in seconds) after which an unused handle is
+                    discarded.
+        :type ttl: int
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, dbname, open_database):
+        """
+        Return the handle of a database, opening it if it is not cached.
+
+        :param dbname: The name of the database.
+        :type dbname: str
+        :param open_database: A function which, given the name of the
+                              database, opens and returns its handle.
+        :type open_database: function
+
+        :return: The database handle.
+        :rtype: CouchDatabase
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._handles.pop(dbname, None)
+            if entry is not None:
+                self._handles[dbname] = (entry[0], now)
+                return entry[0]
+        # open the database without holding the lock
+        db = open_database(dbname)
+        with self._lock:
+            self._handles.pop(dbname, None)
+            self._handles[dbname] = (db, now)
+            while len(self._handles) > self._max_size:
+                self._handles.popitem(last=False)
+        return db
+
+    def clear(self):
+        """
+        Forget about all database handles.
+        """
+        with self._lock:
+            self._handles.clear()
+
+    def _expire(self, now):
+        """
+        Discard the handles that have not been used for longer than the ttl.
+
+        Handles are kept in order of use, so only the oldest ones have to be
+        checked.
+
+        :param now: The current time.
+        :type now: float
+        """
+        while self._handles:
+            dbname, (_, last_used) = next(self._handles.iteritems())
+            if now - last_used <= self._ttl:
+                break
+            del self._handles[dbname]
+
+
 class CouchServerState(ServerState):
     """
     Inteface of the WSGI server with the CouchDB backend.
     """
 
-    def __init__(self, couch_url, shared_db_name, tokens_db_name):
+    def __init__(self, couch_url, shared_db_name, tokens_db_name,
+                 max_open_databases=MAX_OPEN_DATABASES,
+                 open_database_ttl=OPEN_DATABASE_TTL):
         """
         Initialize the couch server state.
 
@@ -1539,15 +2406,38 @@ class CouchServerState(ServerState):
         :type shared_db_name: str
         :param tokens_db_name: The name of the tokens database.
         :type tokens_db_name: str
+        :param max_open_databases: The maximum number of database handles
+                                   kept open.
+        :type max_open_databases: int
+        :param open_database_ttl: The time (in seconds) after which an unused
+                                  database handle is discarded.
+        :type open_database_ttl: int
         """
         self._couch_url = couch_url
         self._shared_db_name = shared_db_name
         self._tokens_db_name = tokens_db_name
+        self._databases = CouchDatabaseCache(
+            max_size=max_open_databases, ttl=open_database_ttl)
 
     def open_database(self, dbname):
         """
         Open a couch database.
 
+        Database handles are cached, so the existence of a database is only
+        checked when its handle is not cached.
+
+        :param dbname: The name of the database to open.
+        :type dbname: str
+
+        :return: The CouchDatabase object.
+        :rtype: CouchDatabase
+        """
+        return self._databases.get(dbname, self._open_database)
+
+    def _open_database(self, dbname):
+        """
+        Create a new handle for a couch database.
+
         :param dbname: The name of the database to open.
         :type dbname: str
 
@@ -1598,6 +2488,8 @@ class CouchServerState(ServerState):
         :type url: str
         """
         self._couch_url = url
+        # handles for the previous URL must not be used anymore
+        self._databases.clear()
 
     def _get_couch_url(self):
         """
@@ -21,6 +21,9 @@ Soledad common crypto bits.
 """
 
 
+import binascii
+
+
 #
 # Encryption schemes used for encryption.
 #
@@ -74,3 +77,59 @@ ENC_METHOD_KEY = '_enc_method'
 ENC_IV_KEY = '_enc_iv'
 MAC_KEY = '_mac'
 MAC_METHOD_KEY = '_mac_method'
+
+
+#
+# Versions of the encrypted document format.
+#
+# In version 1, the ciphertext is stored as hexadecimal in the ENC_JSON_KEY
+# field of the document's content. In version 2, the content holds only the
+# encryption and MAC metadata, and the ciphertext is kept as raw bytes apart
+# from it (for example, as a couch attachment or as the payload of a binary
+# sync frame).
+#
+
+ENC_VERSION_KEY = '_enc_version'
+ENC_VERSION_1 = 1
+ENC_VERSION_2 = 2
+
+
+def split_encrypted_content(content):
+    """
+    Split a symmetrically encrypted content in version 1 format into its
+    metadata in version 2 format and its raw ciphertext.
+
+    :param content: The document's content.
+    :type content: dict
+
+    :return: The metadata and the raw ciphertext, or (None, None) if the
+             content is not a symmetrically encrypted content in version 1
+             format.
+    :rtype: tuple(dict, str)
+    """
+    if not content or ENC_JSON_KEY not in content \
+            or content.get(ENC_SCHEME_KEY) != EncryptionSchemes.SYMKEY:
+        return None, None
+    metadata = dict(content)
+    ciphertext = binascii.a2b_hex(metadata.pop(ENC_JSON_KEY))
+    metadata[ENC_VERSION_KEY] = ENC_VERSION_2
+    return metadata, ciphertext
+
+
+def join_encrypted_content(metadata, ciphertext):
+    """
+    Build a symmetrically encrypted content in version 1 format from its
+    metadata in version 2 format and its raw ciphertext.
+
+    :param metadata: The encryption and MAC metadata.
+    :type metadata: dict
+    :param ciphertext: The raw ciphertext.
+    :type ciphertext: str
+
+    :return: The document's content.
+    :rtype: dict
+    """
+    content = dict(metadata)
+    content.pop(ENC_VERSION_KEY, None)
+    content[ENC_JSON_KEY] = binascii.b2a_hex(ciphertext)
+    return content
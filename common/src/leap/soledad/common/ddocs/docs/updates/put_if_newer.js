@@ -0,0 +1,127 @@
+/**
+ * This update function puts an incoming U1DB document if its revision is
+ * newer than the revision of the stored document, so a document arriving
+ * during a sync can be inserted with a single request.
+ *
+ * The request body has the following structure:
+ *
+ *     {
+ *         'u1db_rev': '<incoming revision>',
+ *         'u1db_enc': {<encryption metadata>},
+ *         'content': '<base64 encoded content>',
+ *         'trans_id': '<trans_id>'
+ *     }
+ *
+ * where 'u1db_enc' is only present for encrypted documents and 'content' is
+ * null for deleted documents. The document that logs the transaction is
+ * written by the caller, once the incoming document has been inserted.
+ *
+ * The response is a JSON object with the state of the incoming document
+ * ('inserted', 'superseded' or 'converged'), whether the stored document
+ * has conflicts, and the update sequence of the database when the stored
+ * document was read. Contents and conflicts are stored as attachments, which
+ * are not available to update functions, so when the decision depends on
+ * them nothing is written and the state is null. The caller then has to
+ * compare the documents by itself.
+ */
+function(doc, req){
+
+    // expand a revision into a map of replica uids to counters
+    var expand = function(rev) {
+        var values = {};
+        if (rev == null)
+            return values;
+        var parts = rev.split('|');
+        for (var i = 0; i < parts.length; i++) {
+            var pair = parts[i].split(':');
+            values[pair[0]] = parseInt(pair[1]);
+        }
+        return values;
+    };
+
+    var is_empty = function(values) {
+        for (var key in values)
+            return false;
+        return true;
+    };
+
+    // tell if a vector clock is strictly newer than another one, just like
+    // u1db.vectorclock.VectorClockRev.is_newer()
+    var is_newer = function(values, other) {
+        if (is_empty(values))
+            return false;
+        if (is_empty(other))
+            return true;
+        var this_is_newer = false;
+        for (var key in values) {
+            if (key in other) {
+                if (other[key] > values[key])
+                    return false;
+                if (other[key] < values[key])
+                    this_is_newer = true;
+            } else {
+                this_is_newer = true;
+            }
+        }
+        for (var key in other)
+            if (!(key in values))
+                return false;
+        return this_is_newer;
+    };
+
+    var respond = function(state, has_conflicts) {
+        return {
+            'headers': {'Content-Type': 'application/json'},
+            'body': JSON.stringify({
+                'state': state,
+                'has_conflicts': has_conflicts,
+                'update_seq': req.info.update_seq,
+            }),
+        };
+    };
+
+    var body = JSON.parse(req.body);
+    var rev = body['u1db_rev'];
+
+    // leave documents not stored by U1DB to the caller
+    if (doc != null && doc.u1db_rev == null)
+        return [null, respond(null, false)];
+
+    var cur_rev = doc != null ? doc.u1db_rev : null;
+    var has_conflicts = doc != null && doc._attachments != null
+        && doc._attachments.u1db_conflicts != null;
+    var values = expand(rev);
+    var cur_values = expand(cur_rev);
+
+    if (is_newer(values, cur_values)) {
+        // conflicts would have to be pruned
+        if (has_conflicts)
+            return [null, respond(null, true)];
+        if (doc == null)
+            doc = {'_id': req.id};
+        doc.u1db_rev = rev;
+        doc.u1db_trans_id = body['trans_id'];
+        if (body['u1db_enc'] != null)
+            doc.u1db_enc = body['u1db_enc'];
+        else
+            delete doc.u1db_enc;
+        doc._attachments = {};
+        if (body['content'] != null)
+            doc._attachments.u1db_content = {
+                'content_type': 'application/octet-stream',
+                'data': body['content'],
+            };
+        return [doc, respond('inserted', false)];
+    }
+
+    // magical convergence
+    if (rev == cur_rev)
+        return [null, respond('converged', has_conflicts)];
+
+    // we have something newer
+    if (is_newer(cur_values, values))
+        return [null, respond('superseded', has_conflicts)];
+
+    // contents have to be compared to tell a conflict
+    return [null, respond(null, has_conflicts)];
+}
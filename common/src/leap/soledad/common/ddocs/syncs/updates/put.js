@@ -14,7 +14,8 @@
  *         'pending': {
  *             'other_replica_uid': {
  *                 'sync_id': '<sync_id>',
- *                 'log': [[<gen>, '<trans_id>'], ...]
+ *                 'log': [[<gen>, '<trans_id>', <doc_idx>,
+ *                          <first_doc_idx>], ...]
  *             },
  *             ...
  *         }
@@ -30,7 +31,10 @@
  *      replica was interrupted and discard all pending data.
  *
  *   2. Then we append incoming info as pending data for that source replica
- *      and current sync_id, and sort the pending data by generation.
+ *      and current sync_id, and sort the pending data by generation. The
+ *      incoming info may stand for a run of consecutive documents, from
+ *      first_doc_idx to doc_idx, when the generation is recorded once for a
+ *      batch of documents.
  *
  *   3. Then we go through pending data and find the most recent generation
  *      that we can use to update the actual sync log.
@@ -54,18 +58,29 @@ function(doc, req){
     var sync_id = body['sync_id'];
     var number_of_docs = body['number_of_docs'];
     var doc_idx = body['doc_idx'];
+    var first_doc_idx = body['first_doc_idx'];
 
     // parse integers
     if (number_of_docs != null)
         number_of_docs = parseInt(number_of_docs);
     if (doc_idx != null)
         doc_idx = parseInt(doc_idx);
+    if (first_doc_idx != null)
+        first_doc_idx = parseInt(first_doc_idx);
+    else
+        first_doc_idx = doc_idx;
 
     if (other_replica_uid == null
             || other_generation == null
             || other_transaction_id == null)
         return [null, 'invalid data'];
 
+    // pending entries stored before runs of documents were recorded at once
+    // only hold the index of one document
+    var first_idx = function(entry) {
+        return entry[3] != null ? entry[3] : entry[2];
+    };
+
     // create slot for pending logs
     if (doc['pending'] == null)
         doc['pending'] = {};
@@ -94,6 +109,7 @@ function(doc, req){
             other_generation,
             other_transaction_id,
             doc_idx,
+            first_doc_idx,
         ])
 
         // sort pending log according to generation
@@ -103,7 +119,8 @@ function(doc, req){
 
         // get most up-to-date information from pending log
         var last_doc_idx = doc['pending'][other_replica_uid]['last_doc_idx'];
-        var pending_idx = doc['pending'][other_replica_uid]['log'][0][2];
+        var pending_idx = first_idx(
+            doc['pending'][other_replica_uid]['log'][0]);
 
         current_gen = null;
         current_trans_id = null;
@@ -115,7 +132,8 @@ function(doc, req){
             last_doc_idx = pending[2]
             if (doc['pending'][other_replica_uid]['log'].length == 0)
                 break;
-            pending_idx = doc['pending'][other_replica_uid]['log'][0][2];
+            pending_idx = first_idx(
+                doc['pending'][other_replica_uid]['log'][0]);
         }
 
         // leave the sync log untouched if we still did not receive enough docs
@@ -1,7 +1,22 @@
 function(doc) {
+    // transactions kept in a document by older versions
     if (doc.u1db_transactions)
         doc.u1db_transactions.forEach(function(t) {
-            emit(t[0],  // use timestamp as key so the results are ordered
+            emit(t[0],  // use timestamp as key so results are ordered
                  t[1]); // value is the transaction_id
         });
+    // a transaction logged in a document of its own, which is never updated
+    if (doc.u1db_log)
+        emit([doc._local_seq],  // use the sequence number of the log document
+                                // in the database as key, so results are
+                                // ordered as they were committed and come
+                                // after the timestamped ones
+             doc.u1db_log);     // value is the transaction_id and doc_id
+    // transactions of log documents merged when the history was compacted,
+    // which keep their keys
+    if (doc.u1db_log_chunk)
+        doc.u1db_log_chunk.forEach(function(t) {
+            emit(t[0],
+                 [t[1], t[2]]); // value is the transaction_id and doc_id
+        });
 }
@@ -119,6 +119,22 @@ class CouldNotObtainLockError(SoledadError):
     status = 500
 
 
+#
+# Sync errors
+#
+
+@register_exception
+class SyncSessionExpiredError(SoledadError):
+    """
+    Raised when the client continues a sync session that the server does not
+    know about, either because it has expired or because it has never been
+    started.
+    """
+
+    wire_description = "sync session expired"
+    status = 410
+
+
 #
 # CouchDatabase errors
 #
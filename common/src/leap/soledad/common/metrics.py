@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# metrics.py
+# Copyright (C) 2014 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Counters and histograms of the Soledad server.
+
+Metrics are kept in memory by a process wide registry. Recording a value is a
+dictionary update under a lock, so instrumented code pays little when nobody
+reads the metrics.
+
+Besides process wide metrics, values may be added up for the request being
+handled by the current thread (for example, the number of couch requests it
+made), and are recorded as histograms when the request ends.
+"""
+
+
+import threading
+import time
+
+
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+"""
+Upper bounds (in seconds) of the buckets of latency histograms.
+"""
+
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+"""
+Upper bounds of the buckets of histograms of counts.
+"""
+
+
+class Histogram(object):
+    """
+    A histogram of observed values.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Initialize the histogram.
+
+        :param buckets: The sorted upper bounds of the buckets.
+        :type buckets: tuple
+        """
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._count = 0
+        self._sum = 0
+
+    def observe(self, value):
+        """
+        Record one value.
+
+        :param value: The value.
+        :type value: float
+        """
+        self._counts[bisect_left(self._buckets, value)] += 1
+        self._count += 1
+        self._sum += value
+
+    def snapshot(self):
+        """
+        Return the current state of the histogram.
+
+        :return: The number of values, their sum and the cumulative number of
+                 values less than or equal to the upper bound of each bucket.
+        :rtype: dict
+        """
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + ('+Inf',), self._counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {'count': self._count, 'sum': self._sum, 'buckets': buckets}
+
+
+class Metrics(object):
+    """
+    A registry of counters and histograms.
+    """
+
+    def __init__(self):
+        """
+        Initialize the registry.
+        """
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._request = threading.local()
+
+    def increment(self, name, value=1):
+        """
+        Increment a counter.
+
+        :param name: The name of the counter.
+        :type name: str
+        :param value: The amount to increment the counter by.
+        :type value: int
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        """
+        Record a value in a histogram.
+
+        :param name: The name of the histogram.
+        :type name: str
+        :param value: The value.
+        :type value: float
+        :param buckets: The upper bounds of the buckets, used if the
+                        histogram does not exist yet.
+        :type buckets: tuple
+        """
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name):
+        """
+        Record the time spent in a block of code, both in a histogram and in
+        the values of the current request.
+
+        :param name: The name of the histogram.
+        :type name: str
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.observe(name, elapsed)
+            self.add_to_request(name, elapsed)
+
+    def start_request(self):
+        """
+        Start adding up values for the request handled by the current thread.
+        """
+        self._request.values = {}
+
+    def add_to_request(self, name, value, buckets=LATENCY_BUCKETS):
+        """
+        Add a value to the values of the request handled by the current
+        thread, if any.
+
+        :param name: The name of the value.
+        :type name: str
+        :param value: The amount to add.
+        :type value: float
+        :param buckets: The upper bounds of the buckets of the histogram the
+                        value is recorded in when the request ends.
+        :type buckets: tuple
+        """
+        values = getattr(self._request, 'values', None)
+        if values is not None:
+            total, _ = values.get(name, (0, buckets))
+            values[name] = (total + value, buckets)
+
+    def end_request(self):
+        """
+        Stop adding up values for the request handled by the current thread,
+        and record them in 'request.<name>' histograms.
+
+        :return: The values of the request.
+        :rtype: dict
+        """
+        values = getattr(self._request, 'values', None) or {}
+        self._request.values = None
+        for name, (value, buckets) in values.iteritems():
+            self.observe('request.%s' % name, value, buckets)
+        return dict((name, value) for name, (value, _) in values.iteritems())
+
+    def snapshot(self):
+        """
+        Return the current state of all counters and histograms.
+
+        :return: A dictionary with the 'counters' and 'histograms'.
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'histograms': dict(
+                    (name, histogram.snapshot())
+                    for name, histogram in self._histograms.iteritems()),
+            }
+
+    def reset(self):
+        """
+        Forget about all counters and histograms.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+METRICS = Metrics()
+"""
+The registry shared by the whole process.
+"""
@@ -24,11 +24,12 @@ import re
 import copy
 import shutil
 from base64 import b64decode
-from mock import Mock
+from mock import Mock, patch
 from urlparse import urljoin
 
 from u1db import errors as u1db_errors
 from couchdb.client import Server
+from couchdb.http import ServerError
 
 from leap.common.files import mkdir_p
 
@@ -36,6 +37,17 @@ from leap.soledad.common.tests import u1db_tests as tests
 from leap.soledad.common.tests.u1db_tests import test_backends
 from leap.soledad.common.tests.u1db_tests import test_sync
 from leap.soledad.common import couch, errors
+from leap.soledad.common.metrics import METRICS
+from leap.soledad.common.crypto import (
+    ENC_JSON_KEY,
+    ENC_SCHEME_KEY,
+    ENC_METHOD_KEY,
+    ENC_IV_KEY,
+    ENC_VERSION_KEY,
+    ENC_VERSION_2,
+    MAC_KEY,
+    MAC_METHOD_KEY,
+)
 import simplejson as json
 
 
@@ -207,9 +219,13 @@ def copy_couch_database_for_test(test, db):
         elif 'u1db_rev' in doc:
             new_doc = {
                 '_id': doc['_id'],
-                'u1db_transactions': doc['u1db_transactions'],
                 'u1db_rev': doc['u1db_rev']
             }
+            for key in ('u1db_transactions', 'u1db_trans_id'):
+                if key in doc:
+                    new_doc[key] = doc[key]
+            if 'u1db_enc' in doc:
+                new_doc['u1db_enc'] = doc['u1db_enc']
             attachments = []
             if ('u1db_conflicts' in doc):
                 new_doc['u1db_conflicts'] = doc['u1db_conflicts']
@@ -223,6 +239,13 @@ def copy_couch_database_for_test(test, db):
                 if (att is not None):
                     new_couch_db.put_attachment(new_doc, att,
                                                 filename=att_name)
+    # copy log docs in the order of the transaction log
+    for row in old_couch_db.view('transactions/log'):
+        if isinstance(row.value, list):
+            new_couch_db.save({
+                '_id': db.LOG_DOC_ID_PREFIX + row.value[0],
+                'u1db_log': row.value,
+            })
     # cleanup connections to prevent file descriptor leaking
     return new_db
 
@@ -529,65 +552,60 @@ class CouchDatabaseExceptionsTests(CouchDBTestCase):
             errors.MissingDesignDocError,
             self.db._do_set_replica_gen_and_trans_id, 1, 2, 3)
 
-    def test_missing_design_doc_functions_raises(self):
+    def test_transaction_log_does_not_need_list_functions(self):
         """
-        Test that all methods that access design documents list functions
-        will raise if the functions are not present.
+        Test that methods that query the transaction log work without list
+        functions on the transactions design document.
         """
         self.db = couch.CouchDatabase.open_database(
             urljoin('http://127.0.0.1:%d' % self.wrapper.port, 'test'),
             create=True,
             ensure_ddocs=True)
-        # erase views from _design/transactions
         transactions = self.db._database['_design/transactions']
-        transactions['lists'] = {}
-        self.db._database.save(transactions)
-        # _get_generation()
-        self.assertRaises(
-            errors.MissingDesignDocListFunctionError,
-            self.db._get_generation)
-        # _get_generation_info()
-        self.assertRaises(
-            errors.MissingDesignDocListFunctionError,
-            self.db._get_generation_info)
-        # _get_trans_id_for_gen()
-        self.assertRaises(
-            errors.MissingDesignDocListFunctionError,
-            self.db._get_trans_id_for_gen, 1)
-        # whats_changed()
+        self.assertNotIn('lists', transactions)
+        self.db.create_doc({'value': 1}, doc_id='doc-1')
+        self.db.create_doc({'value': 2}, doc_id='doc-2')
+        doc = self.db.get_doc('doc-1')
+        doc.content = {'value': 3}
+        self.db.put_doc(doc)
+        log = self.db._get_transaction_log()
+        self.assertEqual((3, log[2][1]), self.db._get_generation_info())
+        for gen in (1, 2, 3):
+            self.assertEqual(
+                log[gen - 1][1], self.db._get_trans_id_for_gen(gen))
         self.assertRaises(
-            errors.MissingDesignDocListFunctionError,
-            self.db.whats_changed)
+            u1db_errors.InvalidGeneration, self.db._get_trans_id_for_gen, 4)
+        self.assertEqual(
+            (3, log[2][1], [('doc-2', 2, log[1][1]), ('doc-1', 3, log[2][1])]),
+            self.db.whats_changed())
+        self.assertEqual(
+            (3, log[2][1], [('doc-1', 3, log[2][1])]),
+            self.db.whats_changed(2))
+        self.assertEqual((3, log[2][1], []), self.db.whats_changed(3))
 
-    def test_absent_design_doc_functions_raises(self):
+    def test_server_error_on_transaction_log_raises(self):
         """
-        Test that all methods that access design documents list functions
-        will raise if the functions are not present.
+        Test that server errors when querying the transaction log are
+        translated like for other design document queries.
         """
-        self.db = couch.CouchDatabase.open_database(
-            urljoin('http://127.0.0.1:%d' % self.wrapper.port, 'test'),
-            create=True,
-            ensure_ddocs=True)
-        # erase views from _design/transactions
-        transactions = self.db._database['_design/transactions']
-        del transactions['lists']
-        self.db._database.save(transactions)
-        # _get_generation()
-        self.assertRaises(
-            errors.MissingDesignDocListFunctionError,
-            self.db._get_generation)
-        # _get_generation_info()
-        self.assertRaises(
-            errors.MissingDesignDocListFunctionError,
-            self.db._get_generation_info)
-        # _get_trans_id_for_gen()
-        self.assertRaises(
-            errors.MissingDesignDocListFunctionError,
-            self.db._get_trans_id_for_gen, 1)
-        # whats_changed()
-        self.assertRaises(
-            errors.MissingDesignDocListFunctionError,
-            self.db.whats_changed)
+        resource = Mock()
+        resource.get_json.side_effect = ServerError(
+            (500, ('unknown_error', 'reason')))
+        with patch.object(self.db._database, 'resource',
+                          return_value=resource):
+            self.assertRaises(
+                errors.DesignDocUnknownError,
+                self.db._get_generation_info)
+            self.assertRaises(
+                errors.DesignDocUnknownError,
+                self.db._get_transaction_log)
+        resource.get_json.side_effect = ServerError(
+            (500, ('unnamed_error', 'reason')))
+        with patch.object(self.db._database, 'resource',
+                          return_value=resource):
+            self.assertRaises(
+                errors.MissingDesignDocListFunctionError,
+                self.db.whats_changed)
 
     def test_missing_design_doc_named_views_raises(self):
         """
@@ -672,4 +690,547 @@ class CouchDatabaseExceptionsTests(CouchDBTestCase):
             self.db._do_set_replica_gen_and_trans_id, 1, 2, 3)
 
 
+class CouchTransactionLogTests(CouchDBTestCase):
+
+    def setUp(self):
+        CouchDBTestCase.setUp(self)
+        self.db = couch.CouchDatabase.open_database(
+            urljoin('http://127.0.0.1:%d' % self.wrapper.port, 'test'),
+            create=True,
+            ensure_ddocs=True)
+
+    def tearDown(self):
+        self.db.delete_database()
+        self.db.close()
+
+    def _log_keys(self):
+        _, rows = self.db._query_transaction_log()
+        return [row['key'] for row in rows]
+
+    def test_transactions_are_logged_in_commit_order(self):
+        """
+        Test that transactions are logged in documents of their own, ordered
+        by their sequence numbers in the database.
+        """
+        doc = self.db.create_doc({'value': 1})
+        self.db.create_doc({'value': 2})
+        doc.content = {'value': 3}
+        self.db.put_doc(doc)
+        keys = self._log_keys()
+        self.assertEqual(3, len(keys))
+        self.assertEqual(sorted(keys), keys)
+        self.assertNotIn('u1db_transactions', self.db._database[doc.doc_id])
+        self.assertIsNone(self.db._database.get('u1db_sequence'))
+
+    def test_new_transactions_follow_timestamped_log(self):
+        """
+        Test that transactions kept in documents by older versions are still
+        ordered before new transactions.
+        """
+        self.db._database.save({
+            '_id': 'old-doc',
+            'u1db_rev': 'replica:1',
+            'u1db_transactions': [[1400000000000, 'T-old']],
+        })
+        self.db.create_doc({'value': 1}, doc_id='new-doc')
+        doc = self.db.get_doc('old-doc')
+        doc.content = {'value': 2}
+        self.db.put_doc(doc)
+        self.assertEqual(1400000000000, self._log_keys()[0])
+        self.assertEqual('T-old', self.db._get_trans_id_for_gen(1))
+        self.assertEqual(3, self.db._get_generation())
+        self.assertEqual(
+            [('new-doc', 2), ('old-doc', 3)],
+            [(doc_id, gen) for doc_id, gen, _ in self.db.whats_changed(1)[2]])
+
+    def test_interleaved_writers(self):
+        """
+        Test that a transaction committed after another writer has read the
+        generation does not take the place of the transactions it has seen.
+        """
+        other_db = couch.CouchDatabase(
+            'http://127.0.0.1:%d' % self.wrapper.port, 'test')
+        self.addCleanup(other_db.close)
+        self.db.create_doc({'value': 0}, doc_id='doc-0')
+        seen = []
+        update = self.db._database.update
+
+        def write_in_between(docs):
+            # the other writer commits while this one is writing
+            other_db.create_doc({'value': 2}, doc_id='doc-2')
+            seen.append(other_db._get_generation_info())
+            return update(docs)
+
+        with patch.object(
+                self.db._database, 'update', side_effect=write_in_between):
+            self.db.create_doc({'value': 1}, doc_id='doc-1')
+        gen, trans_id = seen[0]
+        self.assertEqual(2, gen)
+        self.assertEqual(trans_id, self.db._get_trans_id_for_gen(gen))
+        self.assertEqual(
+            ['doc-1'],
+            [doc_id for doc_id, _, _ in self.db.whats_changed(gen)[2]])
+        self.assertEqual(
+            [('doc-0', 1), ('doc-2', 2), ('doc-1', 3)],
+            [(doc_id, gen) for doc_id, gen, _ in self.db.whats_changed()[2]])
+
+
+class CouchBulkGetTests(CouchDBTestCase):
+
+    def setUp(self):
+        CouchDBTestCase.setUp(self)
+        self.db = couch.CouchDatabase.open_database(
+            urljoin('http://127.0.0.1:%d' % self.wrapper.port, 'test'),
+            create=True,
+            ensure_ddocs=True)
+        self.db.BULK_GET_BATCH_SIZE = 2
+
+    def tearDown(self):
+        self.db.delete_database()
+        self.db.close()
+
+    def test_get_docs_in_batches(self):
+        """
+        Test that documents are fetched in bulk, keeping their order.
+        """
+        for i in range(5):
+            self.db.create_doc({'value': i}, doc_id='doc-%d' % i)
+        self.db.delete_doc(self.db.get_doc('doc-2'))
+        doc_ids = ['doc-4', 'missing', 'doc-2', 'doc-0', 'doc-1', 'doc-3']
+        self.assertEqual(
+            ['doc-4', 'doc-0', 'doc-1', 'doc-3'],
+            [doc.doc_id for doc in self.db.get_docs(doc_ids)])
+        docs = list(self.db.get_docs(doc_ids, include_deleted=True))
+        self.assertEqual(
+            ['doc-4', 'doc-2', 'doc-0', 'doc-1', 'doc-3'],
+            [doc.doc_id for doc in docs])
+        self.assertTrue(docs[1].is_tombstone())
+        self.assertEqual({'value': 4}, docs[0].content)
+        self.assertEqual(4, len(self.db.get_all_docs()[1]))
+
+
+class CouchBulkPutTests(CouchDBTestCase):
+
+    def setUp(self):
+        CouchDBTestCase.setUp(self)
+        self.db = couch.CouchDatabase.open_database(
+            urljoin('http://127.0.0.1:%d' % self.wrapper.port, 'test'),
+            create=True,
+            ensure_ddocs=True)
+
+    def tearDown(self):
+        self.db.delete_database()
+        self.db.close()
+
+    def test_put_docs_if_newer(self):
+        """
+        Test that a batch of incoming documents is compared to the current
+        versions like one document at a time, and written with one bulk
+        request.
+        """
+        old = self.db.create_doc({'value': 'old'}, doc_id='old-doc')
+        other = self.db.create_doc({'value': 'other'}, doc_id='other-doc')
+        same = self.db.create_doc({'value': 'same'}, doc_id='same-doc')
+        entries = [
+            (couch.CouchDocument('new-doc', 'other:1', '{"value": 1}'),
+             1, 'T-1', 1),
+            (couch.CouchDocument(
+                'old-doc', old.rev + '|other:1', '{"value": 2}'),
+             2, 'T-2', 2),
+            (couch.CouchDocument('other-doc', 'other:1', '{"value": 3}'),
+             3, 'T-3', 3),
+            (couch.CouchDocument('same-doc', same.rev, '{"value": "same"}'),
+             4, 'T-4', 4),
+        ]
+        with patch.object(
+                self.db, '_put_docs_in_bulk',
+                wraps=self.db._put_docs_in_bulk) as put_docs_in_bulk:
+            results = self.db._put_docs_if_newer(
+                entries, save_conflict=False, replica_uid='other',
+                number_of_docs=4, sync_id='sync-id')
+        self.assertEqual(1, put_docs_in_bulk.call_count)
+        self.assertEqual(5, self.db._get_generation())
+        # written documents get the generations of their transactions, and
+        # the others the generation before the batch
+        self.assertEqual(
+            [('inserted', 4), ('inserted', 5), ('conflicted', 3),
+             ('converged', 3)],
+            results)
+        self.assertEqual({'value': 1}, self.db.get_doc('new-doc').content)
+        self.assertEqual({'value': 2}, self.db.get_doc('old-doc').content)
+        self.assertEqual(other.rev, self.db.get_doc('other-doc').rev)
+        self.assertEqual(
+            (4, 'T-4'), self.db._get_replica_gen_and_trans_id('other'))
+
+    def test_put_docs_if_newer_with_concurrent_writes(self):
+        """
+        Test that documents written by others during a batch do not change
+        the generations the documents of the batch are put at.
+        """
+        entries = [
+            (couch.CouchDocument('doc-%d' % i, 'other:1', '{}'),
+             i, 'T-%d' % i, i)
+            for i in (1, 2)]
+        set_replica_gens = self.db._set_replica_gens_and_trans_ids
+
+        def set_replica_gens_and_write(*args):
+            set_replica_gens(*args)
+            doc = self.db.get_doc('doc-1')
+            doc.content = {'value': 'concurrent'}
+            self.db.put_doc(doc)
+
+        with patch.object(
+                self.db, '_set_replica_gens_and_trans_ids',
+                side_effect=set_replica_gens_and_write):
+            results = self.db._put_docs_if_newer(
+                entries, save_conflict=False, replica_uid='other',
+                number_of_docs=2, sync_id='sync-id')
+        self.assertEqual(3, self.db._get_generation())
+        self.assertEqual([('inserted', 1), ('inserted', 2)], results)
+
+
+class CouchPutIfNewerUpdateHandlerTests(CouchDBTestCase):
+
+    def setUp(self):
+        CouchDBTestCase.setUp(self)
+        self.db = couch.CouchDatabase.open_database(
+            urljoin('http://127.0.0.1:%d' % self.wrapper.port, 'test'),
+            create=True,
+            ensure_ddocs=True)
+        METRICS.reset()
+
+    def tearDown(self):
+        METRICS.reset()
+        self.db.delete_database()
+        self.db.close()
+
+    def _path_count(self, path):
+        return METRICS.snapshot()['counters'].get(
+            'couch.put_doc_if_newer.%s' % path, 0)
+
+    def test_put_with_update_handler(self):
+        """
+        Test that documents whose revisions can be compared without their
+        contents are put with the update handler.
+        """
+        doc = couch.CouchDocument('doc', 'other:1', '{"value": 1}')
+        self.assertEqual(
+            ('inserted', 1),
+            self.db._put_doc_if_newer(doc, False, 'other', 1, 'T-1'))
+        doc = couch.CouchDocument('doc', 'other:1', '{"value": 1}')
+        self.assertEqual(
+            ('converged', 1),
+            self.db._put_doc_if_newer(doc, False, 'other', 2, 'T-2'))
+        self.assertEqual(2, self._path_count('update_handler'))
+        self.assertEqual(0, self._path_count('fallback'))
+        stored = self.db.get_doc('doc')
+        self.assertEqual('other:1', stored.rev)
+        self.assertEqual({'value': 1}, stored.content)
+
+    def _count_requests(self, fun, *args):
+        METRICS.reset()
+        result = fun(*args)
+        return result, sum(
+            count for name, count in METRICS.snapshot()['counters'].items()
+            if name.startswith('couch.requests.'))
+
+    def test_update_handler_requests(self):
+        """
+        Test that a document put with the update handler only takes requests
+        to validate the source, put the document, log its transaction if it
+        was inserted, record the source generation and read generations.
+        """
+        self.db.create_doc({'value': 0}, doc_id='other-doc')
+        self.db._put_doc_if_newer(
+            couch.CouchDocument('doc-0', 'other:1', '{}'),
+            False, 'other', 1, 'T-1')
+        doc = couch.CouchDocument('doc', 'other:1', '{"value": 1}')
+        self.assertEqual(
+            (('inserted', 3), 5),
+            self._count_requests(
+                self.db._put_doc_if_newer, doc, False, 'other', 2, 'T-2'))
+        doc = couch.CouchDocument('doc', 'other:1', '{"value": 1}')
+        self.assertEqual(
+            (('converged', 3), 4),
+            self._count_requests(
+                self.db._put_doc_if_newer, doc, False, 'other', 3, 'T-3'))
+        # nothing is logged for documents not inserted
+        self.assertEqual(3, self.db._get_generation())
+        self.assertEqual(
+            ('doc', self.db._database['doc']['u1db_trans_id']),
+            self.db._get_transaction_log()[-1])
+
+    def test_fall_back_to_comparing_contents(self):
+        """
+        Test that documents fall back to being compared on this side when
+        their contents are needed.
+        """
+        self.db.create_doc({'value': 'same'}, doc_id='doc')
+        doc = couch.CouchDocument('doc', 'other:1', '{"value": "same"}')
+        state, _ = self.db._put_doc_if_newer(doc, False, 'other', 1, 'T-1')
+        self.assertEqual('superseded', state)
+        self.assertEqual(1, self._path_count('fallback'))
+        self.assertEqual(0, self._path_count('update_handler'))
+
+    def test_fall_back_when_handler_is_missing(self):
+        """
+        Test that documents are still put on databases whose design documents
+        do not have the update handler.
+        """
+        ddoc = self.db._database['_design/docs']
+        del ddoc['updates']
+        self.db._database.save(ddoc)
+        doc = couch.CouchDocument('doc', 'other:1', '{"value": 1}')
+        state, _ = self.db._put_doc_if_newer(doc, False, 'other', 1, 'T-1')
+        self.assertEqual('inserted', state)
+        self.assertEqual(1, self._path_count('fallback'))
+        self.assertEqual({'value': 1}, self.db.get_doc('doc').content)
+
+
+class CouchDatabaseCacheTests(unittest.TestCase):
+    """
+    Tests for the cache of open database handles.
+    """
+
+    def test_handles_are_reused(self):
+        cache = couch.CouchDatabaseCache()
+        open_database = Mock(side_effect=lambda dbname: object())
+        db = cache.get('user-db', open_database)
+        self.assertIs(db, cache.get('user-db', open_database))
+        self.assertEqual(1, open_database.call_count)
+        cache.clear()
+        self.assertIsNot(db, cache.get('user-db', open_database))
+
+    def test_idle_handles_expire(self):
+        cache = couch.CouchDatabaseCache(ttl=60)
+        open_database = Mock(side_effect=lambda dbname: object())
+        with patch('time.time', return_value=1000):
+            db = cache.get('user-db', open_database)
+        with patch('time.time', return_value=1059):
+            self.assertIs(db, cache.get('user-db', open_database))
+        with patch('time.time', return_value=1120):
+            self.assertIsNot(db, cache.get('user-db', open_database))
+
+    def test_least_recently_used_handle_is_discarded(self):
+        cache = couch.CouchDatabaseCache(max_size=2)
+        open_database = Mock(side_effect=lambda dbname: object())
+        a = cache.get('a', open_database)
+        b = cache.get('b', open_database)
+        cache.get('a', open_database)
+        cache.get('c', open_database)
+        self.assertIs(a, cache.get('a', open_database))
+        self.assertIsNot(b, cache.get('b', open_database))
+
+
+class CouchEncryptedDocFormatTests(CouchDBTestCase):
+
+    def setUp(self):
+        CouchDBTestCase.setUp(self)
+        self.db = couch.CouchDatabase.open_database(
+            urljoin('http://127.0.0.1:%d' % self.wrapper.port, 'test'),
+            create=True,
+            ensure_ddocs=True)
+        self.ciphertext = '\x00\xffciphertext'
+        self.content = {
+            ENC_JSON_KEY: self.ciphertext.encode('hex'),
+            ENC_SCHEME_KEY: 'symkey',
+            ENC_METHOD_KEY: 'aes-256-ctr',
+            ENC_IV_KEY: 'iv',
+            MAC_KEY: '00',
+            MAC_METHOD_KEY: 'hmac',
+        }
+
+    def tearDown(self):
+        self.db.delete_database()
+        self.db.close()
+
+    def test_encrypted_content_stored_as_raw_bytes(self):
+        """
+        Test that encrypted contents are stored in version 2 format.
+        """
+        self.db.create_doc(self.content, doc_id='doc')
+        couch_doc = self.db._database.get('doc')
+        self.assertEqual(ENC_VERSION_2, couch_doc['u1db_enc'][ENC_VERSION_KEY])
+        self.assertNotIn(ENC_JSON_KEY, couch_doc['u1db_enc'])
+        self.assertEqual(
+            self.ciphertext,
+            self.db._database.get_attachment('doc', 'u1db_content').read())
+        self.assertEqual(self.content, self.db.get_doc('doc').content)
+
+    def test_version_1_doc_migrated_on_read(self):
+        """
+        Test that documents stored in version 1 format are rewritten in
+        version 2 format when read, without changing the generation.
+        """
+        with patch.object(
+                couch, 'split_encrypted_content',
+                return_value=(None, None)):
+            doc = self.db.create_doc(self.content, doc_id='doc')
+        self.assertNotIn('u1db_enc', self.db._database.get('doc'))
+        gen = self.db._get_generation()
+        self.db.MIGRATE_ENCRYPTED_DOCS_ON_READ = True
+        read_doc = self.db.get_doc('doc')
+        self.assertEqual(self.content, read_doc.content)
+        self.assertEqual(doc.rev, read_doc.rev)
+        self.assertIn('u1db_enc', self.db._database.get('doc'))
+        self.assertEqual(gen, self.db._get_generation())
+        # the document can still be updated
+        read_doc.content = {'key': 'value'}
+        self.db.put_doc(read_doc)
+        self.assertEqual({'key': 'value'}, self.db.get_doc('doc').content)
+
+    def test_version_1_doc_not_migrated_on_read_by_default(self):
+        """
+        Test that reading documents stored in version 1 format does not write
+        them, and that they are migrated when written.
+        """
+        with patch.object(
+                couch, 'split_encrypted_content',
+                return_value=(None, None)):
+            self.db.create_doc(self.content, doc_id='doc')
+        couch_rev = self.db._database.get('doc')['_rev']
+        doc = self.db.get_doc('doc')
+        self.assertEqual(self.content, doc.content)
+        self.db.get_docs(['doc'])
+        self.assertEqual(couch_rev, self.db._database.get('doc')['_rev'])
+        self.db.put_doc(doc)
+        self.assertIn('u1db_enc', self.db._database.get('doc'))
+
+    def test_migrate_encrypted_docs(self):
+        """
+        Test that version 1 documents are migrated offline, and that other
+        documents are left alone.
+        """
+        with patch.object(
+                couch, 'split_encrypted_content',
+                return_value=(None, None)):
+            for i in range(3):
+                self.db.create_doc(self.content, doc_id='doc-%d' % i)
+        self.db.create_doc({'key': 'value'}, doc_id='plain')
+        deleted = self.db.create_doc(self.content, doc_id='deleted')
+        self.db.delete_doc(deleted)
+        plain_rev = self.db._database.get('plain')['_rev']
+        gen = self.db._get_generation()
+        self.assertEqual(3, self.db.migrate_encrypted_docs(page_size=2))
+        for i in range(3):
+            self.assertIn(
+                'u1db_enc', self.db._database.get('doc-%d' % i))
+            self.assertEqual(
+                self.content, self.db.get_doc('doc-%d' % i).content)
+        self.assertEqual(plain_rev, self.db._database.get('plain')['_rev'])
+        self.assertEqual(gen, self.db._get_generation())
+        self.assertEqual(0, self.db.migrate_encrypted_docs())
+
+
+class CouchTransactionHistoryTests(CouchDBTestCase):
+
+    def setUp(self):
+        CouchDBTestCase.setUp(self)
+        self.db = couch.CouchDatabase.open_database(
+            urljoin('http://127.0.0.1:%d' % self.wrapper.port, 'test'),
+            create=True,
+            ensure_ddocs=True)
+
+    def tearDown(self):
+        self.db.delete_database()
+        self.db.close()
+
+    def test_transactions_are_logged_with_their_documents(self):
+        """
+        Test that each transaction is logged in a document of its own,
+        written with one request along with its document.
+        """
+        doc = self.db.create_doc({'value': 1}, doc_id='doc')
+        self.db.create_doc({'value': 1}, doc_id='other')
+        with patch.object(
+                self.db._database, 'update',
+                wraps=self.db._database.update) as update:
+            for value in (2, 3):
+                doc.content = {'value': value}
+                self.db.put_doc(doc)
+        self.assertEqual(2, update.call_count)
+        couch_doc = self.db._database.get('doc')
+        self.assertNotIn('u1db_transactions', couch_doc)
+        log = self.db._get_transaction_log()
+        self.assertEqual(('doc', couch_doc['u1db_trans_id']), log[-1])
+        self.assertEqual(['doc', 'other', 'doc', 'doc'], [d for d, _ in log])
+        self.assertEqual(4, self.db._get_generation())
+        self.assertEqual(
+            ['other', 'doc'],
+            [doc_id for doc_id, _, _ in self.db.whats_changed()[2]])
+
+    def test_conflicting_update_keeps_log(self):
+        """
+        Test that a document that cannot be updated does not change the
+        generations of the transactions already logged.
+        """
+        doc = self.db.create_doc({'value': 1}, doc_id='doc')
+        stale_doc = self.db._get_doc('doc', check_for_conflicts=True)
+        doc.content = {'value': 2}
+        self.db.put_doc(doc)
+        log = self.db._get_transaction_log()
+        stale_doc.content = {'value': 3}
+        self.assertRaises(
+            u1db_errors.RevisionConflict,
+            self.db._put_doc, stale_doc, stale_doc)
+        self.assertEqual(log, self.db._get_transaction_log()[:2])
+        self.assertEqual({'value': 2}, self.db.get_doc('doc').content)
+
+    def test_compaction_logs_transactions_of_documents(self):
+        """
+        Test that compaction logs the transactions of documents put by the
+        update handler whose log documents could not be written.
+        """
+        self.db.create_doc({'value': 1}, doc_id='other')
+        doc = couch.CouchDocument('doc', 'other:1', '{"value": 1}')
+        with patch.object(
+                self.db, '_save_log_docs', side_effect=ServerError(
+                    (500, ('unknown_error', 'reason')))):
+            self.assertRaises(
+                ServerError,
+                self.db._put_doc_if_newer, doc, False, 'other', 1, 'T-1')
+        self.assertEqual({'value': 1}, self.db.get_doc('doc').content)
+        self.assertEqual(1, self.db._get_generation())
+        self.assertEqual((0, 1), self.db.compact_transaction_history())
+        self.assertEqual((0, 0), self.db.compact_transaction_history())
+        self.assertEqual(
+            [('other', 1), ('doc', 2)],
+            [(doc_id, gen) for doc_id, gen, _ in self.db.whats_changed()[2]])
+
+    def _log_doc_ids(self):
+        return [
+            row.id for row in self.db._database.view('_all_docs')
+            if row.id.startswith(self.db.LOG_DOC_ID_PREFIX)]
+
+    def test_compaction_merges_log_docs(self):
+        """
+        Test that compaction merges log documents into chunk documents,
+        keeping generations and transaction ids.
+        """
+        doc = self.db.create_doc({'value': 0}, doc_id='doc')
+        for value in range(1, 5):
+            doc.content = {'value': value}
+            self.db.put_doc(doc)
+        self.db.create_doc({'value': 0}, doc_id='other')
+        log = self.db._get_transaction_log()
+        changes = self.db.whats_changed()
+        self.assertEqual((6, 0), self.db.compact_transaction_history(4))
+        self.assertEqual(log, self.db._get_transaction_log())
+        self.assertEqual(changes, self.db.whats_changed())
+        self.assertEqual(log[2][1], self.db._get_trans_id_for_gen(3))
+        log_doc_ids = self._log_doc_ids()
+        self.assertEqual(2, len(log_doc_ids))
+        self.assertTrue(all(
+            doc_id.startswith(self.db.LOG_CHUNK_DOC_ID_PREFIX)
+            for doc_id in log_doc_ids))
+        # new transactions are logged after the merged ones
+        doc.content = {'value': 5}
+        self.db.put_doc(doc)
+        self.assertEqual(log, self.db._get_transaction_log()[:6])
+        self.assertEqual((0, 0), self.db.compact_transaction_history(4))
+        self.assertEqual(
+            [('other', 6), ('doc', 7)],
+            [(doc_id, gen) for doc_id, gen, _ in self.db.whats_changed()[2]])
+
+
 load_tests = tests.load_with_scenarios
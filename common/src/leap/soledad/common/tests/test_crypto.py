@@ -21,10 +21,18 @@ import os
 import hashlib
 import binascii
 
+import simplejson as json
+
 from leap.soledad.client import crypto
 from leap.soledad.common.document import SoledadDocument
 from leap.soledad.common.tests import BaseSoledadTest
 from leap.soledad.common.crypto import WrongMac, UnknownMacMethod
+from leap.soledad.common.crypto import (
+    ENC_VERSION_KEY,
+    ENC_VERSION_2,
+    split_encrypted_content,
+    join_encrypted_content,
+)
 
 
 class EncryptedSyncTestCase(BaseSoledadTest):
@@ -53,6 +61,27 @@ class EncryptedSyncTestCase(BaseSoledadTest):
         self.assertEqual(
             simpledoc, doc1.content, 'incorrect document encryption')
 
+    def test_decrypt_version_2_format(self):
+        """
+        Test decrypting documents whose ciphertext is kept apart from the
+        encryption metadata.
+        """
+        simpledoc = {'key': 'val'}
+        doc1 = SoledadDocument(doc_id='id')
+        doc1.content = simpledoc
+        doc1.set_json(crypto.encrypt_doc(self._soledad._crypto, doc1))
+        metadata, ciphertext = split_encrypted_content(doc1.content)
+        self.assertEqual(ENC_VERSION_2, metadata[ENC_VERSION_KEY])
+        self.assertFalse(crypto.ENC_JSON_KEY in metadata)
+        plainjson = crypto.decrypt_doc_dict(
+            metadata, doc1.doc_id, doc1.rev,
+            self._soledad._crypto.doc_passphrase(doc1.doc_id),
+            self._soledad._crypto.secret, ciphertext=ciphertext)
+        self.assertEqual(simpledoc, json.loads(plainjson))
+        # and back to version 1
+        self.assertEqual(
+            doc1.content, join_encrypted_content(metadata, ciphertext))
+
 
 class RecoveryDocumentTestCase(BaseSoledadTest):
 
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# test_metrics.py
+# Copyright (C) 2014 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Tests for server metrics.
+"""
+
+
+import simplejson as json
+
+from leap.soledad.common.metrics import Metrics, COUNT_BUCKETS
+from leap.soledad.common.tests import u1db_tests as tests
+from leap.soledad.server.metrics_middleware import MetricsMiddleware
+
+
+class MetricsTestCase(tests.TestCase):
+
+    def test_counters_and_histograms(self):
+        metrics = Metrics()
+        metrics.increment('requests')
+        metrics.increment('requests', 2)
+        metrics.observe('latency', 0.003)
+        metrics.observe('latency', 20)
+        snapshot = metrics.snapshot()
+        self.assertEqual({'requests': 3}, snapshot['counters'])
+        histogram = snapshot['histograms']['latency']
+        self.assertEqual(2, histogram['count'])
+        self.assertEqual(['+Inf', 2], histogram['buckets'][-1])
+        self.assertEqual([0.005, 1], histogram['buckets'][2])
+        metrics.reset()
+        self.assertEqual(
+            {'counters': {}, 'histograms': {}}, metrics.snapshot())
+
+    def test_request_values(self):
+        metrics = Metrics()
+        # values are ignored outside of requests
+        metrics.add_to_request('couch.calls', 1, COUNT_BUCKETS)
+        metrics.start_request()
+        for _ in range(3):
+            metrics.add_to_request('couch.calls', 1, COUNT_BUCKETS)
+        self.assertEqual({'couch.calls': 3}, metrics.end_request())
+        histogram = metrics.snapshot()['histograms']['request.couch.calls']
+        self.assertEqual(1, histogram['count'])
+        self.assertEqual(3, histogram['sum'])
+
+
+class MetricsMiddlewareTestCase(tests.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+        def app(environ, start_response):
+            self.metrics.add_to_request('couch.calls', 2, COUNT_BUCKETS)
+            start_response('200 OK', [])
+            return ['body']
+
+        self.middleware = MetricsMiddleware(app, metrics=self.metrics)
+
+    def _call(self, path, method='GET', remote_addr='127.0.0.1'):
+        environ = {
+            'PATH_INFO': path,
+            'REQUEST_METHOD': method,
+            'REMOTE_ADDR': remote_addr,
+        }
+        status = []
+
+        def start_response(status_line, headers, exc_info=None):
+            status.append(status_line)
+
+        body = ''.join(self.middleware(environ, start_response))
+        return status[0], body
+
+    def test_requests_are_recorded(self):
+        self.assertEqual(
+            ('200 OK', 'body'),
+            self._call('/user-uuid/sync-from/replica', 'POST'))
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(1, snapshot['counters']['requests.sync.POST'])
+        self.assertEqual(1, snapshot['counters']['responses.2xx'])
+        self.assertEqual(
+            1, snapshot['histograms']['latency.sync.POST']['count'])
+        self.assertEqual(
+            2, snapshot['histograms']['request.couch.calls']['sum'])
+
+    def test_metrics_are_only_served_locally(self):
+        self._call('/shared/lock/uuid', 'PUT')
+        status, body = self._call('/_metrics')
+        self.assertEqual('200 OK', status)
+        self.assertEqual(
+            1, json.loads(body)['counters']['requests.lock.PUT'])
+        status, _ = self._call('/_metrics', remote_addr='10.0.0.1')
+        self.assertEqual('404 Not Found', status)
+
+    def test_allowed_addresses(self):
+        self.middleware.allowed_addresses = ('10.0.0.1',)
+        status, _ = self._call('/_metrics', remote_addr='10.0.0.1')
+        self.assertEqual('200 OK', status)
+        status, _ = self._call('/_metrics')
+        self.assertEqual('404 Not Found', status)
+
+    def test_unknown_methods_are_grouped(self):
+        self._call('/user-uuid/doc/id', 'PROPFIND')
+        self._call('/user-uuid/doc/id', 'X-RANDOM')
+        counters = self.metrics.snapshot()['counters']
+        self.assertEqual(2, counters['requests.doc.other'])
+        self.assertNotIn('requests.doc.PROPFIND', counters)
@@ -18,11 +18,15 @@
 Tests for server-related functionality.
 """
 import os
+import pstats
+import signal
 import tempfile
 import simplejson as json
 import mock
 import time
 import binascii
+import zlib
+import cStringIO
 
 from urlparse import urljoin
 
@@ -42,8 +46,23 @@ from leap.soledad.common.tests.test_target_soledad import (
 )
 from leap.soledad.common.tests.test_sync_target import token_leap_sync_target
 from leap.soledad.client import Soledad, crypto
-from leap.soledad.server import LockResource
-from leap.soledad.server.auth import URLToAuthorization
+from leap.soledad.server import (
+    LockResource,
+    ReloadingApplication,
+    _DecodedInput,
+)
+from leap.soledad.server.auth import (
+    URLToAuthorization,
+    SoledadTokenAuthMiddleware,
+)
+from leap.soledad.common.errors import InvalidAuthTokenError
+from leap.soledad.server.sync import SyncSessions
+from leap.soledad.server.sync_state import (
+    CouchSyncStateStore,
+    MemorySyncStateStore,
+)
+from leap.soledad.server.gzip_middleware import GzipMiddleware
+from leap.soledad.server.profiler_middleware import ProfilerMiddleware
 
 
 # monkey path CouchServerState so it can ensure databases.
@@ -265,6 +284,586 @@ class ServerAuthorizationTestCase(BaseLeapTest):
             authmap.is_authorized(
                 self._make_environ('/%s/sync-from/x' % dbname, 'POST')))
 
+    def test_verify_action_with_other_uuid(self):
+        """
+        Test if authorization fails for resources of other users.
+        """
+        authmap = URLToAuthorization('myuuid')
+        self.assertTrue(
+            authmap.is_authorized(
+                self._make_environ('/shared/lock/myuuid', 'PUT')))
+        self.assertFalse(
+            authmap.is_authorized(
+                self._make_environ('/shared/lock/otheruuid', 'PUT')))
+        self.assertFalse(
+            authmap.is_authorized(
+                self._make_environ('/user-otheruuid', 'GET')))
+        self.assertFalse(
+            authmap.is_authorized(
+                self._make_environ('/user-otheruuid/sync-from/x', 'POST')))
+
+    def test_verify_action_with_trailing_newline(self):
+        """
+        Test if authorization fails for paths of authorized resources
+        followed by a newline.
+        """
+        authmap = URLToAuthorization('myuuid')
+        self.assertTrue(
+            authmap.is_authorized(self._make_environ('/shared', 'GET')))
+        self.assertFalse(
+            authmap.is_authorized(self._make_environ('/shared\n', 'GET')))
+        self.assertFalse(
+            authmap.is_authorized(self._make_environ('/\n', 'GET')))
+        self.assertFalse(
+            authmap.is_authorized(
+                self._make_environ('/shared/lock/myuuid\n', 'PUT')))
+        self.assertFalse(
+            authmap.is_authorized(
+                self._make_environ('/user-myuuid\n', 'GET')))
+
+
+class SyncSessionsTestCase(BaseLeapTest):
+    """
+    Tests for the in-memory cache of sync sessions.
+    """
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_put_and_get(self):
+        sessions = SyncSessions()
+        key = ('user-db', 'replica', 'sync-id')
+        self.assertIsNone(sessions.get(key))
+        sessions.put(key, 10)
+        self.assertEqual(10, sessions.get(key))
+        self.assertIsNone(sessions.get(('user-db', 'replica', 'other-id')))
+        sessions.clear()
+        self.assertIsNone(sessions.get(key))
+
+    def test_sessions_expire(self):
+        sessions = SyncSessions(ttl=60)
+        key = ('user-db', 'replica', 'sync-id')
+        with mock.patch('time.time', return_value=1000):
+            sessions.put(key, 10)
+        with mock.patch('time.time', return_value=1059):
+            self.assertEqual(10, sessions.get(key))
+        with mock.patch('time.time', return_value=1120):
+            self.assertIsNone(sessions.get(key))
+
+    def test_least_recently_used_session_is_discarded(self):
+        sessions = SyncSessions(max_sessions=2)
+        sessions.put('a', 1)
+        sessions.put('b', 2)
+        sessions.get('a')
+        sessions.put('c', 3)
+        self.assertEqual(1, sessions.get('a'))
+        self.assertIsNone(sessions.get('b'))
+        self.assertEqual(3, sessions.get('c'))
+
+
+class TokenCacheTestCase(BaseLeapTest):
+    """
+    Tests for the cache of token verification results.
+    """
+
+    def setUp(self):
+        SoledadTokenAuthMiddleware.token_cache.clear()
+        self.middleware = SoledadTokenAuthMiddleware(None)
+
+    def tearDown(self):
+        SoledadTokenAuthMiddleware.token_cache.clear()
+
+    def test_valid_token_is_verified_once(self):
+        with mock.patch.object(
+                self.middleware, '_verify_token_in_couch',
+                return_value=True) as verify:
+            with mock.patch('time.time', return_value=1000):
+                for _ in range(3):
+                    self.assertTrue(
+                        self.middleware._verify_authentication_data(
+                            'user-uuid', 'token'))
+            self.assertEqual(1, verify.call_count)
+            # the token is looked up again once its result expires
+            later = 1000 + SoledadTokenAuthMiddleware.TOKEN_CACHE_TTL
+            with mock.patch('time.time', return_value=later):
+                self.middleware._verify_authentication_data(
+                    'user-uuid', 'token')
+            self.assertEqual(2, verify.call_count)
+
+    def test_invalid_token_is_cached_for_less_time(self):
+        with mock.patch.object(
+                self.middleware, '_verify_token_in_couch',
+                side_effect=InvalidAuthTokenError()) as verify:
+            with mock.patch('time.time', return_value=1000):
+                for _ in range(2):
+                    self.assertRaises(
+                        InvalidAuthTokenError,
+                        self.middleware._verify_authentication_data,
+                        'user-uuid', 'token')
+            self.assertEqual(1, verify.call_count)
+            later = 1000 + SoledadTokenAuthMiddleware.INVALID_TOKEN_CACHE_TTL
+            with mock.patch('time.time', return_value=later):
+                self.assertRaises(
+                    InvalidAuthTokenError,
+                    self.middleware._verify_authentication_data,
+                    'user-uuid', 'token')
+            self.assertEqual(2, verify.call_count)
+
+    def test_errors_are_not_cached(self):
+        with mock.patch.object(
+                self.middleware, '_verify_token_in_couch',
+                side_effect=Exception()) as verify:
+            self.assertFalse(
+                self.middleware._verify_authentication_data(
+                    'user-uuid', 'token'))
+            self.assertFalse(
+                self.middleware._verify_authentication_data(
+                    'user-uuid', 'token'))
+            self.assertEqual(2, verify.call_count)
+
+
+class SyncStateStoreTests(object):
+    """
+    Tests that every sync state store must pass.
+    """
+
+    def test_seen_ids(self):
+        store = self.store
+        self.assertEqual({}, store.seen_ids(self.db, 'replica', 'sync-1'))
+        store.put_seen_id(self.db, 'replica', 'sync-1', 'doc-1', 1)
+        store.put_seen_id(self.db, 'replica', 'sync-1', 'doc-2', 2)
+        store.put_seen_id(self.db, 'replica', 'sync-1', 'doc-1', 3)
+        store.put_seen_id(self.db, 'replica', 'sync-2', 'doc-3', 4)
+        self.assertEqual(
+            {'doc-1': 3, 'doc-2': 2},
+            store.seen_ids(self.db, 'replica', 'sync-1'))
+
+    def test_put_seen_ids(self):
+        store = self.store
+        store.put_seen_ids(self.db, 'replica', 'sync-1', [])
+        store.put_seen_ids(
+            self.db, 'replica', 'sync-1', [('doc-1', 1), ('doc-2', 2)])
+        # documents sent again in the session are updated
+        store.put_seen_ids(
+            self.db, 'replica', 'sync-1', [('doc-1', 3), ('doc-3', 4)])
+        self.assertEqual(
+            {'doc-1': 3, 'doc-2': 2, 'doc-3': 4},
+            store.seen_ids(self.db, 'replica', 'sync-1'))
+
+    def test_changes_to_return(self):
+        store = self.store
+        self.assertEqual(
+            (None, None, None),
+            store.sync_info(self.db, 'replica', 'sync-1'))
+        changes = [('doc-%d' % i, i, 'T-%d' % i) for i in range(5)]
+        self.assertEqual(
+            (5, 'T-4', 5),
+            store.put_changes_to_return(
+                self.db, 'replica', 'sync-1', 5, 'T-4', changes))
+        # the changes stored first are kept
+        self.assertEqual(
+            (5, 'T-4', 5),
+            store.put_changes_to_return(
+                self.db, 'replica', 'sync-1', 6, 'T-5', changes[:1]))
+        self.assertEqual(
+            (5, 'T-4', 5), store.sync_info(self.db, 'replica', 'sync-1'))
+        self.assertEqual(
+            changes[2:4],
+            store.changes_to_return(self.db, 'replica', 'sync-1', 2, 2))
+        self.assertEqual(
+            [], store.changes_to_return(self.db, 'replica', 'sync-1', 5, 2))
+
+
+class MemorySyncStateStoreTestCase(BaseLeapTest, SyncStateStoreTests):
+    """
+    Tests for the in-memory sync state store.
+    """
+
+    def setUp(self):
+        self.store = MemorySyncStateStore()
+        self.db = mock.Mock(_dbname='user-db')
+
+    def tearDown(self):
+        pass
+
+    def test_states_expire(self):
+        store = MemorySyncStateStore(ttl=60)
+        with mock.patch('time.time', return_value=1000):
+            store.put_seen_id(self.db, 'replica', 'sync-1', 'doc-1', 1)
+        with mock.patch('time.time', return_value=1059):
+            self.assertEqual(
+                {'doc-1': 1}, store.seen_ids(self.db, 'replica', 'sync-1'))
+        with mock.patch('time.time', return_value=1120):
+            self.assertEqual(
+                {}, store.seen_ids(self.db, 'replica', 'sync-1'))
+
+
+class CouchSyncStateStoreTestCase(CouchDBTestCase, SyncStateStoreTests):
+    """
+    Tests for the sync state store that keeps the state in couch documents.
+    """
+
+    def setUp(self):
+        CouchDBTestCase.setUp(self)
+        self.store = CouchSyncStateStore()
+        self.db = CouchDatabase.open_database(
+            urljoin('http://127.0.0.1:%d' % self.wrapper.port, 'test'),
+            create=True,
+            ensure_ddocs=True)
+
+    def tearDown(self):
+        self.db.delete_database()
+        self.db.close()
+        CouchDBTestCase.tearDown(self)
+
+    def test_changes_to_return_span_pages(self):
+        store = self.store
+        store.CHANGES_PAGE_SIZE = 3
+        changes = [('doc-%d' % i, i, 'T-%d' % i) for i in range(10)]
+        store.put_changes_to_return(
+            self.db, 'replica', 'sync-1', 10, 'T-9', changes)
+        for start, limit in [(0, 1), (2, 4), (5, 100), (9, 1), (0, 10)]:
+            self.assertEqual(
+                changes[start:start + limit],
+                store.changes_to_return(
+                    self.db, 'replica', 'sync-1', start, limit))
+
+    def test_previous_sessions_are_deleted(self):
+        store = self.store
+        store.put_seen_id(self.db, 'replica', 'sync-1', 'doc-1', 1)
+        store.put_changes_to_return(self.db, 'replica', 'sync-1', 1, 'T', [])
+        store.put_seen_id(self.db, 'other', 'sync-1', 'doc-1', 1)
+        store.put_seen_id(self.db, 'replica', 'sync-2', 'doc-2', 2)
+        store.put_changes_to_return(self.db, 'replica', 'sync-2', 2, 'T', [])
+        self.assertEqual({}, store.seen_ids(self.db, 'replica', 'sync-1'))
+        self.assertEqual(
+            (None, None, None),
+            store.sync_info(self.db, 'replica', 'sync-1'))
+        self.assertEqual(
+            {'doc-2': 2}, store.seen_ids(self.db, 'replica', 'sync-2'))
+        self.assertEqual(
+            {'doc-1': 1}, store.seen_ids(self.db, 'other', 'sync-1'))
+
+    def test_sessions_of_replicas_sharing_a_prefix_are_kept(self):
+        store = self.store
+        store.put_seen_id(self.db, 'replica_other', 'sync-1', 'doc-1', 1)
+        store.put_changes_to_return(
+            self.db, 'replica_other', 'sync-1', 1, 'T', [])
+        store.put_seen_id(self.db, 'replica', 'sync_1', 'doc-2', 2)
+        store.put_changes_to_return(self.db, 'replica', 'sync_1', 2, 'T', [])
+        self.assertEqual(
+            {'doc-1': 1}, store.seen_ids(self.db, 'replica_other', 'sync-1'))
+        self.assertEqual(
+            (1, 'T', 0), store.sync_info(self.db, 'replica_other', 'sync-1'))
+        # a session whose id is a prefix of the previous one's
+        store.put_seen_id(self.db, 'replica', 'sync', 'doc-3', 3)
+        store.put_changes_to_return(self.db, 'replica', 'sync', 3, 'T', [])
+        self.assertEqual({}, store.seen_ids(self.db, 'replica', 'sync_1'))
+        self.assertEqual(
+            (None, None, None), store.sync_info(self.db, 'replica', 'sync_1'))
+        self.assertEqual(
+            {'doc-3': 3}, store.seen_ids(self.db, 'replica', 'sync'))
+
+    def test_seen_ids_are_stored_in_one_document_per_batch(self):
+        store = self.store
+        store.put_seen_ids(
+            self.db, 'replica', 'sync-1',
+            [('doc-%d' % i, i) for i in range(10)])
+        store.put_seen_ids(
+            self.db, 'replica', 'sync-1', [('doc-1', 11), ('doc-10', 12)])
+        prefix = store._seen_prefix('replica', 'sync-1')
+        rows = self.db._database.view(
+            '_all_docs', startkey=prefix, endkey=prefix + u'\ufff0')
+        self.assertEqual(2, len(rows))
+        seen = store.seen_ids(self.db, 'replica', 'sync-1')
+        self.assertEqual(11, len(seen))
+        self.assertEqual(11, seen['doc-1'])
+
+
+class GzipMiddlewareTestCase(BaseLeapTest):
+    """
+    Tests for the streaming gzip middleware.
+    """
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def _call(self, app, accept_encoding='gzip', **kwargs):
+        response = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = dict(headers)
+            return written.append
+
+        environ = {'HTTP_ACCEPT_ENCODING': accept_encoding}
+        chunks = list(GzipMiddleware(app, **kwargs)(environ, start_response))
+        return response, ''.join(written + chunks)
+
+    def _app(self, chunks, headers, written=()):
+        def app(environ, start_response):
+            write = start_response('200 OK', headers)
+            for data in written:
+                write(data)
+            return iter(chunks)
+        return app
+
+    def test_compresses_streamed_response(self):
+        chunks = ['{"entry": %d}\r\n' % i for i in range(1000)]
+        app = self._app(
+            chunks[500:], [('Content-Type', 'application/json')],
+            written=chunks[:500])
+        response, body = self._call(app)
+        self.assertEqual('gzip', response['headers']['Content-Encoding'])
+        self.assertNotIn('Content-Length', response['headers'])
+        self.assertEqual(
+            ''.join(chunks), zlib.decompress(body, 16 + zlib.MAX_WBITS))
+        self.assertTrue(len(body) < len(''.join(chunks)))
+
+    def test_skips_small_responses(self):
+        app = self._app(
+            ['{}'], [('Content-Type', 'application/json'),
+                     ('Content-Length', '2')])
+        response, body = self._call(app)
+        self.assertNotIn('Content-Encoding', response['headers'])
+        self.assertEqual('{}', body)
+
+    def test_skips_incompressible_types(self):
+        data = os.urandom(4096)
+        app = self._app(
+            [data], [('Content-Type', 'application/octet-stream'),
+                     ('Content-Length', str(len(data)))])
+        response, body = self._call(app)
+        self.assertNotIn('Content-Encoding', response['headers'])
+        self.assertEqual(data, body)
+
+    def test_skips_clients_not_accepting_gzip(self):
+        app = self._app(['x' * 4096], [('Content-Type', 'text/plain')])
+        response, body = self._call(app, accept_encoding='')
+        self.assertNotIn('Content-Encoding', response['headers'])
+        self.assertEqual('x' * 4096, body)
+
+
+class ReloadingApplicationTestCase(BaseLeapTest):
+    """
+    Tests for building the application stack once.
+    """
+
+    def setUp(self):
+        self.conf_path = os.path.join(
+            tempfile.mkdtemp(prefix="leap_tests-"), 'soledad-server.conf')
+        with open(self.conf_path, 'w') as f:
+            f.write('[soledad-server]\n')
+        self._call_from_thread = mock.patch(
+            'leap.soledad.server.reactor.callFromThread')
+        self.call_from_thread = self._call_from_thread.start()
+
+    def tearDown(self):
+        self._call_from_thread.stop()
+        os.remove(self.conf_path)
+        os.rmdir(os.path.dirname(self.conf_path))
+
+    def _make_stack(self, conf):
+        return mock.Mock(return_value=['body'])
+
+    def test_stack_is_built_once(self):
+        application = ReloadingApplication(self.conf_path)
+        with mock.patch('leap.soledad.server.make_application',
+                        side_effect=self._make_stack) as make:
+            for _ in range(3):
+                self.assertEqual(['body'], application({}, None))
+            self.assertEqual(1, make.call_count)
+            application.request_reload()
+            application({}, None)
+            self.assertEqual(2, make.call_count)
+
+    def test_stack_is_built_again_when_configuration_changes(self):
+        application = ReloadingApplication(self.conf_path, check_interval=0)
+        with mock.patch('leap.soledad.server.make_application',
+                        side_effect=self._make_stack) as make:
+            application({}, None)
+            application({}, None)
+            self.assertEqual(1, make.call_count)
+            mtime = os.stat(self.conf_path).st_mtime
+            os.utime(self.conf_path, (mtime + 10, mtime + 10))
+            application({}, None)
+            self.assertEqual(2, make.call_count)
+
+    def test_configuration_is_checked_once_per_interval(self):
+        application = ReloadingApplication(self.conf_path, check_interval=5)
+        with mock.patch('leap.soledad.server.make_application',
+                        side_effect=self._make_stack) as make:
+            with mock.patch('time.time', return_value=1000):
+                application({}, None)
+            mtime = os.stat(self.conf_path).st_mtime
+            os.utime(self.conf_path, (mtime + 10, mtime + 10))
+            with mock.patch('time.time', return_value=1004):
+                application({}, None)
+            self.assertEqual(1, make.call_count)
+            with mock.patch('time.time', return_value=1006):
+                application({}, None)
+                application({}, None)
+            self.assertEqual(2, make.call_count)
+
+    def test_signal_handlers_are_installed_when_stack_is_built(self):
+        application = ReloadingApplication(self.conf_path)
+        with mock.patch('leap.soledad.server.make_application',
+                        side_effect=self._make_stack) as make:
+            application({}, None)
+            application({}, None)
+        conf = make.call_args[0][0]
+        # handlers are installed from the reactor thread, once per build
+        self.call_from_thread.assert_called_once_with(
+            application.install_signal_handlers, conf)
+
+    def test_sigusr2_is_bound_only_when_profiling_is_configured(self):
+        application = ReloadingApplication(self.conf_path)
+        handlers = dict(
+            (signum, signal.getsignal(signum))
+            for signum in (signal.SIGHUP, signal.SIGUSR2))
+        try:
+            application.install_signal_handlers({'profile': 'false'})
+            self.assertEqual(
+                application.request_reload,
+                signal.getsignal(signal.SIGHUP))
+            self.assertEqual(signal.SIG_DFL, signal.getsignal(signal.SIGUSR2))
+            application.install_signal_handlers({'profile': 'true'})
+            self.assertEqual(
+                ProfilerMiddleware.toggle, signal.getsignal(signal.SIGUSR2))
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+
+class ProfilerMiddlewareTestCase(BaseLeapTest):
+    """
+    Tests for the profiling of requests.
+    """
+
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp(prefix="leap_tests-")
+
+    def tearDown(self):
+        ProfilerMiddleware.toggled = False
+        for name in os.listdir(self.profile_dir):
+            os.remove(os.path.join(self.profile_dir, name))
+        os.rmdir(self.profile_dir)
+
+    def _app(self, environ, start_response):
+        start_response('200 OK', [])
+        return ['body']
+
+    def _call(self, middleware, path='/user-uuid/sync-from/replica'):
+        environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'POST'}
+        return ''.join(middleware(environ, mock.Mock()))
+
+    def test_disabled(self):
+        middleware = ProfilerMiddleware(
+            self._app, rate=1, profile_dir=self.profile_dir,
+            flush_requests=1)
+        self.assertEqual('body', self._call(middleware))
+        self.assertEqual([], os.listdir(self.profile_dir))
+
+    def test_profiles_are_aggregated_and_rotated(self):
+        middleware = ProfilerMiddleware(
+            self._app, enabled=True, rate=1, profile_dir=self.profile_dir,
+            max_profiles=2, flush_requests=2)
+        for _ in range(6):
+            self.assertEqual('body', self._call(middleware))
+        names = os.listdir(self.profile_dir)
+        self.assertEqual(2, len(names))
+        for name in names:
+            self.assertTrue(name.endswith('-2.prof'))
+            pstats.Stats(os.path.join(self.profile_dir, name))
+
+    def test_filter_and_toggle(self):
+        middleware = ProfilerMiddleware(
+            self._app, enabled=True, rate=0, path_filter='user-uuid',
+            profile_dir=self.profile_dir, flush_requests=1)
+        self._call(middleware, '/user-other/sync-from/replica')
+        self.assertEqual([], os.listdir(self.profile_dir))
+        ProfilerMiddleware.toggle()
+        self._call(middleware)
+        self.assertEqual([], os.listdir(self.profile_dir))
+        ProfilerMiddleware.toggle()
+        self._call(middleware)
+        self.assertEqual(1, len(os.listdir(self.profile_dir)))
+
+    def test_profiles_are_written_when_switched_off(self):
+        middleware = ProfilerMiddleware(
+            self._app, enabled=True, rate=1, profile_dir=self.profile_dir,
+            flush_requests=10)
+        self._call(middleware)
+        self.assertEqual([], os.listdir(self.profile_dir))
+        ProfilerMiddleware.toggle()
+        self._call(middleware)
+        self.assertEqual(1, len(os.listdir(self.profile_dir)))
+
+    def test_write_errors_do_not_fail_requests(self):
+        # the profile directory cannot be created over a file
+        path = os.path.join(self.profile_dir, 'file')
+        open(path, 'w').close()
+        middleware = ProfilerMiddleware(
+            self._app, enabled=True, rate=1, profile_dir=path,
+            flush_requests=1)
+        self.assertEqual('body', self._call(middleware))
+        self.assertEqual(['file'], os.listdir(self.profile_dir))
+
+
+class DecodedInputTestCase(BaseLeapTest):
+    """
+    Tests for the decompression of encoded request bodies.
+    """
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def _input(self, data, encoding, max_size):
+        if encoding == 'gzip':
+            compressor = zlib.compressobj(
+                6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            compressor = zlib.compressobj()
+        body = compressor.compress(data) + compressor.flush()
+        return _DecodedInput(
+            cStringIO.StringIO(body), len(body), encoding, max_size)
+
+    def _read_all(self, rfile):
+        chunks = []
+        data = rfile.read(1000)
+        while data:
+            chunks.append(data)
+            data = rfile.read(1000)
+        return ''.join(chunks)
+
+    def test_decodes_body(self):
+        data = '\r\n'.join('{"entry": %d}' % i for i in range(5000))
+        for encoding in ('gzip', 'deflate'):
+            rfile = self._input(data, encoding, len(data))
+            self.assertEqual(data, self._read_all(rfile))
+
+    def test_limits_decoded_size(self):
+        from u1db.remote.http_app import BadRequest
+        rfile = self._input('x' * 100000, 'gzip', 50000)
+        self.assertRaises(BadRequest, self._read_all, rfile)
+
+    def test_rejects_malformed_body(self):
+        from u1db.remote.http_app import BadRequest
+        data = 'not compressed at all'
+        rfile = _DecodedInput(
+            cStringIO.StringIO(data), len(data), 'gzip', 1000)
+        self.assertRaises(BadRequest, rfile.read, 10)
+
 
 class EncryptedSyncTestCase(
         CouchDBTestCase, TestCaseWithServer):
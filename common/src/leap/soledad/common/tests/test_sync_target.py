@@ -303,24 +303,28 @@ class TestSoledadSyncTarget(
         self.patch(self.server.RequestHandlerClass, 'get_stderr',
                    blackhole_getstderr)
         db = self.request_state._create_database('test')
-        _put_doc_if_newer = db._put_doc_if_newer
+        _put_docs_if_newer = db._put_docs_if_newer
         trigger_ids = ['doc-here2']
 
-        def bomb_put_doc_if_newer(self, doc, save_conflict,
-                                  replica_uid=None, replica_gen=None,
-                                  replica_trans_id=None, number_of_docs=None,
-                                  doc_idx=None, sync_id=None):
-            if doc.doc_id in trigger_ids:
-                raise Exception
-            return _put_doc_if_newer(doc, save_conflict=save_conflict,
-                                     replica_uid=replica_uid,
-                                     replica_gen=replica_gen,
-                                     replica_trans_id=replica_trans_id,
-                                     number_of_docs=number_of_docs,
-                                     doc_idx=doc_idx, sync_id=sync_id)
+        def bomb_put_docs_if_newer(self, entries, save_conflict,
+                                   replica_uid=None, number_of_docs=None,
+                                   sync_id=None):
+            # put the documents that precede a trigger document, then fail
+            for i, (doc, _, _, _) in enumerate(entries):
+                if doc.doc_id in trigger_ids:
+                    _put_docs_if_newer(
+                        entries[:i], save_conflict=save_conflict,
+                        replica_uid=replica_uid,
+                        number_of_docs=number_of_docs, sync_id=sync_id)
+                    raise Exception
+            return _put_docs_if_newer(entries, save_conflict=save_conflict,
+                                      replica_uid=replica_uid,
+                                      number_of_docs=number_of_docs,
+                                      sync_id=sync_id)
         from leap.soledad.common.tests.test_couch import IndexedCouchDatabase
         self.patch(
-            IndexedCouchDatabase, '_put_doc_if_newer', bomb_put_doc_if_newer)
+            IndexedCouchDatabase, '_put_docs_if_newer',
+            bomb_put_docs_if_newer)
         remote_target = self.getSyncTarget('test')
         other_changes = []
 
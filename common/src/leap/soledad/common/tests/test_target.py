@@ -24,6 +24,8 @@ import u1db
 import os
 import simplejson as json
 import cStringIO
+import threading
+import time
 
 
 from u1db.sync import Synchronizer
@@ -38,6 +40,7 @@ from leap.soledad.client import (
     auth,
     VerifiedHTTPSConnection,
 )
+from leap.soledad.common import wire
 from leap.soledad.common.document import SoledadDocument
 from leap.soledad.server.auth import SoledadTokenAuthMiddleware
 
@@ -327,6 +330,174 @@ class TestSoledadParsingSyncStream(
                           tgt._parse_sync_stream,
                           '[\r\n{"error": "?"}\r\n', None)
 
+    def test_parse_received_doc_response_many_entries(self):
+        tgt = target.SoledadSyncTarget("http://foo/foo")
+        tgt._ensure_callback = None
+        body = (
+            '[\r\n{"new_generation": 5, "new_transaction_id": "T-5", '
+            '"number_of_changes": 3},'
+            '\r\n{"id": "a", "rev": "r1", "content": "{}", "gen": 2, '
+            '"trans_id": "T-2"},'
+            '\r\n{"id": "b", "rev": "r2", "content": null, "gen": 3, '
+            '"trans_id": "T-3"}\r\n]')
+        self.assertEqual(
+            (5, 'T-5', 3, [('a', 'r1', '{}', 2, 'T-2'),
+                           ('b', 'r2', None, 3, 'T-3')]),
+            tgt._parse_received_doc_response((body, {})))
+        # missing comma between entries
+        self.assertRaises(
+            u1db.errors.BrokenSyncStream,
+            tgt._parse_received_doc_response,
+            (body.replace('"T-2"},', '"T-2"}'), {}))
+
+
+class TestDocumentSyncerPool(tests.TestCase):
+    """
+    Tests for the ordered pipeline of document syncers.
+    """
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        self.stopped = []
+
+        class _FakeSyncer(object):
+            """
+            A syncer that answers requests in reverse order of submission.
+            """
+
+            instances = []
+
+            def __init__(syncer, *args, **kwargs):
+                _FakeSyncer.instances.append(syncer)
+
+            def set_request_method(syncer, method, *args, **kwargs):
+                syncer._args = args
+
+            def do_request(syncer):
+                idx, = syncer._args
+                time.sleep((10 - idx) * 0.01)
+                if idx == 5 and self.fail_at_5:
+                    raise Exception('failed')
+                if idx == 7 and self.unavailable_at_7:
+                    self.unavailable_at_7 = False
+                    raise u1db.errors.Unavailable()
+                return idx, {}
+
+            def close(syncer):
+                pass
+
+        self.fail_at_5 = False
+        self.unavailable_at_7 = False
+        self.syncer_class = _FakeSyncer
+        self.patch(target, 'HTTPDocumentSyncer', _FakeSyncer)
+
+    def _make_pool(self, window):
+        controller = target.SyncWindowController(
+            initial_window=window, max_window=window)
+        return target.DocumentSyncerPool(
+            'http://foo/foo', {}, '/foo', {}, None,
+            lambda: self.stopped.append(True), window_controller=controller)
+
+    def test_callbacks_run_in_order(self):
+        pool = self._make_pool(4)
+        results = []
+        jobs = []
+        for i in range(10):
+            jobs.append(pool.submit(
+                i, 10, 'get', args=(i,),
+                success_callback=lambda idx, total, resp: results.append(
+                    resp[0])))
+        for job in jobs:
+            job.join()
+        pool.cleanup()
+        self.assertEqual(range(10), results)
+        self.assertTrue(all(job.success for job in jobs))
+        # no more workers than the window size were created
+        self.assertEqual(4, len(self.syncer_class.instances))
+        self.assertEqual([], self.stopped)
+
+    def test_failure_cancels_next_jobs(self):
+        self.fail_at_5 = True
+        pool = self._make_pool(3)
+        results = []
+        failures = []
+        jobs = []
+        for i in range(10):
+            job = pool.submit(
+                i, 10, 'get', args=(i,),
+                success_callback=lambda idx, total, resp: results.append(
+                    resp[0]),
+                failure_callback=lambda idx, total, exc: failures.append(
+                    idx))
+            if job is None:
+                break
+            jobs.append(job)
+        for job in jobs:
+            job.join()
+        pool.cleanup()
+        self.assertEqual(range(5), results)
+        self.assertEqual([5], failures)
+        self.assertEqual([True], self.stopped)
+        self.assertTrue(pool.failures)
+        self.assertEqual(
+            [True] * 5 + [False] * (len(jobs) - 5),
+            [job.success for job in jobs])
+
+    def test_unavailable_requests_are_retried(self):
+        self.unavailable_at_7 = True
+        controller = target.SyncWindowController(initial_window=8)
+        pool = target.DocumentSyncerPool(
+            'http://foo/foo', {}, '/foo', {}, None,
+            lambda: self.stopped.append(True), window_controller=controller)
+        results = []
+        jobs = []
+        for i in range(10):
+            jobs.append(pool.submit(
+                i, 10, 'get', args=(i,),
+                success_callback=lambda idx, total, resp: results.append(
+                    resp[0])))
+        for job in jobs:
+            job.join()
+        pool.cleanup()
+        self.assertEqual(range(10), results)
+        self.assertEqual(2, jobs[7].attempts)
+        self.assertEqual(1, controller.stats['unavailable'])
+        self.assertLess(controller.window, 8)
+
+
+class TestSyncWindowController(tests.TestCase):
+    """
+    Tests for the adaptive window of concurrent sync requests.
+    """
+
+    def test_window_grows_with_stable_latency(self):
+        controller = target.SyncWindowController(initial_window=4)
+        for _ in range(100):
+            controller.on_success(0.1, 100)
+        self.assertGreater(controller.window, 4)
+        self.assertLessEqual(
+            controller.window, target.SyncWindowController.MAX_WINDOW)
+
+    def test_window_shrinks_with_growing_latency(self):
+        controller = target.SyncWindowController(initial_window=16)
+        for _ in range(10):
+            controller.on_success(0.1, 100)
+        window = controller.window
+        for _ in range(10):
+            controller.on_success(1.0, 100)
+        self.assertLess(controller.window, window)
+
+    def test_window_halves_when_unavailable(self):
+        controller = target.SyncWindowController(initial_window=16)
+        controller.on_unavailable()
+        self.assertEqual(8, controller.window)
+        self.assertEqual(8, controller.stats['window'])
+        self.assertEqual(1, controller.stats['unavailable'])
+        for _ in range(10):
+            controller.on_unavailable()
+        self.assertEqual(
+            target.SyncWindowController.MIN_WINDOW, controller.window)
+
 
 #
 # functions for TestRemoteSyncTargets
@@ -411,6 +582,258 @@ class TestSoledadSyncTarget(
             db, 'doc-here', 'replica:1', '{"value": "here"}', False)
         db.close()
 
+    def test_sync_exchange_send_in_batches(self):
+        """
+        Test that many documents are sent in few POST requests.
+        """
+        self.startServer()
+        db = self.request_state._create_database('test')
+        remote_target = self.getSyncTarget('test')
+        remote_target.MAX_PUT_BATCH_DOCS = 2
+        batches = []
+        _put_docs = target.HTTPDocumentSyncer._put_docs
+
+        def counting_put_docs(self, sync_id, last_known_generation,
+                              last_known_trans_id, docs):
+            batches.append([d['id'] for d in docs])
+            return _put_docs(self, sync_id, last_known_generation,
+                             last_known_trans_id, docs)
+
+        self.patch(target.HTTPDocumentSyncer, '_put_docs', counting_put_docs)
+        docs_by_gen = []
+        for i in range(5):
+            doc = self.make_document(
+                'doc-%d' % i, 'replica:1', '{"value": %d}' % i)
+            docs_by_gen.append((doc, 10 + i, 'T-%d' % i))
+        new_gen, trans_id = remote_target.sync_exchange(
+            docs_by_gen, 'replica', last_known_generation=0,
+            last_known_trans_id=None, return_doc_cb=lambda *args: None)
+        self.assertEqual(5, new_gen)
+        self.assertEqual(
+            [['doc-0', 'doc-1'], ['doc-2', 'doc-3'], ['doc-4']],
+            sorted(batches))
+        for i in range(5):
+            self.assertGetEncryptedDoc(
+                db, 'doc-%d' % i, 'replica:1', '{"value": %d}' % i, False)
+        self.assertEqual(
+            (14, 'T-4'), db._get_replica_gen_and_trans_id('replica'))
+        db.close()
+
+    def test_sync_exchange_receive_in_batches(self):
+        """
+        Test that many documents are received in few POST requests.
+        """
+        self.startServer()
+        db = self.request_state._create_database('test')
+        for i in range(5):
+            db.create_doc_from_json('{"value": %d}' % i, doc_id='doc-%d' % i)
+        remote_target = self.getSyncTarget('test')
+        remote_target.MAX_GET_BATCH_DOCS = 2
+        requests = []
+        _get_docs = target.HTTPDocumentSyncer._get_docs
+
+        def counting_get_docs(self, received, sync_id, last_known_generation,
+                              last_known_trans_id, limit=1):
+            requests.append((received, limit))
+            return _get_docs(self, received, sync_id, last_known_generation,
+                             last_known_trans_id, limit=limit)
+
+        self.patch(target.HTTPDocumentSyncer, '_get_docs', counting_get_docs)
+        other_docs = []
+
+        def receive_doc(doc, gen, trans_id):
+            other_docs.append((doc.doc_id, gen))
+
+        new_gen, trans_id = remote_target.sync_exchange(
+            [], 'replica', last_known_generation=0, last_known_trans_id=None,
+            return_doc_cb=receive_doc, defer_decryption=False)
+        self.assertEqual(5, new_gen)
+        self.assertEqual([(0, 2), (2, 2), (4, 2)], sorted(requests))
+        self.assertEqual(
+            [('doc-%d' % i, i + 1) for i in range(5)], other_docs)
+        db.close()
+
+    def test_sync_exchange_binary_format(self):
+        """
+        Test that documents are sent and received in the binary wire format
+        when the server supports it.
+        """
+        self.startServer()
+        db = self.request_state._create_database('test')
+        db.create_doc_from_json('{"value": "there"}', doc_id='doc-there')
+        remote_target = self.getSyncTarget('test')
+        remote_target.get_sync_info('replica')
+        self.assertEqual(wire.BINARY_FORMAT, remote_target._wire_format)
+        requests = []
+        _init_post_request = target.HTTPDocumentSyncer._init_post_request
+
+        def recording_init_post_request(self, action, content_length,
+                                        *args):
+            requests.append((action, self._wire_format))
+            return _init_post_request(self, action, content_length, *args)
+
+        self.patch(target.HTTPDocumentSyncer, '_init_post_request',
+                   recording_init_post_request)
+        doc = self.make_document('doc-here', 'replica:1', '{"value": "here"}')
+        other_docs = []
+
+        def receive_doc(doc, gen, trans_id):
+            other_docs.append((doc.doc_id, doc.get_json()))
+
+        new_gen, _ = remote_target.sync_exchange(
+            [(doc, 10, 'T-sid')], 'replica', last_known_generation=0,
+            last_known_trans_id=None, return_doc_cb=receive_doc,
+            defer_decryption=False)
+        self.assertEqual(2, new_gen)
+        self.assertEqual(
+            set([('put', wire.BINARY_FORMAT), ('get', wire.BINARY_FORMAT)]),
+            set(requests))
+        self.assertGetEncryptedDoc(
+            db, 'doc-here', 'replica:1', '{"value": "here"}', False)
+        self.assertEqual([('doc-there', '{"value": "there"}')], other_docs)
+        db.close()
+
+    def test_sync_exchange_compressed_uploads(self):
+        """
+        Test that documents are uploaded in compressed bodies when the server
+        accepts them.
+        """
+        self.startServer()
+        db = self.request_state._create_database('test')
+        remote_target = self.getSyncTarget('test')
+        remote_target.get_sync_info('replica')
+        self.assertEqual('gzip', remote_target._request_encoding)
+        # binary frames are never compressed
+        remote_target._wire_format = wire.JSON_FORMAT
+        requests = []
+        _init_post_request = target.HTTPDocumentSyncer._init_post_request
+
+        def recording_init_post_request(self, action, content_length,
+                                        content_encoding=None):
+            requests.append((action, content_encoding))
+            return _init_post_request(
+                self, action, content_length, content_encoding)
+
+        self.patch(target.HTTPDocumentSyncer, '_init_post_request',
+                   recording_init_post_request)
+        content = json.dumps({'value': 'here' * 1000})
+        doc = self.make_document('doc-here', 'replica:1', content)
+        new_gen, _ = remote_target.sync_exchange(
+            [(doc, 10, 'T-sid')], 'replica', last_known_generation=0,
+            last_known_trans_id=None, return_doc_cb=lambda *args: None,
+            defer_decryption=False)
+        self.assertEqual(1, new_gen)
+        self.assertIn(('put', 'gzip'), requests)
+        self.assertIn(('get', None), requests)
+        self.assertGetEncryptedDoc(db, 'doc-here', 'replica:1', content, False)
+        db.close()
+
+    def test_sync_exchange_continues_expired_session(self):
+        """
+        Test that the client restarts a sync session that the server has
+        forgotten about.
+        """
+        from leap.soledad.server.sync import SyncResource
+        self.startServer()
+        db = self.request_state._create_database('test')
+        for i in range(3):
+            db.create_doc_from_json('{"value": %d}' % i, doc_id='doc-%d' % i)
+        remote_target = self.getSyncTarget('test')
+        remote_target.MAX_GET_BATCH_DOCS = 1
+        prologues = []
+        _prepare_prologue = target.HTTPDocumentSyncer._prepare_prologue
+
+        def forgetful_prepare_prologue(self, entries, sync_id,
+                                       last_known_generation,
+                                       last_known_trans_id):
+            size = _prepare_prologue(
+                self, entries, sync_id, last_known_generation,
+                last_known_trans_id)
+            prologues.append(json.loads(entries[-1]))
+            # make the server forget about the session after it was started
+            SyncResource.sync_sessions.clear()
+            return size
+
+        self.patch(target.HTTPDocumentSyncer, '_prepare_prologue',
+                   forgetful_prepare_prologue)
+        other_docs = []
+
+        def receive_doc(doc, gen, trans_id):
+            other_docs.append(doc.doc_id)
+
+        new_gen, _ = remote_target.sync_exchange(
+            [], 'replica', last_known_generation=0, last_known_trans_id=None,
+            return_doc_cb=receive_doc, defer_decryption=False,
+            sync_id='some-sync-id')
+        self.assertEqual(3, new_gen)
+        self.assertEqual(['doc-0', 'doc-1', 'doc-2'], other_docs)
+        # the first request starts the session, the following ones try to
+        # continue it and restart it with the full prologue when it expired
+        self.assertIn('last_known_generation', prologues[0])
+        self.assertIn({'sync_id': 'some-sync-id'}, prologues[1:])
+        self.assertIn('last_known_generation', prologues[-1])
+        db.close()
+
+    def test_sync_exchange_resumes_interrupted_download(self):
+        """
+        Test that the client resumes receiving documents where an interrupted
+        sync stopped.
+        """
+        from leap.soledad.client.mp_safe_db import MPSafeSQLiteDB
+        self.startServer()
+        db = self.request_state._create_database('test')
+        for i in range(3):
+            db.create_doc_from_json('{"value": %d}' % i, doc_id='doc-%d' % i)
+        remote_target = self.getSyncTarget('test')
+        remote_target.MAX_GET_BATCH_DOCS = 1
+        sync_db = MPSafeSQLiteDB(
+            os.path.join(self.createTempDir(), 'sync.db'))
+        self.addCleanup(sync_db.close)
+        sync_db.execute("CREATE TABLE %s (%s)" % (
+            remote_target.CHECKPOINT_TABLE_NAME,
+            remote_target.CHECKPOINT_FIELD_NAMES))
+        remote_target._sync_db = sync_db
+        remote_target._sync_db_write_lock = threading.Lock()
+        requests = []
+        _get_docs = target.HTTPDocumentSyncer._get_docs
+
+        def failing_get_docs(self, received, sync_id, last_known_generation,
+                             last_known_trans_id, limit=1):
+            requests.append((received, limit))
+            if received == 1 and len(requests) <= 3:
+                raise Exception('interrupted')
+            return _get_docs(self, received, sync_id, last_known_generation,
+                             last_known_trans_id, limit=limit)
+
+        self.patch(target.HTTPDocumentSyncer, '_get_docs', failing_get_docs)
+        other_docs = []
+
+        def receive_doc(doc, gen, trans_id):
+            other_docs.append(doc.doc_id)
+
+        # the first sync is interrupted after receiving the first document
+        new_gen, _ = remote_target.sync_exchange(
+            [], 'replica', last_known_generation=0, last_known_trans_id=None,
+            return_doc_cb=receive_doc, defer_decryption=False)
+        self.assertEqual(1, new_gen)
+        self.assertEqual(['doc-0'], other_docs)
+        checkpoint = remote_target._get_checkpoint()
+        self.assertEqual(remote_target.CHECKPOINT_RECEIVE, checkpoint['phase'])
+        self.assertEqual(1, checkpoint['received'])
+        self.assertEqual(3, checkpoint['number_of_changes'])
+        # the second sync continues from the second document
+        del requests[:]
+        new_gen, _ = remote_target.sync_exchange(
+            [], 'replica', last_known_generation=new_gen,
+            last_known_trans_id=None, return_doc_cb=receive_doc,
+            defer_decryption=False)
+        self.assertEqual(3, new_gen)
+        self.assertEqual(['doc-0', 'doc-1', 'doc-2'], other_docs)
+        self.assertEqual((1, 0), requests[0])
+        self.assertEqual([(1, 1), (2, 1)], sorted(requests[1:]))
+        self.assertIsNone(remote_target._get_checkpoint())
+        db.close()
+
     def test_sync_exchange_send_failure_and_retry_scenario(self):
         """
         Test for sync exchange failure and retry.
@@ -429,25 +852,28 @@ class TestSoledadSyncTarget(
         self.patch(self.server.RequestHandlerClass, 'get_stderr',
                    blackhole_getstderr)
         db = self.request_state._create_database('test')
-        _put_doc_if_newer = db._put_doc_if_newer
+        _put_docs_if_newer = db._put_docs_if_newer
         trigger_ids = ['doc-here2']
 
-        def bomb_put_doc_if_newer(self, doc, save_conflict,
-                                  replica_uid=None, replica_gen=None,
-                                  replica_trans_id=None, number_of_docs=None,
-                                  doc_idx=None, sync_id=None):
-            if doc.doc_id in trigger_ids:
-                raise Exception
-            return _put_doc_if_newer(doc, save_conflict=save_conflict,
-                                     replica_uid=replica_uid,
-                                     replica_gen=replica_gen,
-                                     replica_trans_id=replica_trans_id,
-                                     number_of_docs=number_of_docs,
-                                     doc_idx=doc_idx,
-                                     sync_id=sync_id)
+        def bomb_put_docs_if_newer(self, entries, save_conflict,
+                                   replica_uid=None, number_of_docs=None,
+                                   sync_id=None):
+            # put the documents that precede a trigger document, then fail
+            for i, (doc, _, _, _) in enumerate(entries):
+                if doc.doc_id in trigger_ids:
+                    _put_docs_if_newer(
+                        entries[:i], save_conflict=save_conflict,
+                        replica_uid=replica_uid,
+                        number_of_docs=number_of_docs, sync_id=sync_id)
+                    raise Exception
+            return _put_docs_if_newer(entries, save_conflict=save_conflict,
+                                      replica_uid=replica_uid,
+                                      number_of_docs=number_of_docs,
+                                      sync_id=sync_id)
         from leap.soledad.common.tests.test_couch import IndexedCouchDatabase
         self.patch(
-            IndexedCouchDatabase, '_put_doc_if_newer', bomb_put_doc_if_newer)
+            IndexedCouchDatabase, '_put_docs_if_newer',
+            bomb_put_docs_if_newer)
         remote_target = self.getSyncTarget('test')
         other_changes = []
 
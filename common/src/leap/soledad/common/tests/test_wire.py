@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# test_wire.py
+# Copyright (C) 2014 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Tests for the binary sync wire format.
+"""
+
+
+import binascii
+
+import simplejson as json
+
+from leap.soledad.common import wire
+from leap.soledad.common.crypto import ENC_JSON_KEY, ENC_SCHEME_KEY
+from leap.soledad.common.tests import u1db_tests as tests
+
+
+class WireFormatTestCase(tests.TestCase):
+
+    def test_content_type(self):
+        self.assertEqual(
+            'application/x-soledad-sync-put',
+            wire.make_content_type(
+                'application/x-soledad-sync-put', wire.JSON_FORMAT))
+        content_type = wire.make_content_type(
+            'application/x-soledad-sync-put', wire.BINARY_FORMAT)
+        self.assertEqual(
+            ('application/x-soledad-sync-put', wire.BINARY_FORMAT),
+            wire.parse_content_type(content_type))
+        self.assertEqual(
+            ('application/x-soledad-sync-get', wire.JSON_FORMAT),
+            wire.parse_content_type('application/x-soledad-sync-get'))
+
+    def test_choose_format(self):
+        self.assertEqual(wire.JSON_FORMAT, wire.choose_format(None))
+        self.assertEqual(wire.JSON_FORMAT, wire.choose_format('msgpack'))
+        self.assertEqual(
+            wire.BINARY_FORMAT, wire.choose_format('json, binary'))
+
+    def test_choose_request_encoding(self):
+        self.assertEqual(None, wire.choose_request_encoding(None))
+        self.assertEqual(None, wire.choose_request_encoding('br'))
+        self.assertEqual(
+            'gzip', wire.choose_request_encoding('deflate, GZIP;q=0.5'))
+
+    def test_encrypted_doc_frame(self):
+        ciphertext = '\x00\xff' * 10
+        content = json.dumps({
+            ENC_JSON_KEY: binascii.b2a_hex(ciphertext),
+            ENC_SCHEME_KEY: 'symkey'})
+        entry = dict(id='doc-id', rev='replica:1', content=content, gen=1,
+                     trans_id='T-1')
+        frame = wire.encode_doc_frame(entry)
+        # the ciphertext is not hex encoded in the frame
+        self.assertTrue(len(frame) < len(json.dumps(entry)))
+        [(metadata, payload)] = list(wire.decode_frames(frame))
+        self.assertEqual(ciphertext, payload)
+        self.assertNotIn(ENC_JSON_KEY, json.loads(metadata['content']))
+        decoded = wire.decode_doc_frame(metadata, payload)
+        self.assertEqual(json.loads(content), json.loads(decoded['content']))
+        self.assertEqual('doc-id', decoded['id'])
+
+    def test_plain_and_deleted_doc_frames(self):
+        entries = [
+            dict(id='doc-1', rev='replica:1', content='{"value": 1}'),
+            dict(id='doc-2', rev='replica:2', content=None)]
+        data = ''.join(map(wire.encode_doc_frame, entries))
+        decoded = [wire.decode_doc_frame(metadata, payload)
+                   for metadata, payload in wire.decode_frames(data)]
+        self.assertEqual(entries, decoded)
+
+    def test_truncated_frames(self):
+        data = wire.encode_frame({'a': 1}, 'payload')
+        for size in (3, len(data) - 1):
+            self.assertRaises(
+                wire.BrokenFrameError, list, wire.decode_frames(data[:size]))
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+# wire.py
+# Copyright (C) 2014 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Soledad sync wire formats.
+
+Besides the U1DB JSON stream, syncing bodies may use a binary format made of
+length-prefixed frames. Each frame is made of two 4-byte big-endian unsigned
+integers with the lengths of its metadata and payload, followed by the
+metadata (a JSON object) and by the payload (raw bytes).
+
+The ciphertext of a symmetrically encrypted document is carried as the raw
+payload of its frame, instead of as hexadecimal inside the document's JSON
+content, which in turn would be escaped inside the JSON entry of the stream.
+The frame metadata then carries the content in version 2 of the encrypted
+document format.
+
+The server announces the formats it supports in a header of the response to
+the sync info request, so clients keep using the JSON format with older
+servers.
+"""
+
+
+import struct
+
+import simplejson as json
+
+from leap.soledad.common.crypto import (
+    ENC_JSON_KEY,
+    ENC_VERSION_KEY,
+    ENC_VERSION_2,
+    split_encrypted_content,
+    join_encrypted_content,
+)
+
+
+JSON_FORMAT = 'json'
+BINARY_FORMAT = 'binary'
+
+SUPPORTED_FORMATS = (BINARY_FORMAT, JSON_FORMAT)
+"""
+Wire formats supported by this implementation, in order of preference.
+"""
+
+FORMATS_HEADER = 'x-soledad-sync-formats'
+"""
+Header used by the server to announce the wire formats it supports.
+"""
+
+REQUEST_ENCODINGS = ('gzip', 'deflate')
+"""
+Content codings supported for syncing request bodies, in order of preference.
+"""
+
+REQUEST_ENCODINGS_HEADER = 'accept-encoding'
+"""
+Header used by the server to announce the content codings it accepts in
+syncing request bodies (see RFC 7694).
+"""
+
+FRAME_HEADER = struct.Struct('>II')
+
+
+class BrokenFrameError(Exception):
+    """
+    Raised when a sequence of frames cannot be decoded.
+    """
+    pass
+
+
+#
+# Format negotiation
+#
+
+def parse_content_type(content_type):
+    """
+    Split a content type into its media type and wire format.
+
+    :param content_type: The value of a content-type header, possibly with a
+                         'format' parameter.
+    :type content_type: str
+
+    :return: The media type and the wire format.
+    :rtype: tuple(str, str)
+    """
+    parts = (content_type or '').split(';')
+    wire_format = JSON_FORMAT
+    for param in parts[1:]:
+        name, _, value = param.partition('=')
+        if name.strip() == 'format':
+            wire_format = value.strip()
+    return parts[0].strip(), wire_format
+
+
+def make_content_type(media_type, wire_format):
+    """
+    Build a content type for a body in some wire format.
+
+    :param media_type: The media type of the body.
+    :type media_type: str
+    :param wire_format: The wire format of the body.
+    :type wire_format: str
+
+    :return: The value for the content-type header.
+    :rtype: str
+    """
+    if wire_format == JSON_FORMAT:
+        return media_type
+    return '%s; format=%s' % (media_type, wire_format)
+
+
+def choose_format(formats_header):
+    """
+    Choose the preferred wire format among the ones announced by a server.
+
+    :param formats_header: The value of the header with the comma separated
+                           list of formats supported by the server, or None
+                           if the server did not send it.
+    :type formats_header: str
+
+    :return: The wire format to be used.
+    :rtype: str
+    """
+    if formats_header:
+        announced = [f.strip() for f in formats_header.split(',')]
+        for wire_format in SUPPORTED_FORMATS:
+            if wire_format in announced:
+                return wire_format
+    return JSON_FORMAT
+
+
+def choose_request_encoding(encodings_header):
+    """
+    Choose the preferred content coding for request bodies among the ones
+    announced by a server.
+
+    :param encodings_header: The value of the header with the comma separated
+                             list of codings accepted by the server, or None
+                             if the server did not send it.
+    :type encodings_header: str
+
+    :return: The content coding to be used, or None if request bodies should
+             not be encoded.
+    :rtype: str
+    """
+    if encodings_header:
+        announced = [e.split(';')[0].strip().lower()
+                     for e in encodings_header.split(',')]
+        for encoding in REQUEST_ENCODINGS:
+            if encoding in announced:
+                return encoding
+    return None
+
+
+#
+# Document contents
+#
+
+def split_content(content):
+    """
+    Split the ciphertext out of a document's JSON content.
+
+    :param content: The JSON serialization of the document's content, or None
+                    if the document was deleted.
+    :type content: str
+
+    :return: The JSON content without the ciphertext (in version 2 of the
+             encrypted document format), and the raw ciphertext, which is
+             empty if the content is not encrypted.
+    :rtype: tuple(str, str)
+    """
+    if content is None or ENC_JSON_KEY not in content:
+        return content, ''
+    metadata, ciphertext = split_encrypted_content(json.loads(content))
+    if metadata is None:
+        return content, ''
+    return json.dumps(metadata), ciphertext
+
+
+def join_content(content, ciphertext):
+    """
+    Put back the ciphertext into a document's JSON content.
+
+    :param content: The JSON content without the ciphertext.
+    :type content: str
+    :param ciphertext: The raw ciphertext.
+    :type ciphertext: str
+
+    :return: The JSON serialization of the document's content, in version 1
+             of the encrypted document format.
+    :rtype: str
+    """
+    if content is None or ENC_VERSION_KEY not in content:
+        return content
+    content_dict = json.loads(content)
+    if content_dict.get(ENC_VERSION_KEY) != ENC_VERSION_2:
+        return content
+    return json.dumps(join_encrypted_content(content_dict, ciphertext))
+
+
+#
+# Frames
+#
+
+def encode_frame(metadata, payload=''):
+    """
+    Encode one frame.
+
+    :param metadata: The metadata of the frame.
+    :type metadata: dict
+    :param payload: The raw payload of the frame.
+    :type payload: str
+
+    :return: The encoded frame.
+    :rtype: str
+    """
+    metadata = json.dumps(metadata)
+    return FRAME_HEADER.pack(len(metadata), len(payload)) \
+        + metadata + payload
+
+
+def encode_doc_frame(entry):
+    """
+    Encode a document entry of a sync stream as a frame whose payload is the
+    document's raw ciphertext.
+
+    :param entry: The entry, whose 'content' is the document's JSON content.
+    :type entry: dict
+
+    :return: The encoded frame.
+    :rtype: str
+    """
+    content, ciphertext = split_content(entry['content'])
+    entry = dict(entry, content=content)
+    return encode_frame(entry, ciphertext)
+
+
+def decode_doc_frame(metadata, payload):
+    """
+    Decode a document entry from the metadata and payload of a frame.
+
+    :param metadata: The metadata of the frame.
+    :type metadata: dict
+    :param payload: The raw payload of the frame.
+    :type payload: str
+
+    :return: The entry, whose 'content' is the document's JSON content.
+    :rtype: dict
+
+    :raise BrokenFrameError: If the entry has no content.
+    """
+    if 'content' not in metadata:
+        raise BrokenFrameError()
+    metadata['content'] = join_content(metadata['content'], payload)
+    return metadata
+
+
+def decode_frames(data):
+    """
+    Decode a sequence of frames.
+
+    :param data: The encoded frames.
+    :type data: str
+
+    :return: An iterator over the (metadata, payload) of each frame.
+    :rtype: generator
+
+    :raise BrokenFrameError: If data is truncated or malformed.
+    """
+    offset = 0
+    total = len(data)
+    while offset < total:
+        if offset + FRAME_HEADER.size > total:
+            raise BrokenFrameError()
+        metadata_length, payload_length = \
+            FRAME_HEADER.unpack_from(data, offset)
+        offset += FRAME_HEADER.size
+        end = offset + metadata_length + payload_length
+        if end > total:
+            raise BrokenFrameError()
+        try:
+            metadata = json.loads(data[offset:offset + metadata_length])
+        except ValueError:
+            raise BrokenFrameError()
+        if not isinstance(metadata, dict):
+            raise BrokenFrameError()
+        yield metadata, data[offset + metadata_length:end]
+        offset = end
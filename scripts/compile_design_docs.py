@@ -30,6 +30,8 @@ def build_ddocs():
         directory.
       - Design document directories might contain `views`, `lists` and
         `updates` subdirectories.
+      - Design document directories might contain an `options.json` file
+        with the options of the design document.
       - Views subdirectories must contain a `map.js` file and may contain a
         `reduce.js` file.
       - List and updates subdirectories may contain any number of javascript
@@ -46,6 +48,12 @@ def build_ddocs():
 
         ddocs[ddoc] = {'_id': '_design/%s' % ddoc}
 
+        # look for the options of the design document
+        optionsfile = join(ddocs_path, ddoc, 'options.json')
+        if isfile(optionsfile):
+            with open(optionsfile) as f:
+                ddocs[ddoc]['options'] = json.load(f)
+
         for t in ['views', 'lists', 'updates']:
             tdir = join(ddocs_path, ddoc, t)
             if isdir(tdir):
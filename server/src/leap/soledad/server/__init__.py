@@ -27,6 +27,24 @@ twistd command. To start the soledad server, run:
 
     twistd -n web --wsgi=leap.soledad.server.application --port=X
 
+The configuration in /etc/leap/soledad-server.conf is loaded when the first
+request arrives, and loaded again when the file changes or when the server
+receives a SIGHUP signal.
+
+Request counts and latencies, as well as couch, sync and authentication
+metrics, can be read as JSON from the /_metrics path by clients whose address
+is listed in 'metrics_allowed_addresses' (comma separated, local addresses by
+default). The address checked is the one the request comes from, so when the
+server runs behind a reverse proxy on the same host the proxy must not
+forward that path.
+
+Requests may be profiled by setting 'profile = true' in the configuration
+file, along with the fraction of requests to profile ('profile_rate') and a
+regular expression matching paths of requests which are always profiled
+('profile_filter'). Aggregated profiles are written to 'profile_dir'.
+When profiling is configured, it can be switched off and on again by
+sending the server a SIGUSR2 signal.
+
 An initscript is included and will be installed system wide to make it
 feasible to start and stop the Soledad server service using a standard
 interface.
@@ -87,8 +105,15 @@ and lock documents on the shared database is handled by
 """
 
 import configparser
+import os
+import signal
 import urlparse
 import sys
+import threading
+import time
+import zlib
+
+import simplejson as json
 
 from u1db.remote import http_app, utils
 
@@ -103,17 +128,42 @@ if version.base() == "12.0.0":
     # come to use Twisted>=12.3.0.
     sys.modules['OpenSSL.tsafe'] = old_tsafe
 
+from twisted.internet import reactor
+
 from leap.soledad.server.auth import SoledadTokenAuthMiddleware
-from leap.soledad.server.gzip_middleware import GzipMiddleware
+from leap.soledad.server.gzip_middleware import (
+    GzipMiddleware,
+    DEFAULT_COMPRESSLEVEL,
+    DEFAULT_MIN_SIZE,
+)
 from leap.soledad.server.lock_resource import LockResource
+from leap.soledad.server.metrics_middleware import (
+    MetricsMiddleware,
+    LOCAL_ADDRESSES,
+)
+from leap.soledad.server.profiler_middleware import (
+    ProfilerMiddleware,
+    DEFAULT_RATE,
+    DEFAULT_PROFILE_DIR,
+    DEFAULT_MAX_PROFILES,
+)
 from leap.soledad.server.sync import (
     SyncResource,
     MAX_REQUEST_SIZE,
     MAX_ENTRY_SIZE,
 )
+from leap.soledad.server.sync_state import get_sync_state_store
 
 from leap.soledad.common import SHARED_DB_NAME
 from leap.soledad.common.couch import CouchServerState
+from leap.soledad.common.wire import (
+    BINARY_FORMAT,
+    JSON_FORMAT,
+    FRAME_HEADER,
+    BrokenFrameError,
+    decode_doc_frame,
+    parse_content_type,
+)
 
 
 # ----------------------------------------------------------------------------
@@ -171,6 +221,138 @@ http_app.url_to_resource.register(SyncResource)
 # Modified HTTP method invocation (to account for splitted sync)
 # ----------------------------------------------------------------------------
 
+class _DecodedInput(object):
+    """
+    A file-like wrapper that decompresses an encoded request body.
+
+    The amount of decompressed bytes is limited, so small bodies cannot
+    expand to huge amounts of data.
+    """
+
+    CHUNK_SIZE = 8192
+
+    WBITS = {
+        'gzip': 16 + zlib.MAX_WBITS,
+        'deflate': zlib.MAX_WBITS,
+    }
+
+    def __init__(self, rfile, content_length, encoding, max_size):
+        """
+        Initialize the decoded input.
+
+        @param rfile: The input with the encoded body.
+        @type rfile: file-like
+        @param content_length: The length of the encoded body.
+        @type content_length: int
+        @param encoding: The content coding of the body, one of the keys of
+            WBITS.
+        @type encoding: str
+        @param max_size: The maximum amount of decoded bytes.
+        @type max_size: int
+        """
+        self._rfile = rfile
+        self._remaining = content_length
+        self._decompressor = zlib.decompressobj(self.WBITS[encoding])
+        self._max_size = max_size
+        self._size = 0
+        self._buffer = ''
+        self._eof = False
+
+    def _fill(self, size):
+        """
+        Decode data until there are at least size bytes available or the body
+        has ended.
+
+        @raise BadRequest: If the body is malformed or decodes to more than
+            the maximum amount of bytes.
+        """
+        while len(self._buffer) < size and not self._eof:
+            compressed = self._decompressor.unconsumed_tail
+            if not compressed and self._remaining > 0:
+                compressed = self._rfile.read(
+                    min(self._remaining, self.CHUNK_SIZE))
+                self._remaining -= len(compressed)
+            try:
+                if compressed:
+                    data = self._decompressor.decompress(
+                        compressed, self.CHUNK_SIZE)
+                else:
+                    data = self._decompressor.flush()
+                    self._eof = True
+            except zlib.error:
+                raise http_app.BadRequest()
+            self._size += len(data)
+            if self._size > self._max_size:
+                raise http_app.BadRequest()
+            self._buffer += data
+
+    def read(self, size):
+        """
+        Read at most size decoded bytes.
+
+        @param size: The maximum amount of bytes to read.
+        @type size: int
+
+        @return: The decoded data, or an empty string if the body has ended.
+        @rtype: str
+        """
+        self._fill(size)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class _FrameReader(http_app._FencedReader):
+    """
+    A fenced reader that is also able to read length-prefixed frames.
+    """
+
+    def read_exactly(self, size):
+        """
+        Read exactly size bytes from the body.
+
+        @param size: The number of bytes to read.
+        @type size: int
+
+        @return: The data read.
+        @rtype: str
+
+        @raise BadRequest: If the body ends before size bytes are read.
+        """
+        parts = []
+        while size > 0:
+            chunk = self.read_chunk(size)
+            if chunk == '':
+                raise http_app.BadRequest()
+            if len(chunk) > size:
+                # keep the rest for the next read
+                self._kept = chunk[size:]
+                chunk = chunk[:size]
+            parts.append(chunk)
+            size -= len(chunk)
+        return ''.join(parts)
+
+    def read_frame(self):
+        """
+        Read one frame from the body.
+
+        @return: The metadata (as a JSON string) and the payload of the
+            frame, or None if the body has ended.
+        @rtype: tuple
+
+        @raise BadRequest: If the frame is truncated or too big.
+        """
+        chunk = self.read_chunk(FRAME_HEADER.size)
+        if chunk == '':
+            return None
+        self._kept = chunk
+        metadata_length, payload_length = FRAME_HEADER.unpack(
+            self.read_exactly(FRAME_HEADER.size))
+        if metadata_length + payload_length > self.max_entry_size:
+            raise http_app.BadRequest()
+        return (self.read_exactly(metadata_length),
+                self.read_exactly(payload_length))
+
+
 class HTTPInvocationByMethodWithBody(
         http_app.HTTPInvocationByMethodWithBody):
     """
@@ -181,8 +363,9 @@ class HTTPInvocationByMethodWithBody(
         """
         Call an HTTP method of a resource.
 
-        This method was rewritten to allow for a sync flow which uses one POST
-        request for each transferred document (back and forth).
+        This method was rewritten to allow for a sync flow which uses many POST
+        requests, each one transferring a batch of documents from the client
+        or one document to the client.
 
         Usual U1DB sync process transfers all documents from client to server
         and back in only one POST request. This is inconvenient for some
@@ -190,6 +373,11 @@ class HTTPInvocationByMethodWithBody(
         process, and possible timeouts for when dealing with large documents
         that have to be retrieved and encrypted/decrypted. Because of those,
         we split the sync process into many POST requests.
+
+        Syncing bodies may be either in the U1DB JSON stream format or in the
+        binary format of length-prefixed frames, as indicated by the 'format'
+        parameter of their content type. Request bodies may also be
+        compressed, as indicated by their content encoding.
         """
         args = urlparse.parse_qsl(self.environ['QUERY_STRING'],
                                   strict_parsing=False)
@@ -213,15 +401,31 @@ class HTTPInvocationByMethodWithBody(
                 raise http_app.BadRequest
             if content_length > self.max_request_size:
                 raise http_app.BadRequest
-            reader = http_app._FencedReader(
-                self.environ['wsgi.input'], content_length,
-                self.max_entry_size)
-            content_type = self.environ.get('CONTENT_TYPE')
+            rfile = self.environ['wsgi.input']
+            # decode compressed bodies, enforcing the maximum request size on
+            # the decoded data
+            encoding = self.environ.get('HTTP_CONTENT_ENCODING', 'identity')
+            encoding = encoding.strip().lower()
+            if encoding in _DecodedInput.WBITS:
+                rfile = _DecodedInput(
+                    rfile, content_length, encoding, self.max_request_size)
+                content_length = self.max_request_size
+            elif encoding != 'identity':
+                raise http_app.BadRequest
+            reader = _FrameReader(
+                rfile, content_length, self.max_entry_size)
+            content_type, wire_format = parse_content_type(
+                self.environ.get('CONTENT_TYPE'))
             if content_type == 'application/json':
                 meth = self._lookup(method)
                 body = reader.read_chunk(sys.maxint)
                 return meth(args, body)
             elif content_type.startswith('application/x-soledad-sync'):
+                if wire_format == BINARY_FORMAT:
+                    return self._call_binary_sync(
+                        method, args, content_type, reader)
+                if wire_format != JSON_FORMAT:
+                    raise http_app.BadRequest()
                 # read one line and validate it
                 body_getline = reader.getline
                 if body_getline().strip() != '[':
@@ -257,6 +461,54 @@ class HTTPInvocationByMethodWithBody(
             else:
                 raise http_app.BadRequest()
 
+    def _call_binary_sync(self, method, args, content_type, reader):
+        """
+        Call the sync methods of a resource for a body in the binary format.
+
+        The first frame carries the sync arguments, and the following ones
+        carry either the incoming documents or the information about which
+        documents should be returned.
+
+        @param method: The HTTP method of the request.
+        @type method: str
+        @param args: The arguments from the query string.
+        @type args: dict
+        @param content_type: The content type of the body, without the
+            format parameter.
+        @type content_type: str
+        @param reader: The reader of the request body.
+        @type reader: _FrameReader
+
+        @return: The result of the resource method.
+        """
+        self.resource.wire_format = BINARY_FORMAT
+        frame = reader.read_frame()
+        if frame is None:
+            raise http_app.BadRequest()
+        meth_args = self._lookup('%s_args' % method)
+        meth_args(args, frame[0])
+        # handle incoming documents
+        if content_type == 'application/x-soledad-sync-put':
+            meth_put = self._lookup('%s_put' % method)
+            meth_end = self._lookup('%s_end' % method)
+            frame = reader.read_frame()
+            while frame is not None:
+                try:
+                    entry = decode_doc_frame(json.loads(frame[0]), frame[1])
+                except (ValueError, TypeError, BrokenFrameError):
+                    raise http_app.BadRequest()
+                meth_put({}, json.dumps(entry))
+                frame = reader.read_frame()
+            return meth_end()
+        # handle outgoing documents
+        elif content_type == 'application/x-soledad-sync-get':
+            frame = reader.read_frame()
+            if frame is None or reader.read_frame() is not None:
+                raise http_app.BadRequest()
+            meth_get = self._lookup('%s_get' % method)
+            return meth_get({}, frame[0])
+        raise http_app.BadRequest()
+
 
 # monkey patch server with new http invocation
 http_app.HTTPInvocationByMethodWithBody = HTTPInvocationByMethodWithBody
@@ -278,6 +530,15 @@ def load_configuration(file_path):
     """
     conf = {
         'couch_url': 'http://localhost:5984',
+        'gzip_compresslevel': DEFAULT_COMPRESSLEVEL,
+        'gzip_min_size': DEFAULT_MIN_SIZE,
+        'sync_state_store': 'couch',
+        'profile': 'false',
+        'profile_rate': DEFAULT_RATE,
+        'profile_filter': '',
+        'profile_dir': DEFAULT_PROFILE_DIR,
+        'profile_max_files': DEFAULT_MAX_PROFILES,
+        'metrics_allowed_addresses': ', '.join(LOCAL_ADDRESSES),
     }
     config = configparser.ConfigParser()
     config.read(file_path)
@@ -290,21 +551,187 @@ def load_configuration(file_path):
     return conf
 
 
+def profiling_configured(conf):
+    """
+    Return whether a configuration enables profiling.
+
+    @param conf: The configuration, as returned by load_configuration().
+    @type conf: dict
+
+    @return: Whether profiling is enabled.
+    @rtype: bool
+    """
+    return str(conf['profile']).lower() in ('true', 'yes', 'on', '1')
+
+
 # ----------------------------------------------------------------------------
 # Run as Twisted WSGI Resource
 # ----------------------------------------------------------------------------
 
-def application(environ, start_response):
-    conf = load_configuration('/etc/leap/soledad-server.conf')
+CONFIG_FILE_PATH = '/etc/leap/soledad-server.conf'
+CONFIG_CHECK_INTERVAL = 5  # in seconds
+
+
+def make_application(conf):
+    """
+    Build the WSGI application stack for some configuration.
+
+    @param conf: The configuration, as returned by load_configuration().
+    @type conf: dict
+
+    @return: The WSGI application.
+    @rtype: MetricsMiddleware
+    """
     state = CouchServerState(
         conf['couch_url'],
         SoledadApp.SHARED_DB_NAME,
         SoledadTokenAuthMiddleware.TOKENS_DB)
-    # WSGI application that may be used by `twistd -web`
-    application = GzipMiddleware(
-        SoledadTokenAuthMiddleware(SoledadApp(state)))
+    SyncResource.sync_state_store = get_sync_state_store(
+        conf['sync_state_store'])
+    app = ProfilerMiddleware(
+        SoledadApp(state),
+        enabled=profiling_configured(conf),
+        rate=float(conf['profile_rate']),
+        path_filter=conf['profile_filter'] or None,
+        profile_dir=conf['profile_dir'],
+        max_profiles=int(conf['profile_max_files']))
+    return MetricsMiddleware(
+        GzipMiddleware(
+            SoledadTokenAuthMiddleware(app),
+            compresslevel=int(conf['gzip_compresslevel']),
+            min_size=int(conf['gzip_min_size'])),
+        allowed_addresses=tuple(
+            address.strip()
+            for address in conf['metrics_allowed_addresses'].split(',')
+            if address.strip()))
+
+
+class ReloadingApplication(object):
+    """
+    A WSGI application that builds the application stack once, and builds
+    it again when the configuration file changes or a reload is requested.
+
+    The stack holds long-lived state, like pooled couch connections and
+    cached database handles, which is shared by all requests.
+
+    Each time the stack is built, the signal handlers of the server are
+    installed for its configuration: SIGHUP requests a reload and, only when
+    profiling is configured, SIGUSR2 switches it off and on again.
+    """
+
+    def __init__(self, conf_path=CONFIG_FILE_PATH,
+                 check_interval=CONFIG_CHECK_INTERVAL):
+        """
+        Initialize the application.
+
+        @param conf_path: The path to the configuration file.
+        @type conf_path: str
+        @param check_interval: The minimum time (in seconds) between checks
+            for changes of the configuration file.
+        @type check_interval: int
+        """
+        self._conf_path = conf_path
+        self._check_interval = check_interval
+        self._app = None
+        self._mtime = None
+        self._checked = 0
+        self._reload_requested = False
+        self._lock = threading.Lock()
+
+    def request_reload(self, *args):
+        """
+        Make the next request build the application stack again.
+
+        This only sets a flag, so it may be used as a signal handler.
+        """
+        self._reload_requested = True
+
+    def install_signal_handlers(self, conf):
+        """
+        Install the signal handlers of the server for some configuration.
+
+        Signal handlers can only be installed from the main thread, which is
+        the one running the reactor.
+
+        @param conf: The configuration, as returned by load_configuration().
+        @type conf: dict
+        """
+        signal.signal(signal.SIGHUP, self.request_reload)
+        if profiling_configured(conf):
+            signal.signal(signal.SIGUSR2, ProfilerMiddleware.toggle)
+        else:
+            signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+
+    def _get_mtime(self):
+        """
+        Return the modification time of the configuration file.
+
+        @return: The modification time, or None if the file does not exist.
+        @rtype: float
+        """
+        try:
+            return os.stat(self._conf_path).st_mtime
+        except OSError:
+            return None
+
+    def _needs_reload(self):
+        """
+        Return whether the application stack may have to be built.
+
+        The configuration file is checked at most once every check interval.
+
+        @return: Whether the application stack may have to be built.
+        @rtype: bool
+        """
+        if self._app is None or self._reload_requested:
+            return True
+        now = time.time()
+        if now - self._checked < self._check_interval:
+            return False
+        self._checked = now
+        return self._get_mtime() != self._mtime
+
+    def _get_app(self):
+        """
+        Return the application stack, building it if needed.
+
+        @return: The WSGI application.
+        @rtype: MetricsMiddleware
+        """
+        if self._needs_reload():
+            with self._lock:
+                # another thread may have built the stack in the meantime
+                mtime = self._get_mtime()
+                if self._app is None or self._reload_requested \
+                        or mtime != self._mtime:
+                    self._reload_requested = False
+                    self._mtime = mtime
+                    self._checked = time.time()
+                    conf = load_configuration(self._conf_path)
+                    self._app = make_application(conf)
+                    # requests are handled in the reactor's thread pool
+                    reactor.callFromThread(
+                        self.install_signal_handlers, conf)
+        return self._app
+
+    def __call__(self, environ, start_response):
+        """
+        Handle a WSGI call with the current application stack.
+
+        @param environ: Dictionary containing CGI variables.
+        @type environ: dict
+        @param start_response: Callable of the form start_response(status,
+            response_headers, exc_info=None).
+        @type start_response: callable
+
+        @return: The results of the application.
+        @rtype: list
+        """
+        return self._get_app()(environ, start_response)
+
 
-    return application(environ, start_response)
+# WSGI application that may be used by `twistd -web`
+application = ReloadingApplication()
 
 
 from ._version import get_versions
@@ -22,15 +22,17 @@ Authentication facilities for Soledad Server.
 
 
 import httplib
+import re
 import simplejson as json
+import threading
+import time
 
 
-from u1db import DBNAME_CONSTRAINTS, errors as u1db_errors
+from u1db import errors as u1db_errors
 from abc import ABCMeta, abstractmethod
-from routes.mapper import Mapper
-from couchdb.client import Server
 from twisted.python import log
 from hashlib import sha512
+from collections import OrderedDict
 
 
 from leap.soledad.common import (
@@ -38,12 +40,18 @@ from leap.soledad.common import (
     SHARED_DB_LOCK_DOC_ID_PREFIX,
     USER_DB_PREFIX,
 )
+from leap.soledad.common.couch import couch_server
 from leap.soledad.common.errors import InvalidAuthTokenError
+from leap.soledad.common.metrics import METRICS
 
 
 class URLToAuthorization(object):
     """
     Verify if actions can be performed by a user.
+
+    The authorization rules do not depend on the user, so their regular
+    expressions are compiled only once. The uuid in the URL of user specific
+    resources is captured and compared with the user's uuid.
     """
 
     HTTP_METHOD_GET = 'GET'
@@ -51,22 +59,60 @@ class URLToAuthorization(object):
     HTTP_METHOD_DELETE = 'DELETE'
     HTTP_METHOD_POST = 'POST'
 
+    # The authorization rules, as (URL regexp, authorized methods) tuples:
+    #
+    #     URL path                      | Authorized actions
+    #     --------------------------------------------------
+    #     /                             | GET
+    #     /shared-db                    | GET
+    #     /shared-db/docs               | -
+    #     /shared-db/doc/{any_id}       | GET, PUT, DELETE
+    #     /shared-db/sync-from/{source} | -
+    #     /shared-db/lock/{uuid}        | PUT, DELETE
+    #     /user-db                      | GET, PUT, DELETE
+    #     /user-db/docs                 | -
+    #     /user-db/doc/{id}             | -
+    #     /user-db/sync-from/{source}   | GET, PUT, POST
+    #
+    # Rules whose regexp has an 'uuid' group only authorize the user with
+    # that uuid. Regexps end with \Z rather than $, which would also match
+    # before a trailing newline.
+    RULES = [
+        # auth info for global resource
+        (re.compile(r'^/\Z'),
+         (HTTP_METHOD_GET,)),
+        # auth info for shared-db database resource
+        (re.compile(r'^/%s\Z' % re.escape(SHARED_DB_NAME)),
+         (HTTP_METHOD_GET,)),
+        # auth info for shared-db doc resource
+        (re.compile(r'^/%s/doc/.*\Z' % re.escape(SHARED_DB_NAME)),
+         (HTTP_METHOD_GET, HTTP_METHOD_PUT, HTTP_METHOD_DELETE)),
+        # auth info for shared-db lock resource
+        (re.compile(
+            r'^/%s/lock/(?P<uuid>[^/]+)\Z' % re.escape(SHARED_DB_NAME)),
+         (HTTP_METHOD_PUT, HTTP_METHOD_DELETE)),
+        # auth info for user-db database resource
+        (re.compile(r'^/%s(?P<uuid>[^/]+)\Z' % re.escape(USER_DB_PREFIX)),
+         (HTTP_METHOD_GET, HTTP_METHOD_PUT, HTTP_METHOD_DELETE)),
+        # auth info for user-db sync resource
+        (re.compile(
+            r'^/%s(?P<uuid>[^/]+)/sync-from/[^/]+\Z'
+            % re.escape(USER_DB_PREFIX)),
+         (HTTP_METHOD_GET, HTTP_METHOD_PUT, HTTP_METHOD_POST)),
+    ]
+
     def __init__(self, uuid):
         """
-        Initialize the mapper.
+        Initialize the authorization verifier.
 
-        The C{uuid} is used to create the rules that will either allow or
-        disallow the user to perform specific actions.
+        The C{uuid} is used to either allow or disallow the user to perform
+        specific actions.
 
         @param uuid: The user uuid.
         @type uuid: str
-        @param user_db_prefix: The string prefix of users' databases.
-        @type user_db_prefix: str
         """
-        self._map = Mapper(controller_scan=None)
         self._user_db_name = "%s%s" % (USER_DB_PREFIX, uuid)
         self._uuid = uuid
-        self._register_auth_info()
 
     def is_authorized(self, environ):
         """
@@ -79,69 +125,15 @@ class URLToAuthorization(object):
         @return: Whether the action is authorized or not.
         @rtype: bool
         """
-        return self._map.match(environ=environ) is not None
-
-    def _register(self, pattern, http_methods):
-        """
-        Register a C{pattern} in the mapper as valid for C{http_methods}.
-
-        @param pattern: The URL pattern that corresponds to the user action.
-        @type pattern: str
-        @param http_methods: A list of authorized HTTP methods.
-        @type http_methods: list of str
-        """
-        self._map.connect(
-            None, pattern, http_methods=http_methods,
-            conditions=dict(method=http_methods),
-            requirements={'dbname': DBNAME_CONSTRAINTS})
-
-    def _register_auth_info(self):
-        """
-        Register the authorization info in the mapper using C{SHARED_DB_NAME}
-        as the user's database name.
-
-        This method sets up the following authorization rules:
-
-            URL path                      | Authorized actions
-            --------------------------------------------------
-            /                             | GET
-            /shared-db                    | GET
-            /shared-db/docs               | -
-            /shared-db/doc/{any_id}       | GET, PUT, DELETE
-            /shared-db/sync-from/{source} | -
-            /shared-db/lock/{uuid}        | PUT, DELETE
-            /user-db                      | GET, PUT, DELETE
-            /user-db/docs                 | -
-            /user-db/doc/{id}             | -
-            /user-db/sync-from/{source}   | GET, PUT, POST
-        """
-        # auth info for global resource
-        self._register('/', [self.HTTP_METHOD_GET])
-        # auth info for shared-db database resource
-        self._register(
-            '/%s' % SHARED_DB_NAME,
-            [self.HTTP_METHOD_GET])
-        # auth info for shared-db doc resource
-        self._register(
-            '/%s/doc/{id:.*}' % SHARED_DB_NAME,
-            [self.HTTP_METHOD_GET, self.HTTP_METHOD_PUT,
-             self.HTTP_METHOD_DELETE])
-        # auth info for shared-db lock resource
-        self._register(
-            '/%s/lock/%s' % (SHARED_DB_NAME, self._uuid),
-            [self.HTTP_METHOD_PUT, self.HTTP_METHOD_DELETE])
-        # auth info for user-db database resource
-        self._register(
-            '/%s' % self._user_db_name,
-            [self.HTTP_METHOD_GET, self.HTTP_METHOD_PUT,
-             self.HTTP_METHOD_DELETE])
-        # auth info for user-db sync resource
-        self._register(
-            '/%s/sync-from/{source_replica_uid}' % self._user_db_name,
-            [self.HTTP_METHOD_GET, self.HTTP_METHOD_PUT,
-             self.HTTP_METHOD_POST])
-        # generate the regular expressions
-        self._map.create_regs()
+        path = environ.get('PATH_INFO', '')
+        method = environ.get('REQUEST_METHOD')
+        for regexp, http_methods in self.RULES:
+            match = regexp.match(path)
+            if match is None or method not in http_methods:
+                continue
+            if match.groupdict().get('uuid', self._uuid) == self._uuid:
+                return True
+        return False
 
 
 class SoledadAuthMiddleware(object):
@@ -272,7 +264,10 @@ class SoledadAuthMiddleware(object):
 
         # verify if user is athenticated
         try:
-            if not self._verify_authentication_data(uuid, auth_data):
+            with METRICS.timed('auth'):
+                authenticated = self._verify_authentication_data(
+                    uuid, auth_data)
+            if not authenticated:
                 return self._unauthorized_error(
                     start_response,
                     self._get_auth_error_string())
@@ -349,9 +344,98 @@ class SoledadAuthMiddleware(object):
         return None
 
 
+class TokenCache(object):
+    """
+    A bounded cache of token verification results.
+
+    Results are kept by user uuid and token hash, so cleartext tokens are not
+    kept in memory. Valid and invalid tokens expire after different times,
+    and the least recently verified result makes room for new ones when the
+    cache is full.
+
+    Tokens are revoked outside of the server, by removing them from the
+    tokens database, so nothing tells the cache about it: a revoked token
+    keeps being accepted until its cached result expires, that is for up to
+    the time valid tokens are trusted for.
+    """
+
+    def __init__(self, max_size, ttl, invalid_ttl):
+        """
+        Initialize the token cache.
+
+        @param max_size: The maximum number of results to keep.
+        @type max_size: int
+        @param ttl: The time (in seconds) a valid token is trusted for.
+        @type ttl: int
+        @param invalid_ttl: The time (in seconds) an invalid token is
+            rejected for without querying couch.
+        @type invalid_ttl: int
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._invalid_ttl = invalid_ttl
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uuid, token_hash):
+        """
+        Return the cached verification result of a token.
+
+        @param uuid: The user uuid.
+        @type uuid: str
+        @param token_hash: The hash of the token.
+        @type token_hash: str
+
+        @return: Whether the token is valid for C{uuid}, or None if there is
+            no cached result.
+        @rtype: bool
+        """
+        key = (uuid, token_hash)
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is None:
+                return None
+            valid, expires = entry
+            if expires <= time.time():
+                del self._results[key]
+                return None
+            return valid
+
+    def put(self, uuid, token_hash, valid):
+        """
+        Cache the verification result of a token.
+
+        @param uuid: The user uuid.
+        @type uuid: str
+        @param token_hash: The hash of the token.
+        @type token_hash: str
+        @param valid: Whether the token is valid for C{uuid}.
+        @type valid: bool
+        """
+        ttl = self._ttl if valid else self._invalid_ttl
+        key = (uuid, token_hash)
+        with self._lock:
+            self._results.pop(key, None)
+            self._results[key] = (valid, time.time() + ttl)
+            while len(self._results) > self._max_size:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        """
+        Forget about all verification results.
+        """
+        with self._lock:
+            self._results.clear()
+
+
 class SoledadTokenAuthMiddleware(SoledadAuthMiddleware):
     """
     Token based authentication.
+
+    Token verification results are cached, so syncing many documents does
+    not make couch look the same token up for every request. A revoked token
+    may then still be accepted for up to TOKEN_CACHE_TTL seconds after it is
+    removed from the tokens database.
     """
 
     TOKENS_DB = "tokens"
@@ -361,6 +445,13 @@ class SoledadTokenAuthMiddleware(SoledadAuthMiddleware):
 
     TOKEN_AUTH_ERROR_STRING = "Incorrect address or token."
 
+    TOKEN_CACHE_SIZE = 10000
+    TOKEN_CACHE_TTL = 60  # in seconds
+    INVALID_TOKEN_CACHE_TTL = 10  # in seconds
+
+    token_cache = TokenCache(
+        TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL, INVALID_TOKEN_CACHE_TTL)
+
     def _verify_authentication_scheme(self, scheme):
         """
         Verify if authentication scheme is valid.
@@ -393,13 +484,41 @@ class SoledadTokenAuthMiddleware(SoledadAuthMiddleware):
         """
         token = auth_data  # we expect a cleartext token at this point
         try:
-            return self._verify_token_in_couch(uuid, token)
+            return self._verify_token(uuid, token)
         except InvalidAuthTokenError:
             raise
         except Exception as e:
             log.err(e)
             return False
 
+    def _verify_token(self, uuid, token):
+        """
+        Decide if C{token} is valid for C{uuid}, querying couchdb only if
+        there is no cached result.
+
+        @param uuid: The user uuid.
+        @type uuid: str
+        @param token: The token.
+        @type token: str
+
+        @raise InvalidAuthTokenError: Raised when token received from user is
+                                      either missing in the tokens db or is
+                                      invalid.
+        """
+        token_hash = sha512(token).hexdigest()
+        valid = self.token_cache.get(uuid, token_hash)
+        METRICS.increment(
+            'auth.token_cache.%s' % ('misses' if valid is None else 'hits'))
+        if valid is None:
+            try:
+                valid = self._verify_token_in_couch(uuid, token)
+            except InvalidAuthTokenError:
+                valid = False
+            self.token_cache.put(uuid, token_hash, valid)
+        if not valid:
+            raise InvalidAuthTokenError()
+        return True
+
     def _verify_token_in_couch(self, uuid, token):
         """
         Query couchdb to decide if C{token} is valid for C{uuid}.
@@ -413,11 +532,10 @@ class SoledadTokenAuthMiddleware(SoledadAuthMiddleware):
                                       either missing in the tokens db or is
                                       invalid.
         """
-        server = Server(url=self._app.state.couch_url)
-        dbname = self.TOKENS_DB
-        db = server[dbname]
-        # lookup key is a hash of the token to prevent timing attacks.
-        token = db.get(sha512(token).hexdigest())
+        with couch_server(self._app.state.couch_url) as server:
+            db = server[self.TOKENS_DB]
+            # lookup key is a hash of the token to prevent timing attacks.
+            token = db.get(sha512(token).hexdigest())
         if token is None:
             raise InvalidAuthTokenError()
         # we compare uuid hashes to avoid possible timing attacks that
@@ -17,51 +17,129 @@
 """
 Gzip middleware for WSGI apps.
 """
-import StringIO
-from gzip import GzipFile
+import time
+import zlib
+
+from leap.soledad.common.metrics import METRICS
+from leap.soledad.common.wire import BINARY_FORMAT, make_content_type
+
+
+DEFAULT_COMPRESSLEVEL = 6
+"""
+The default compression level. Higher levels spend much more CPU for a
+marginal size gain.
+"""
+
+DEFAULT_MIN_SIZE = 1024
+"""
+Responses whose content-length is smaller than this are not compressed.
+"""
+
+INCOMPRESSIBLE_TYPES = (
+    'image/',
+    'audio/',
+    'video/',
+    'application/zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/octet-stream',
+    # binary sync responses mostly carry raw ciphertext
+    make_content_type('application/x-soledad-sync-response', BINARY_FORMAT),
+)
+"""
+Prefixes of content types of responses that are not compressed.
+"""
 
 
 class GzipMiddleware(object):
     """
     GzipMiddleware class for WSGI.
+
+    Responses are compressed chunk by chunk as the application produces them,
+    so no copy of the whole response is held in memory.
     """
-    def __init__(self, app, compresslevel=9):
+    def __init__(self, app, compresslevel=DEFAULT_COMPRESSLEVEL,
+                 min_size=DEFAULT_MIN_SIZE,
+                 incompressible_types=INCOMPRESSIBLE_TYPES):
         self.app = app
         self.compresslevel = compresslevel
+        self.min_size = min_size
+        self.incompressible_types = incompressible_types
+
+    def _should_compress(self, headers):
+        """
+        Decide whether a response should be compressed based on its headers.
+
+        @param headers: The response headers.
+        @type headers: list of (name, value) tuples
+
+        @return: Whether the response should be compressed.
+        @rtype: bool
+        """
+        headers = dict((name.lower(), value) for name, value in headers)
+        if 'content-encoding' in headers:
+            return False
+        try:
+            if int(headers.get('content-length')) < self.min_size:
+                return False
+        except (TypeError, ValueError):
+            pass  # unknown length, the response is streamed
+        content_type = headers.get('content-type', '').lower()
+        for incompressible_type in self.incompressible_types:
+            if content_type.startswith(incompressible_type):
+                return False
+        return True
 
     def __call__(self, environ, start_response):
         if 'gzip' not in environ.get('HTTP_ACCEPT_ENCODING', ''):
             return self.app(environ, start_response)
 
-        buffer = StringIO.StringIO()
-        output = GzipFile(
-            mode='wb',
-            compresslevel=self.compresslevel,
-            fileobj=buffer
-        )
-
-        start_response_args = []
-
-        def dummy_start_response(status, headers, exc_info=None):
-            start_response_args.append(status)
-            start_response_args.append(headers)
-            start_response_args.append(exc_info)
-            return output.write
-
-        app_iter = self.app(environ, dummy_start_response)
-        for line in app_iter:
-            output.write(line)
-        if hasattr(app_iter, 'close'):
-            app_iter.close()
-        output.close()
-        buffer.seek(0)
-        result = buffer.getvalue()
-        headers = []
-        for name, value in start_response_args[1]:
-            if name.lower() != 'content-length':
-                headers.append((name, value))
-        headers.append(('Content-Length', str(len(result))))
-        headers.append(('Content-Encoding', 'gzip'))
-        start_response(start_response_args[0], headers, start_response_args[2])
-        buffer.close()
-        return [result]
+        # holds the compressor if the response is being compressed
+        compressor = []
+
+        def gzip_start_response(status, headers, exc_info=None):
+            del compressor[:]
+            if not self._should_compress(headers):
+                return start_response(status, headers, exc_info)
+            compressobj = zlib.compressobj(
+                self.compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            compressor.append(compressobj)
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'content-length']
+            headers.append(('Content-Encoding', 'gzip'))
+            headers.append(('Vary', 'Accept-Encoding'))
+            write = start_response(status, headers, exc_info)
+
+            def gzip_write(data):
+                data = compressobj.compress(data)
+                if data:
+                    write(data)
+
+            return gzip_write
+
+        app_iter = self.app(environ, gzip_start_response)
+        return self._compress(app_iter, compressor)
+
+    def _compress(self, app_iter, compressor):
+        """
+        Compress the chunks of a response as they are produced.
+
+        @param app_iter: The iterable returned by the application.
+        @type app_iter: iterable
+        @param compressor: A list holding the compressor, or an empty list if
+            the response is not compressed.
+        @type compressor: list
+        """
+        try:
+            for chunk in app_iter:
+                if compressor:
+                    start = time.time()
+                    chunk = compressor[0].compress(chunk)
+                    METRICS.add_to_request('gzip.time', time.time() - start)
+                if chunk:
+                    yield chunk
+            if compressor:
+                yield compressor[0].flush()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
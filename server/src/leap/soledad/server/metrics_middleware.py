@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# metrics_middleware.py
+# Copyright (C) 2014 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Metrics middleware for WSGI apps.
+"""
+import time
+
+import simplejson as json
+
+from leap.soledad.common.metrics import METRICS
+
+
+METRICS_PATH = '/_metrics'
+"""
+The path of the metrics endpoint.
+"""
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+"""
+The default addresses allowed to read the metrics.
+"""
+
+METHODS = ('GET', 'PUT', 'POST', 'DELETE', 'HEAD')
+"""
+Request methods recorded by name; other methods are recorded as 'other'.
+"""
+
+
+class MetricsMiddleware(object):
+    """
+    MetricsMiddleware class for WSGI.
+
+    Counts requests and records their latency by resource and method, along
+    with the time each request spent in couch, authentication and
+    compression. The metrics are served as JSON to clients whose address is
+    allowed.
+
+    Addresses are checked against REMOTE_ADDR only. Behind a reverse proxy
+    running on the same host every request comes from a local address, so
+    the proxy must not forward the metrics path, or the allowed addresses
+    must be changed (an empty list disables the endpoint).
+    """
+
+    def __init__(self, app, path=METRICS_PATH, metrics=METRICS,
+                 allowed_addresses=LOCAL_ADDRESSES):
+        """
+        Initialize the middleware.
+
+        @param app: The application to be instrumented.
+        @type app: callable
+        @param path: The path of the metrics endpoint.
+        @type path: str
+        @param metrics: The registry of the metrics.
+        @type metrics: leap.soledad.common.metrics.Metrics
+        @param allowed_addresses: The addresses allowed to read the metrics.
+        @type allowed_addresses: tuple
+        """
+        self.app = app
+        self.path = path
+        self.metrics = metrics
+        self.allowed_addresses = allowed_addresses
+
+    def _resource(self, path):
+        """
+        Return the name of the resource a request path refers to.
+
+        @param path: The request path.
+        @type path: str
+
+        @return: The name of the resource.
+        @rtype: str
+        """
+        parts = path.strip('/').split('/')
+        if parts == ['']:
+            return 'global'
+        if len(parts) == 1:
+            return 'database'
+        return {
+            'docs': 'docs',
+            'doc': 'doc',
+            'sync-from': 'sync',
+            'lock': 'lock',
+        }.get(parts[1], 'other')
+
+    def _serve_metrics(self, environ, start_response):
+        """
+        Send the current metrics, unless the request comes from an address
+        that is not allowed.
+        """
+        if environ.get('REMOTE_ADDR') not in self.allowed_addresses:
+            start_response('404 Not Found', [])
+            return []
+        body = json.dumps(self.metrics.snapshot())
+        start_response('200 OK', [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body)))])
+        return [body]
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == self.path:
+            return self._serve_metrics(environ, start_response)
+
+        method = environ.get('REQUEST_METHOD', 'GET')
+        name = '%s.%s' % (
+            self._resource(environ.get('PATH_INFO', '')),
+            method if method in METHODS else 'other')
+        # holds the status of the response
+        status = []
+
+        def metrics_start_response(status_line, headers, exc_info=None):
+            status[:] = [status_line[:1]]
+            return start_response(status_line, headers, exc_info)
+
+        start = time.time()
+        self.metrics.start_request()
+        try:
+            app_iter = self.app(environ, metrics_start_response)
+        except:
+            self._record(name, start, status)
+            raise
+        return self._iterate(app_iter, name, start, status)
+
+    def _iterate(self, app_iter, name, start, status):
+        """
+        Pass on the chunks of a response, and record the metrics of the
+        request once it has been sent.
+
+        @param app_iter: The iterable returned by the application.
+        @type app_iter: iterable
+        @param name: The name of the resource and method of the request.
+        @type name: str
+        @param start: The time the request started.
+        @type start: float
+        @param status: A list holding the first digit of the response status,
+            or an empty list if the response was not started.
+        @type status: list
+        """
+        try:
+            for chunk in app_iter:
+                yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            self._record(name, start, status)
+
+    def _record(self, name, start, status):
+        """
+        Record the metrics of a request.
+
+        @param name: The name of the resource and method of the request.
+        @type name: str
+        @param start: The time the request started.
+        @type start: float
+        @param status: A list holding the first digit of the response status,
+            or an empty list if the response was not started.
+        @type status: list
+        """
+        self.metrics.end_request()
+        self.metrics.increment('requests.%s' % name)
+        self.metrics.increment(
+            'responses.%sxx' % (status[0] if status else 5))
+        self.metrics.observe('latency.%s' % name, time.time() - start)
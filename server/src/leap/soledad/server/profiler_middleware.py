@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# profiler_middleware.py
+# Copyright (C) 2014 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Profiler middleware for WSGI apps.
+"""
+import cProfile
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+from twisted.python import log
+
+
+DEFAULT_RATE = 0.01
+"""
+The default fraction of requests that are profiled.
+"""
+
+DEFAULT_PROFILE_DIR = '/tmp/soledad-profiles'
+"""
+The default directory where profiles are written.
+"""
+
+DEFAULT_MAX_PROFILES = 50
+"""
+The default number of profile files kept in the profile directory.
+"""
+
+FLUSH_REQUESTS = 100
+FLUSH_INTERVAL = 60  # in seconds
+
+
+class ProfilerMiddleware(object):
+    """
+    ProfilerMiddleware class for WSGI.
+
+    Profiles a fraction of requests, and the requests whose path matches a
+    filter (for example a user's database or the sync resource), with
+    cProfile. The profiles of many requests are aggregated and written to a
+    file in the profile directory every FLUSH_REQUESTS profiled requests or
+    FLUSH_INTERVAL seconds, keeping only the newest files.
+
+    When profiling is disabled, requests are passed on without any other
+    work. Profiling can be switched on and off at runtime with toggle(), and
+    the profiles collected before it was switched off are written when the
+    next request arrives. Profiles that cannot be written are logged and
+    dropped.
+    """
+
+    toggled = False
+    """
+    Whether profiling has been switched from its configured state.
+    """
+
+    def __init__(self, app, enabled=False, rate=DEFAULT_RATE,
+                 path_filter=None, profile_dir=DEFAULT_PROFILE_DIR,
+                 max_profiles=DEFAULT_MAX_PROFILES,
+                 flush_requests=FLUSH_REQUESTS, flush_interval=FLUSH_INTERVAL):
+        """
+        Initialize the middleware.
+
+        @param app: The application to be profiled.
+        @type app: callable
+        @param enabled: Whether profiling is enabled.
+        @type enabled: bool
+        @param rate: The fraction of requests to profile.
+        @type rate: float
+        @param path_filter: A regular expression; requests whose path
+            matches it are always profiled.
+        @type path_filter: str
+        @param profile_dir: The directory where profiles are written.
+        @type profile_dir: str
+        @param max_profiles: The number of profile files to keep.
+        @type max_profiles: int
+        @param flush_requests: The number of profiled requests aggregated in
+            each profile file.
+        @type flush_requests: int
+        @param flush_interval: The maximum time (in seconds) between writes
+            of profile files.
+        @type flush_interval: int
+        """
+        self.app = app
+        self.enabled = enabled
+        self.rate = rate
+        self.path_filter = re.compile(path_filter) if path_filter else None
+        self.profile_dir = profile_dir
+        self.max_profiles = max_profiles
+        self.flush_requests = flush_requests
+        self.flush_interval = flush_interval
+        self._profiles = []
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def toggle(cls, *args):
+        """
+        Switch profiling on if it is configured off, and the other way
+        around.
+
+        This only flips a flag, so it may be used as a signal handler.
+        """
+        cls.toggled = not cls.toggled
+
+    def _should_profile(self, environ):
+        """
+        Decide whether a request should be profiled.
+
+        @param environ: Dictionary containing CGI variables.
+        @type environ: dict
+
+        @return: Whether the request should be profiled.
+        @rtype: bool
+        """
+        if self.path_filter is not None \
+                and self.path_filter.search(environ.get('PATH_INFO', '')):
+            return True
+        return random.random() < self.rate
+
+    def __call__(self, environ, start_response):
+        if self.enabled == self.toggled:
+            if self._profiles:
+                # profiling was switched off
+                self._flush()
+            return self.app(environ, start_response)
+        if not self._should_profile(environ):
+            return self.app(environ, start_response)
+        profile = cProfile.Profile()
+        try:
+            app_iter = profile.runcall(self.app, environ, start_response)
+        except:
+            self._collect(profile)
+            raise
+        return self._iterate(app_iter, profile)
+
+    def _iterate(self, app_iter, profile):
+        """
+        Pass on the chunks of a response, profiling only their production.
+
+        @param app_iter: The iterable returned by the application.
+        @type app_iter: iterable
+        @param profile: The profile of the request.
+        @type profile: cProfile.Profile
+        """
+        iterator = iter(app_iter)
+        try:
+            while True:
+                profile.enable()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    profile.disable()
+                yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            self._collect(profile)
+
+    def _collect(self, profile):
+        """
+        Keep the profile of a request, and write the aggregated profiles if
+        enough requests or time have passed.
+
+        @param profile: The profile of the request.
+        @type profile: cProfile.Profile
+        """
+        with self._lock:
+            self._profiles.append(profile)
+            if len(self._profiles) < self.flush_requests \
+                    and time.time() - self._flushed < self.flush_interval:
+                return
+        self._flush()
+
+    def _flush(self):
+        """
+        Write the aggregated profiles collected so far, if any.
+        """
+        with self._lock:
+            profiles = self._profiles
+            self._profiles = []
+            self._flushed = time.time()
+        if profiles:
+            self._write(profiles)
+
+    def _write(self, profiles):
+        """
+        Write the aggregated stats of some profiles to a new file, and remove
+        the oldest files.
+
+        Errors are logged and the profiles are dropped, so that profiling
+        never fails a request.
+
+        @param profiles: The profiles.
+        @type profiles: list of cProfile.Profile
+        """
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        name = 'soledad-%.6f-%d.prof' % (time.time(), len(profiles))
+        path = os.path.join(self.profile_dir, name)
+        try:
+            if not os.path.isdir(self.profile_dir):
+                os.makedirs(self.profile_dir)
+            stats.dump_stats(path + '.tmp')
+            os.rename(path + '.tmp', path)
+            names = sorted(
+                name for name in os.listdir(self.profile_dir)
+                if name.startswith('soledad-') and name.endswith('.prof'))
+            for name in names[:-self.max_profiles]:
+                os.remove(os.path.join(self.profile_dir, name))
+        except (IOError, OSError) as e:
+            log.msg("Could not write profile %s: %s" % (path, e))
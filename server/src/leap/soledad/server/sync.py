@@ -20,118 +20,173 @@
 Server side synchronization infrastructure.
 """
 
-import json
-
-
-from leap.soledad.common.couch import CouchDatabase
+import threading
+import time
+
+
+from leap.soledad.common.errors import SyncSessionExpiredError
+from leap.soledad.common.metrics import METRICS
+from leap.soledad.common.wire import (
+    JSON_FORMAT,
+    BINARY_FORMAT,
+    SUPPORTED_FORMATS,
+    FORMATS_HEADER,
+    REQUEST_ENCODINGS,
+    REQUEST_ENCODINGS_HEADER,
+    encode_frame,
+    encode_doc_frame,
+    make_content_type,
+)
+from collections import OrderedDict
 from itertools import izip
 from u1db import sync, Document
 from u1db.remote import http_app
 
+from leap.soledad.server.sync_state import CouchSyncStateStore
+
 
 MAX_REQUEST_SIZE = 200  # in Mb
 MAX_ENTRY_SIZE = 200  # in Mb
+MAX_GET_LIMIT = 1000  # max number of docs returned in one sync-get request
+MAX_PUT_BATCH = 100  # max number of incoming docs put in one bulk request
+MAX_SYNC_SESSIONS = 1000  # max number of sync sessions kept in memory
+SYNC_SESSION_TTL = 600  # in seconds
 
 
-class ServerSyncState(object):
+class SyncSessions(object):
     """
-    The state of one sync session, as stored on backend server.
+    A bounded in-memory cache of the sync sessions whose initial arguments
+    have already been validated by the server.
 
-    This object performes queries to distinct design documents:
-
-        _design/syncs/_update/state
-        _design/syncs/_view/state
-        _design/syncs/_view/seen_ids
-        _design/syncs/_view/changes_to_return
-
-    On server side, the ongoing syncs metadata is maintained in a document
-    called 'u1db_sync_state'.
+    Once a session is known, the client may continue it by sending only the
+    sync_id on the prologue of subsequent requests, and the server skips
+    validating the client's knowledge about the server replica again.
     """
 
-    def __init__(self, db, source_replica_uid, sync_id):
+    def __init__(self, max_sessions=MAX_SYNC_SESSIONS, ttl=SYNC_SESSION_TTL):
         """
-        Initialize the sync state object.
-
-        :param db: The target syncing database.
-        :type db: CouchDatabase.
-        :param source_replica_uid: CouchDatabase
-        :type source_replica_uid: str
+        Initialize the sync sessions cache.
+
+        :param max_sessions: The maximum number of sessions to keep. The least
+                             recently used session is discarded when this
+                             number is exceeded.
+        :type max_sessions: int
+        :param ttl: The time (in seconds) after which an unused session
+                    expires.
+        :type ttl: int
         """
-        self._db = db
-        self._source_replica_uid = source_replica_uid
-        self._sync_id = sync_id
+        self._max_sessions = max_sessions
+        self._ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
 
-    def _key(self, key):
+    def put(self, key, last_known_generation):
         """
-        Format a key to be used on couch views.
+        Store a validated sync session.
 
-        :param key: The lookup key.
-        :type key: json serializable object
+        :param key: The (dbname, source_replica_uid, sync_id) tuple that
+                    identifies the session.
+        :type key: tuple
+        :param last_known_generation: The last server replica generation the
+                                      client knows about.
+        :type last_known_generation: int
+        """
+        with self._lock:
+            self._sessions.pop(key, None)
+            self._sessions[key] = (last_known_generation, time.time())
+            while len(self._sessions) > self._max_sessions:
+                self._sessions.popitem(last=False)
 
-        :return: The properly formatted key.
-        :rtype: str
+    def get(self, key):
         """
-        return json.dumps(key, separators=(',', ':'))
+        Return the last known generation stored for a sync session.
+
+        :param key: The (dbname, source_replica_uid, sync_id) tuple that
+                    identifies the session.
+        :type key: tuple
 
-    def _put_info(self, key, value):
+        :return: The last known generation for the session, or None if the
+                 session is unknown or has expired.
+        :rtype: int
+        """
+        with self._lock:
+            session = self._sessions.pop(key, None)
+            if session is None:
+                return None
+            last_known_generation, last_used = session
+            now = time.time()
+            if now - last_used > self._ttl:
+                return None
+            self._sessions[key] = (last_known_generation, now)
+            return last_known_generation
+
+    def clear(self):
+        """
+        Forget about all sync sessions.
         """
-        Put some information on the sync state document.
+        with self._lock:
+            self._sessions.clear()
+
+
+class ServerSyncState(object):
+    """
+    The state of one sync session, as stored on the server.
 
-        This method works in conjunction with the
-        _design/syncs/_update/state update handler couch backend.
+    The state is kept by a sync state store, so each incoming document costs
+    the same no matter how many documents the session has already seen.
+    """
 
-        :param key: The key for the info to be put.
-        :type key: str
-        :param value: The value for the info to be put.
-        :type value: str
+    def __init__(self, db, source_replica_uid, sync_id, store=None):
         """
-        ddoc_path = [
-            '_design', 'syncs', '_update', 'state',
-            'u1db_sync_state']
-        res = self._db._database.resource(*ddoc_path)
-        with CouchDatabase.sync_info_lock[self._db.replica_uid]:
-            res.put_json(
-                body={
-                    'sync_id': self._sync_id,
-                    'source_replica_uid': self._source_replica_uid,
-                    key: value,
-                },
-                headers={'content-type': 'application/json'})
+        Initialize the sync state object.
 
-    def put_seen_id(self, seen_id, gen):
+        :param db: The target syncing database.
+        :type db: CouchDatabase.
+        :param source_replica_uid: The uid of the source syncing replica.
+        :type source_replica_uid: str
+        :param sync_id: The id of the current sync session.
+        :type sync_id: str
+        :param store: The store where the sync state is kept. Defaults to a
+                      store that keeps it in the target syncing database.
+        :type store: SyncStateStore
         """
-        Put one seen id on the sync state document.
+        self._db = db
+        self._source_replica_uid = source_replica_uid
+        self._sync_id = sync_id
+        if store is None:
+            store = CouchSyncStateStore()
+        self._store = store
+        # once stored, the sync info does not change during the session
+        self._sync_info = None
 
-        :param seen_id: The doc_id of a document seen during sync.
-        :type seen_id: str
-        :param gen: The corresponding db generation for that document.
-        :type gen: int
+    def put_seen_ids(self, seen_ids):
         """
-        self._put_info(
-            'seen_id',
-            [seen_id, gen])
+        Put many seen ids on the sync state.
+
+        :param seen_ids: A list of (doc_id, gen) tuples for the documents
+                         seen during sync and their db generations.
+        :type seen_ids: list
+        """
+        with METRICS.timed('sync_state.put_seen_ids'):
+            self._store.put_seen_ids(
+                self._db, self._source_replica_uid, self._sync_id, seen_ids)
 
     def seen_ids(self):
         """
         Return all document ids seen during the sync.
 
-        :return: A list with doc ids seen during the sync.
-        :rtype: list
+        :return: A dictionary mapping doc ids seen during the sync to their
+                 generations.
+        :rtype: dict
         """
-        ddoc_path = ['_design', 'syncs', '_view', 'seen_ids']
-        resource = self._db._database.resource(*ddoc_path)
-        response = resource.get_json(
-            key=self._key([self._source_replica_uid, self._sync_id]))
-        data = response[2]
-        if data['rows']:
-            entry = data['rows'].pop()
-            return entry['value']['seen_ids']
-        return []
+        with METRICS.timed('sync_state.seen_ids'):
+            return self._store.seen_ids(
+                self._db, self._source_replica_uid, self._sync_id)
 
     def put_changes_to_return(self, gen, trans_id, changes_to_return):
         """
-        Put the calculated changes to return in the backend sync state
-        document.
+        Put the calculated changes to return in the sync state, unless they
+        have already been put by a concurrent request.
 
         :param gen: The target database generation that will be synced.
         :type gen: int
@@ -141,15 +196,16 @@ class ServerSyncState(object):
         :param changes_to_return: A list of tuples with the changes to be
                                   returned during the sync process.
         :type changes_to_return: list
+
+        :return: The generation, transaction id and number of changes stored
+                 in the sync state.
+        :rtype: tuple
         """
-        self._put_info(
-            'changes_to_return',
-            {
-                'gen': gen,
-                'trans_id': trans_id,
-                'changes_to_return': changes_to_return,
-            }
-        )
+        with METRICS.timed('sync_state.put_changes_to_return'):
+            self._sync_info = self._store.put_changes_to_return(
+                self._db, self._source_replica_uid, self._sync_id, gen,
+                trans_id, changes_to_return)
+        return self._sync_info
 
     def sync_info(self):
         """
@@ -161,47 +217,47 @@ class ServerSyncState(object):
                  server.
         :rtype: tuple
         """
-        ddoc_path = ['_design', 'syncs', '_view', 'state']
-        resource = self._db._database.resource(*ddoc_path)
-        response = resource.get_json(
-            key=self._key([self._source_replica_uid, self._sync_id]))
-        data = response[2]
-        gen = None
-        trans_id = None
-        number_of_changes = None
-        if data['rows'] and data['rows'][0]['value'] is not None:
-            value = data['rows'][0]['value']
-            gen = value['gen']
-            trans_id = value['trans_id']
-            number_of_changes = value['number_of_changes']
-        return gen, trans_id, number_of_changes
-
-    def next_change_to_return(self, received):
-        """
-        Return the next change to be returned to the source syncing replica.
+        if self._sync_info is None:
+            with METRICS.timed('sync_state.sync_info'):
+                sync_info = self._store.sync_info(
+                    self._db, self._source_replica_uid, self._sync_id)
+            if sync_info[2] is None:
+                return sync_info
+            self._sync_info = sync_info
+        return self._sync_info
+
+    def next_changes_to_return(self, received, limit=1):
+        """
+        Return the next changes to be returned to the source syncing replica.
 
         :param received: How many documents the source replica has already
                          received during the current sync process.
         :type received: int
+        :param limit: The maximum number of changes to return.
+        :type limit: int
+
+        :return: The generation and transaction id of the target database
+                 which will be synced, and a list of at most `limit` tuples
+                 (doc_id, gen, trans_id) of changes to be returned, or
+                 (None, None, []) if there are no more changes.
+        :rtype: tuple
         """
-        ddoc_path = ['_design', 'syncs', '_view', 'changes_to_return']
-        resource = self._db._database.resource(*ddoc_path)
-        response = resource.get_json(
-            key=self._key(
-                [self._source_replica_uid, self._sync_id, received]))
-        data = response[2]
-        if not data['rows']:
-            return None, None, None
-        value = data['rows'][0]['value']
-        gen = value['gen']
-        trans_id = value['trans_id']
-        next_change_to_return = value['next_change_to_return']
-        return gen, trans_id, tuple(next_change_to_return)
+        if limit <= 0:
+            return None, None, []
+        with METRICS.timed('sync_state.changes_to_return'):
+            changes = self._store.changes_to_return(
+                self._db, self._source_replica_uid, self._sync_id, received,
+                limit)
+        if not changes:
+            return None, None, []
+        gen, trans_id, _ = self.sync_info()
+        return gen, trans_id, changes
 
 
 class SyncExchange(sync.SyncExchange):
 
-    def __init__(self, db, source_replica_uid, last_known_generation, sync_id):
+    def __init__(self, db, source_replica_uid, last_known_generation, sync_id,
+                 sync_state_store=None):
         """
         :param db: The target syncing database.
         :type db: CouchDatabase
@@ -212,6 +268,9 @@ class SyncExchange(sync.SyncExchange):
         :type last_known_generation: int
         :param sync_id: The id of the current sync session.
         :type sync_id: str
+        :param sync_state_store: The store where the state of the sync
+                                 session is kept.
+        :type sync_state_store: SyncStateStore
         """
         self._db = db
         self.source_replica_uid = source_replica_uid
@@ -222,10 +281,10 @@ class SyncExchange(sync.SyncExchange):
         self._trace_hook = None
         # recover sync state
         self._sync_state = ServerSyncState(
-            self._db, self.source_replica_uid, sync_id)
-
+            self._db, self.source_replica_uid, sync_id,
+            store=sync_state_store)
 
-    def find_changes_to_return(self, received):
+    def find_changes_to_return(self, received, limit=1):
         """
         Find changes to return.
 
@@ -236,6 +295,9 @@ class SyncExchange(sync.SyncExchange):
         :param received: How many documents the source replica has already
                          received during the current sync process.
         :type received: int
+        :param limit: The maximum number of changes to be returned in the
+                      current request.
+        :type limit: int
 
         :return: the generation of this database, which the caller can
                  consider themselves to be synchronized after processing
@@ -256,78 +318,67 @@ class SyncExchange(sync.SyncExchange):
                 (doc_id, gen, trans_id) for (doc_id, gen, trans_id) in changes
                 # there was a subsequent update
                 if doc_id not in seen_ids or seen_ids.get(doc_id) < gen]
-            self._sync_state.put_changes_to_return(
-                new_gen, new_trans_id, changes_to_return)
-            number_of_changes = len(changes_to_return)
+            new_gen, new_trans_id, number_of_changes = \
+                self._sync_state.put_changes_to_return(
+                    new_gen, new_trans_id, changes_to_return)
         # query server for stored changes
-        _, _, next_change_to_return = \
-            self._sync_state.next_change_to_return(received)
+        _, _, changes_to_return = \
+            self._sync_state.next_changes_to_return(received, limit)
         self.new_gen = new_gen
         self.new_trans_id = new_trans_id
-        # and append one change
-        self.change_to_return = next_change_to_return
+        # and append the changes
+        self.changes_to_return = changes_to_return
         return self.new_gen, number_of_changes
 
-    def return_one_doc(self, return_doc_cb):
+    def return_docs(self, return_doc_cb):
         """
-        Return one changed document and its last change generation to the
+        Return the changed documents found by the last call to
+        find_changes_to_return() and their last change generation to the
         source syncing replica by invoking the callback return_doc_cb.
 
-        This is called once for each document to be transferred from target to
-        source.
+        This is called once for each batch of documents to be transferred from
+        target to source.
 
         :param return_doc_cb: is a callback used to return the documents with
                               their last change generation to the target
                               replica.
         :type return_doc_cb: callable(doc, gen, trans_id)
         """
-        if self.change_to_return is not None:
-            changed_doc_id, gen, trans_id = self.change_to_return
-            doc = self._db.get_doc(changed_doc_id, include_deleted=True)
+        # documents are fetched in bulk, in the order of the changes
+        docs = self._db.get_docs(
+            [doc_id for doc_id, _, _ in self.changes_to_return],
+            check_for_conflicts=True, include_deleted=True)
+        for (_, gen, trans_id), doc in izip(self.changes_to_return, docs):
             return_doc_cb(doc, gen, trans_id)
 
-    def insert_doc_from_source(self, doc, source_gen, trans_id,
-            number_of_docs=None, doc_idx=None, sync_id=None):
-        """Try to insert synced document from source.
-
-        Conflicting documents are not inserted but will be sent over
-        to the sync source.
-
-        It keeps track of progress by storing the document source
-        generation as well.
+    def insert_docs_from_source(self, entries, number_of_docs=None,
+                                sync_id=None):
+        """
+        Try to insert a batch of synced documents from source.
 
-        The 1st step of a sync exchange is to call this repeatedly to
-        try insert all incoming documents from the source.
+        The documents are put into the target database with bulk requests.
+        Conflicting documents are not inserted but will be sent over to the
+        sync source. It keeps track of progress by storing the document
+        source generations as well.
 
-        :param doc: A Document object.
-        :type doc: Document
-        :param source_gen: The source generation of doc.
-        :type source_gen: int
-        :param trans_id: The transaction id of that document change.
-        :type trans_id: str
+        :param entries: A list of (doc, source_gen, trans_id, doc_idx) tuples
+                        for the incoming documents.
+        :type entries: list
         :param number_of_docs: The total amount of documents sent on this sync
                                session.
         :type number_of_docs: int
-        :param doc_idx: The index of the current document.
-        :type doc_idx: int
         :param sync_id: The id of the current sync session.
         :type sync_id: str
         """
-        state, at_gen = self._db._put_doc_if_newer(
-            doc, save_conflict=False, replica_uid=self.source_replica_uid,
-            replica_gen=source_gen, replica_trans_id=trans_id,
-            number_of_docs=number_of_docs, doc_idx=doc_idx, sync_id=sync_id)
-        if state == 'inserted':
-            self._sync_state.put_seen_id(doc.doc_id, at_gen)
-        elif state == 'converged':
-            # magical convergence
-            self._sync_state.put_seen_id(doc.doc_id, at_gen)
-        elif state == 'superseded':
-            # we have something newer that we will return
-            pass
-        else:
-            # conflict that we will returne
-            assert state == 'conflicted'
+        results = self._db._put_docs_if_newer(
+            entries, save_conflict=False,
+            replica_uid=self.source_replica_uid,
+            number_of_docs=number_of_docs, sync_id=sync_id)
+        # superseded and conflicted documents will be returned
+        self._sync_state.put_seen_ids([
+            (doc.doc_id, at_gen)
+            for (doc, _, _, _), (state, at_gen) in izip(entries, results)
+            if state in ('inserted', 'converged')])
 
 
 class SyncResource(http_app.SyncResource):
@@ -337,14 +388,53 @@ class SyncResource(http_app.SyncResource):
 
     sync_exchange_class = SyncExchange
 
+    sync_sessions = SyncSessions()
+
+    sync_state_store = CouchSyncStateStore()
+    """
+    The store where the state of ongoing sync sessions is kept.
+    """
+
+    wire_format = JSON_FORMAT
+    """
+    The wire format of the current request body, which is also used for the
+    response.
+    """
+
+    @http_app.http_method()
+    def get(self):
+        """
+        Return information about the sync state of the source replica.
+
+        The wire formats supported for syncing bodies and the content codings
+        accepted for request bodies are announced in headers, so clients can
+        choose among them.
+        """
+        result = self.state.open_database(self.dbname).get_sync_target() \
+            .get_sync_info(self.source_replica_uid)
+        self.responder.send_response_json(
+            headers={
+                FORMATS_HEADER: ', '.join(SUPPORTED_FORMATS),
+                REQUEST_ENCODINGS_HEADER: ', '.join(REQUEST_ENCODINGS),
+            },
+            target_replica_uid=result[0],
+            target_replica_generation=result[1],
+            target_replica_transaction_id=result[2],
+            source_replica_uid=self.source_replica_uid,
+            source_replica_generation=result[3],
+            source_transaction_id=result[4])
+
     @http_app.http_method(
         last_known_generation=int, last_known_trans_id=http_app.none_or_str,
         sync_id=http_app.none_or_str, content_as_args=True)
-    def post_args(self, last_known_generation, last_known_trans_id=None,
+    def post_args(self, last_known_generation=None, last_known_trans_id=None,
                   sync_id=None, ensure=False):
         """
         Handle the initial arguments for the sync POST request from client.
 
+        If only the sync_id is given, the client is continuing a sync session
+        whose full arguments have already been validated by the server.
+
         :param last_known_generation: The last server replica generation the
                                       client knows about.
         :type last_known_generation: int
@@ -356,19 +446,38 @@ class SyncResource(http_app.SyncResource):
         :param ensure: Whether the server replica should be created if it does
                        not already exist.
         :type ensure: bool
+
+        :raise SyncSessionExpiredError: If the client tries to continue a
+                                        sync session that is not known by the
+                                        server.
         """
-        # create or open the database
-        if ensure:
-            db, self.replica_uid = self.state.ensure_database(self.dbname)
-        else:
+        session_key = (self.dbname, self.source_replica_uid, sync_id)
+        if last_known_generation is None:
+            # continue a known sync session
+            if sync_id is None:
+                raise http_app.BadRequest()
+            last_known_generation = self.sync_sessions.get(session_key)
+            if last_known_generation is None:
+                raise SyncSessionExpiredError()
             db = self.state.open_database(self.dbname)
-        # validate the information the client has about server replica
-        db.validate_gen_and_trans_id(
-            last_known_generation, last_known_trans_id)
+        else:
+            # create or open the database
+            if ensure:
+                db, self.replica_uid = self.state.ensure_database(self.dbname)
+            else:
+                db = self.state.open_database(self.dbname)
+            # validate the information the client has about server replica
+            db.validate_gen_and_trans_id(
+                last_known_generation, last_known_trans_id)
+            if sync_id is not None:
+                self.sync_sessions.put(session_key, last_known_generation)
         # get a sync exchange object
         self.sync_exch = self.sync_exchange_class(
-            db, self.source_replica_uid, last_known_generation, sync_id)
+            db, self.source_replica_uid, last_known_generation, sync_id,
+            sync_state_store=self.sync_state_store)
         self._sync_id = sync_id
+        self._incoming_docs = []
+        self._number_of_docs = None
 
     @http_app.http_method(content_as_args=True)
     def post_put(self, id, rev, content, gen, trans_id, number_of_docs,
@@ -376,6 +485,11 @@ class SyncResource(http_app.SyncResource):
         """
         Put one incoming document into the server replica.
 
+        This is called once for each document entry in the body of a
+        sync-put request, so one request may carry a batch of documents.
+        Incoming documents are accumulated and put into the server replica
+        in batches of MAX_PUT_BATCH documents.
+
         :param id: The id of the incoming document.
         :type id: str
         :param rev: The revision of the incoming document.
@@ -394,31 +508,41 @@ class SyncResource(http_app.SyncResource):
         :param doc_idx: The index of the current document.
         :type doc_idx: int
         """
+        METRICS.increment('sync.docs_received')
         doc = Document(id, rev, content)
-        self.sync_exch.insert_doc_from_source(
-            doc, gen, trans_id, number_of_docs=number_of_docs,
-            doc_idx=doc_idx, sync_id=self._sync_id)
+        self._incoming_docs.append((doc, gen, trans_id, doc_idx))
+        self._number_of_docs = number_of_docs
+        if len(self._incoming_docs) >= MAX_PUT_BATCH:
+            self._put_incoming_docs()
 
-    @http_app.http_method(received=int, content_as_args=True)
-    def post_get(self, received):
+    def _put_incoming_docs(self):
+        """
+        Put the accumulated incoming documents into the server replica.
+        """
+        if self._incoming_docs:
+            with METRICS.timed('sync.put_docs'):
+                self.sync_exch.insert_docs_from_source(
+                    self._incoming_docs, number_of_docs=self._number_of_docs,
+                    sync_id=self._sync_id)
+            self._incoming_docs = []
+
+    @http_app.http_method(received=int, limit=int, content_as_args=True)
+    def post_get(self, received, limit=1):
         """
-        Return one syncing document to the client.
+        Return a batch of syncing documents to the client.
 
         :param received: How many documents have already been received by the
                          client on the current sync session.
         :type received: int
+        :param limit: The maximum number of documents to be returned. If 0,
+                      only the header with information about the sync session
+                      is returned.
+        :type limit: int
         """
 
-        def send_doc(doc, gen, trans_id):
-            entry = dict(id=doc.doc_id, rev=doc.rev, content=doc.get_json(),
-                         gen=gen, trans_id=trans_id)
-            self.responder.stream_entry(entry)
-
         new_gen, number_of_changes = \
-            self.sync_exch.find_changes_to_return(received)
-        self.responder.content_type = 'application/x-u1db-sync-response'
-        self.responder.start_response(200)
-        self.responder.start_stream(),
+            self.sync_exch.find_changes_to_return(
+                received, max(0, min(limit, MAX_GET_LIMIT)))
         header = {
             "new_generation": new_gen,
             "new_transaction_id": self.sync_exch.new_trans_id,
@@ -426,16 +550,52 @@ class SyncResource(http_app.SyncResource):
         }
         if self.replica_uid is not None:
             header['replica_uid'] = self.replica_uid
+
+        if self.wire_format == BINARY_FORMAT:
+            self._post_get_binary(header)
+            return
+
+        def send_doc(doc, gen, trans_id):
+            METRICS.increment('sync.docs_sent')
+            entry = dict(id=doc.doc_id, rev=doc.rev, content=doc.get_json(),
+                         gen=gen, trans_id=trans_id)
+            self.responder.stream_entry(entry)
+
+        self.responder.content_type = 'application/x-u1db-sync-response'
+        self.responder.start_response(200)
+        self.responder.start_stream(),
         self.responder.stream_entry(header)
-        self.sync_exch.return_one_doc(send_doc)
+        self.sync_exch.return_docs(send_doc)
         self.responder.end_stream()
         self.responder.finish_response()
 
+    def _post_get_binary(self, header):
+        """
+        Return a batch of syncing documents to the client as binary frames.
+
+        :param header: The information about the sync session to be sent
+                       before the documents.
+        :type header: dict
+        """
+        frames = [encode_frame(header)]
+
+        def send_doc(doc, gen, trans_id):
+            METRICS.increment('sync.docs_sent')
+            entry = dict(id=doc.doc_id, rev=doc.rev, content=doc.get_json(),
+                         gen=gen, trans_id=trans_id)
+            frames.append(encode_doc_frame(entry))
+
+        self.sync_exch.return_docs(send_doc)
+        self.responder.content_type = make_content_type(
+            'application/x-soledad-sync-response', BINARY_FORMAT)
+        self.responder.send_response_content(''.join(frames))
+
     def post_end(self):
         """
-        Return the current generation and transaction_id after inserting one
-        incoming document.
+        Return the current generation and transaction_id after inserting the
+        batch of incoming documents.
         """
+        self._put_incoming_docs()
         self.responder.content_type = 'application/x-soledad-sync-response'
         self.responder.start_response(200)
         self.responder.start_stream(),
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+# sync_state.py
+# Copyright (C) 2014 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Stores for the state of ongoing sync sessions.
+
+The state of a sync session is made of the ids of documents seen during the
+session and of the changes to be returned to the source replica. Each session
+is identified by the database being synced, the uid of the source replica and
+the sync_id sent by the client, and storing one seen id costs the same no
+matter how many documents the session has already seen.
+"""
+
+
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+
+from couchdb.http import ResourceConflict, ResourceNotFound
+
+
+SYNC_STATE_TTL = 3600  # in seconds
+MAX_SYNC_STATES = 1000  # max number of sync states kept in memory
+
+
+class SyncStateStore(object):
+    """
+    The interface of a store for the state of sync sessions.
+    """
+
+    def put_seen_id(self, db, source_replica_uid, sync_id, seen_id, gen):
+        """
+        Store one document id seen during a sync session.
+
+        :param db: The target syncing database.
+        :type db: CouchDatabase
+        :param source_replica_uid: The uid of the source syncing replica.
+        :type source_replica_uid: str
+        :param sync_id: The id of the sync session.
+        :type sync_id: str
+        :param seen_id: The doc_id of a document seen during sync.
+        :type seen_id: str
+        :param gen: The corresponding db generation for that document.
+        :type gen: int
+        """
+        raise NotImplementedError(self.put_seen_id)
+
+    def put_seen_ids(self, db, source_replica_uid, sync_id, seen_ids):
+        """
+        Store many document ids seen during a sync session.
+
+        :param db: The target syncing database.
+        :type db: CouchDatabase
+        :param source_replica_uid: The uid of the source syncing replica.
+        :type source_replica_uid: str
+        :param sync_id: The id of the sync session.
+        :type sync_id: str
+        :param seen_ids: A list of (doc_id, gen) tuples for the documents
+                         seen during sync and their db generations.
+        :type seen_ids: list
+        """
+        raise NotImplementedError(self.put_seen_ids)
+
+    def seen_ids(self, db, source_replica_uid, sync_id):
+        """
+        Return the document ids seen during a sync session.
+
+        :param db: The target syncing database.
+        :type db: CouchDatabase
+        :param source_replica_uid: The uid of the source syncing replica.
+        :type source_replica_uid: str
+        :param sync_id: The id of the sync session.
+        :type sync_id: str
+
+        :return: A dictionary mapping seen doc ids to their generations.
+        :rtype: dict
+        """
+        raise NotImplementedError(self.seen_ids)
+
+    def put_changes_to_return(self, db, source_replica_uid, sync_id, gen,
+                              trans_id, changes_to_return):
+        """
+        Store the changes to be returned during a sync session, unless they
+        have already been stored.
+
+        :param db: The target syncing database.
+        :type db: CouchDatabase
+        :param source_replica_uid: The uid of the source syncing replica.
+        :type source_replica_uid: str
+        :param sync_id: The id of the sync session.
+        :type sync_id: str
+        :param gen: The target database generation that will be synced.
+        :type gen: int
+        :param trans_id: The target database transaction id that will be
+                         synced.
+        :type trans_id: str
+        :param changes_to_return: A list of (doc_id, gen, trans_id) tuples
+                                  with the changes to be returned.
+        :type changes_to_return: list
+
+        :return: The generation, transaction id and number of changes
+                 actually stored for the session, which are the ones
+                 stored first if many requests race to store them.
+        :rtype: tuple
+        """
+        raise NotImplementedError(self.put_changes_to_return)
+
+    def sync_info(self, db, source_replica_uid, sync_id):
+        """
+        Return the generation, transaction id and number of changes to be
+        returned during a sync session.
+
+        :param db: The target syncing database.
+        :type db: CouchDatabase
+        :param source_replica_uid: The uid of the source syncing replica.
+        :type source_replica_uid: str
+        :param sync_id: The id of the sync session.
+        :type sync_id: str
+
+        :return: The generation, transaction id and number of changes, or a
+                 tuple of Nones if the changes have not been stored yet.
+        :rtype: tuple
+        """
+        raise NotImplementedError(self.sync_info)
+
+    def changes_to_return(self, db, source_replica_uid, sync_id, start,
+                          limit):
+        """
+        Return some of the changes to be returned during a sync session.
+
+        :param db: The target syncing database.
+        :type db: CouchDatabase
+        :param source_replica_uid: The uid of the source syncing replica.
+        :type source_replica_uid: str
+        :param sync_id: The id of the sync session.
+        :type sync_id: str
+        :param start: The index of the first change to return.
+        :type start: int
+        :param limit: The maximum number of changes to return.
+        :type limit: int
+
+        :return: A list of (doc_id, gen, trans_id) tuples.
+        :rtype: list
+        """
+        raise NotImplementedError(self.changes_to_return)
+
+
+class CouchSyncStateStore(SyncStateStore):
+    """
+    A store that keeps the state of each sync session in its own couch
+    documents, on the database being synced.
+
+    The generation, transaction id and number of changes to return are
+    stored in a document with id
+    'u1db_sync_state_<source_replica_uid>_<sync_id>', where '_' and '%' in
+    the source replica uid and the sync id are escaped, so '_' only
+    separates the parts of ids.
+
+    The seen ids of each call to put_seen_ids() are stored together in one
+    document with id 'u1db_sync_state_<source_replica_uid>_<sync_id>_seen_'
+    followed by a random token, so storing them never conflicts.
+
+    The changes to return are written once per session, split in pages of
+    CHANGES_PAGE_SIZE changes, and are read by fetching only the pages that
+    contain the requested range. Page ids carry a random token recorded in
+    the session document, so pages of requests that race to store the
+    changes are never mixed.
+
+    Documents of previous sync sessions from the same source replica are
+    deleted when the changes to return of a new session are stored.
+    """
+
+    PREFIX = 'u1db_sync_state_'
+
+    CHANGES_PAGE_SIZE = 1000
+
+    def _escape(self, value):
+        return value.replace('%', '%25').replace('_', '%5F')
+
+    def _source_prefix(self, source_replica_uid):
+        return '%s%s_' % (self.PREFIX, self._escape(source_replica_uid))
+
+    def _state_id(self, source_replica_uid, sync_id):
+        return '%s%s' % (
+            self._source_prefix(source_replica_uid), self._escape(sync_id))
+
+    def _seen_prefix(self, source_replica_uid, sync_id):
+        return '%s_seen_' % self._state_id(source_replica_uid, sync_id)
+
+    def _page_id(self, state_id, token, page):
+        return '%s_changes_%s_%d' % (state_id, token, page)
+
+    def _get(self, db, doc_id):
+        try:
+            return db._database[doc_id]
+        except ResourceNotFound:
+            return None
+
+    def put_seen_id(self, db, source_replica_uid, sync_id, seen_id, gen):
+        self.put_seen_ids(
+            db, source_replica_uid, sync_id, [(seen_id, gen)])
+
+    def put_seen_ids(self, db, source_replica_uid, sync_id, seen_ids):
+        if not seen_ids:
+            return
+        db._database.save({
+            '_id': self._seen_prefix(source_replica_uid, sync_id)
+            + uuid.uuid4().hex,
+            'seen_ids': list(seen_ids),
+        })
+
+    def seen_ids(self, db, source_replica_uid, sync_id):
+        prefix = self._seen_prefix(source_replica_uid, sync_id)
+        rows = db._database.view(
+            '_all_docs', startkey=prefix, endkey=prefix + u'\ufff0',
+            include_docs=True)
+        # generations only grow during a session, so the highest one of a
+        # document sent many times is the latest
+        seen = {}
+        for row in rows:
+            for seen_id, gen in row.doc['seen_ids']:
+                seen[seen_id] = max(gen, seen.get(seen_id, gen))
+        return seen
+
+    def put_changes_to_return(self, db, source_replica_uid, sync_id, gen,
+                              trans_id, changes_to_return):
+        state_id = self._state_id(source_replica_uid, sync_id)
+        token = uuid.uuid4().hex
+        size = self.CHANGES_PAGE_SIZE
+        # pages are written before the session document, so they are
+        # available as soon as the session document is
+        pages = [
+            {
+                '_id': self._page_id(state_id, token, i // size),
+                'changes': changes_to_return[i:i + size],
+            }
+            for i in xrange(0, len(changes_to_return), size)]
+        if pages:
+            db._database.update(pages)
+        doc = {
+            '_id': state_id,
+            'gen': gen,
+            'trans_id': trans_id,
+            'number_of_changes': len(changes_to_return),
+            'token': token,
+            'page_size': size,
+        }
+        try:
+            db._database.save(doc)
+        except ResourceConflict:
+            # another request stored the changes first
+            if pages:
+                for page in pages:
+                    page['_deleted'] = True
+                db._database.update(pages)
+            return self.sync_info(db, source_replica_uid, sync_id)
+        self._delete_previous_sessions(db, source_replica_uid, sync_id)
+        return gen, trans_id, len(changes_to_return)
+
+    def _delete_previous_sessions(self, db, source_replica_uid, sync_id):
+        """
+        Delete documents of previous sync sessions from a source replica.
+        """
+        prefix = self._source_prefix(source_replica_uid)
+        current = self._state_id(source_replica_uid, sync_id)
+        rows = db._database.view(
+            '_all_docs', startkey=prefix, endkey=prefix + u'\ufff0')
+        stale = [
+            {'_id': row.id, '_rev': row.value['rev'], '_deleted': True}
+            for row in rows
+            if row.id != current and not row.id.startswith(current + '_')]
+        if stale:
+            db._database.update(stale)
+
+    def sync_info(self, db, source_replica_uid, sync_id):
+        doc = self._get(db, self._state_id(source_replica_uid, sync_id))
+        if doc is None:
+            return None, None, None
+        return doc['gen'], doc['trans_id'], doc['number_of_changes']
+
+    def changes_to_return(self, db, source_replica_uid, sync_id, start,
+                          limit):
+        state_id = self._state_id(source_replica_uid, sync_id)
+        doc = self._get(db, state_id)
+        if doc is None:
+            return []
+        end = min(start + limit, doc['number_of_changes'])
+        if start >= end:
+            return []
+        size = doc['page_size']
+        first_page = start // size
+        keys = [
+            self._page_id(state_id, doc['token'], page)
+            for page in xrange(first_page, (end - 1) // size + 1)]
+        changes = []
+        for row in db._database.view(
+                '_all_docs', keys=keys, include_docs=True):
+            changes.extend(row.doc['changes'])
+        offset = start - first_page * size
+        return map(tuple, changes[offset:offset + end - start])
+
+
+class MemorySyncStateStore(SyncStateStore):
+    """
+    A store that keeps the state of sync sessions in memory.
+
+    Sessions expire after some time without being used, and the least
+    recently used session is discarded when too many sessions are kept. The
+    state is not shared among server processes, so this store may only be
+    used when the server runs in a single process.
+    """
+
+    def __init__(self, max_states=MAX_SYNC_STATES, ttl=SYNC_STATE_TTL):
+        """
+        Initialize the store.
+
+        :param max_states: The maximum number of sessions to keep.
+        :type max_states: int
+        :param ttl: The time (in seconds) after which an unused session
+                    expires.
+        :type ttl: int
+        """
+        self._max_states = max_states
+        self._ttl = ttl
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _state(self, db, source_replica_uid, sync_id, create=False):
+        """
+        Return the state of a session, marking it as recently used.
+
+        Must be called with the lock held.
+        """
+        key = (db._dbname, source_replica_uid, sync_id)
+        state = self._states.pop(key, None)
+        now = time.time()
+        if state is not None and now - state['last_used'] > self._ttl:
+            state = None
+        if state is None:
+            if not create:
+                return None
+            state = {'seen_ids': {}, 'changes': None}
+        state['last_used'] = now
+        self._states[key] = state
+        while len(self._states) > self._max_states:
+            self._states.popitem(last=False)
+        return state
+
+    def put_seen_id(self, db, source_replica_uid, sync_id, seen_id, gen):
+        with self._lock:
+            state = self._state(db, source_replica_uid, sync_id, create=True)
+            state['seen_ids'][seen_id] = gen
+
+    def put_seen_ids(self, db, source_replica_uid, sync_id, seen_ids):
+        with self._lock:
+            state = self._state(db, source_replica_uid, sync_id, create=True)
+            state['seen_ids'].update(seen_ids)
+
+    def seen_ids(self, db, source_replica_uid, sync_id):
+        with self._lock:
+            state = self._state(db, source_replica_uid, sync_id)
+            if state is None:
+                return {}
+            return dict(state['seen_ids'])
+
+    def put_changes_to_return(self, db, source_replica_uid, sync_id, gen,
+                              trans_id, changes_to_return):
+        with self._lock:
+            state = self._state(db, source_replica_uid, sync_id, create=True)
+            if state['changes'] is None:
+                state['changes'] = (gen, trans_id, list(changes_to_return))
+            gen, trans_id, changes = state['changes']
+            return gen, trans_id, len(changes)
+
+    def sync_info(self, db, source_replica_uid, sync_id):
+        with self._lock:
+            state = self._state(db, source_replica_uid, sync_id)
+            if state is None or state['changes'] is None:
+                return None, None, None
+            gen, trans_id, changes = state['changes']
+            return gen, trans_id, len(changes)
+
+    def changes_to_return(self, db, source_replica_uid, sync_id, start,
+                          limit):
+        with self._lock:
+            state = self._state(db, source_replica_uid, sync_id)
+            if state is None or state['changes'] is None:
+                return []
+            _, _, changes = state['changes']
+            return [tuple(c) for c in changes[start:start + limit]]
+
+
+SYNC_STATE_STORES = {
+    'couch': CouchSyncStateStore,
+    'memory': MemorySyncStateStore,
+}
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_sync_state_store(name):
+    """
+    Return the store of some kind shared by the whole server.
+
+    :param name: The kind of store, one of the keys of SYNC_STATE_STORES.
+    :type name: str
+
+    :return: The sync state store.
+    :rtype: SyncStateStore
+    """
+    with _stores_lock:
+        if name not in _stores:
+            _stores[name] = SYNC_STATE_STORES[name]()
+        return _stores[name]